@@ -75,8 +75,42 @@ GpsFrontend = {}
     return processTime + readInterval + additionalDelay
   end
   
+  --- Moves the GPS along a track.
+  -- trackInfo.points is a list of gps.set tables, each with a time in seconds from the start.
+  -- With the GPS stand-in (Tools/Gateway) the whole track is uploaded in one request and replayed there,
+  -- otherwise the points are set one by one from here.
+  -- Unless trackInfo.noWait is set, returns after the last point has been read by the terminal.
+  -- @tparam table trackInfo points, ?loop (stand-in only), ?noWait
   function GpsFrontend:simulateTrack(trackInfo)
-    --TODO
+    local points = trackInfo.points
+    D:log("Simulating GPS track of " .. #points .. " points")
+    local uploaded = gps.uploadTrack(points, trackInfo.loop)
+    if uploaded then
+      if not trackInfo.noWait then
+        framework.delay(uploaded.Duration + self:getFullDelay())
+      end
+      return uploaded
+    end
+    if trackInfo.loop then
+      D:log("GPS track upload not available, the track is played once")
+    end
+    local started = os.time()
+    for _, point in ipairs(points) do
+      local position = {}
+      for k, v in pairs(point) do
+        if k ~= "time" then
+          position[k] = v
+        end
+      end
+      local wait = point.time - (os.time() - started)
+      if wait > 0 then
+        framework.delay(wait)
+      end
+      gps.set(position)
+    end
+    if not trackInfo.noWait then
+      framework.delay(self:getFullDelay())
+    end
   end
   
   function GpsFrontend:normalize(value)
@@ -0,0 +1,57 @@
+-- Traffic
+-- Test marks for the web service traffic recording of the gateway stand-in
+-- (Tools/Gateway/gateway.py --record / --replay, see Tools/Gateway/traffic.py)
+-- and the Lua clock of a replay
+local http = require("socket.http")
+local socket = require("socket")
+local url = require("socket.url")
+
+Traffic = {}
+  Traffic.suite = ""
+
+  --- Tells the gateway stand-in at baseUrl where a test starts, the replay answers each test from its own part of the recording
+  function Traffic:markTests(lunatest, baseUrl)
+    for _, hooks in ipairs({lunatest.default_hooks, lunatest.verbose_hooks}) do
+      local beginSuite, preTest = hooks.begin_suite, hooks.pre_test
+      hooks.begin_suite = function(s_env, tests)
+        Traffic.suite = s_env.name
+        if beginSuite then beginSuite(s_env, tests) end
+      end
+      hooks.pre_test = function(name)
+        Traffic:mark(baseUrl, Traffic.suite .. "/" .. name)
+        if preTest then preTest(name) end
+      end
+    end
+  end
+
+  function Traffic:mark(baseUrl, name)
+    local ok, code = http.request(baseUrl .. "/Replay/mark.json/?name=" .. url.escape(name))
+    if not ok then
+      D:log("Traffic mark " .. name .. " not sent: " .. tostring(code))
+    end
+  end
+
+  --- Runs os.time() and socket.sleep() (so framework.delay) speed times faster; 0 skips every sleep.
+  -- The recorded answers come as fast, so the tests' timeouts and intervals still fit them.
+  function Traffic:replayClock(speed)
+    local sleep, time, gettime = socket.sleep, os.time, socket.gettime
+    local start = gettime()
+    local skipped = 0
+    local scale = speed > 0 and speed or 1
+    socket.sleep = function(seconds)
+      if speed > 0 then
+        sleep(seconds / speed)
+      else
+        skipped = skipped + seconds
+      end
+    end
+    os.time = function(t)
+      if t then return time(t) end
+      return math.floor(start + (gettime() - start) * scale + skipped)
+    end
+  end
+
+-- usage
+-- require("Infrastructure/Traffic/Traffic")
+-- Traffic:markTests(lunatest, cfg.GATEWAY_URL)
+-- Traffic:replayClock(0)
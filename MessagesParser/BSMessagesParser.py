@@ -1,24 +1,13 @@
-from bs4 import BeautifulSoup
-xmlStr = open("2VmsMessages.xml").read()
-xmlObj = BeautifulSoup(xmlStr,"xml")
+from catalogcompiler import iter_services
 
-forwardMessages = xmlObj.find("ForwardMessages").findAll("Message")
-returnMessages =  xmlObj.find("ReturnMessages").findAll("Message")
+for service, digest in iter_services("2VmsMessages.xml"):
+  print("FORWARD  MSGs:")
 
-outputForward = []
-outputReturn = []
-
-print "FORWARD  MSGs:"
-
-for msg in forwardMessages:
-  outputForward.append({ "name" : msg.Name.string, "Min" : msg.MIN.string })
-  print "{name=\"%s\", min=%s},"%(msg.Name.string,msg.MIN.string)
-
-print "****"
-print "RETURN  MSGs:"
-
-for msg in returnMessages:
-  outputReturn.append({ "name" : msg.Name.string, "Min" : msg.MIN.string })
-  print "{name=\"%s\", min=%s},"%(msg.Name.string,msg.MIN.string)
+  for msg in service["forward"]:
+    print("{name=\"%s\", min=%s},"%(msg["name"],msg["min"]))
 
+  print("****")
+  print("RETURN  MSGs:")
 
+  for msg in service["return"]:
+    print("{name=\"%s\", min=%s},"%(msg["name"],msg["min"]))
@@ -1,63 +1,41 @@
-from bs4 import BeautifulSoup
 import sys
 
+from catalogcompiler import iter_services
+
 class CoreServicesMsgParser():
 
   inputFile = "metadata"
 
-  def __init__(self):
-    self.xmlStr = open(self.inputFile).read()
-    self.xmlObj = BeautifulSoup(self.xmlStr,"xml")
-
   def parse(self,sin=None):
-    services = self.xmlObj.find("Services").findAll("Service")
-
-    for service in services:
+    for service, digest in iter_services(self.inputFile):
       self.parseService(service,sin)
-   
+
 
   def parseService(self, service,requestedSin=None):
 
     if not service: return
 
-    forwardMessages = service.find("ForwardMessages")
-
-    returnMessages =  service.find("ReturnMessages")
-    
-    properties =  service.find("Properties")
-
-    sin = service.find("SIN").string
+    sin = service["sin"]
     if requestedSin != None and int(requestedSin) != int(sin):
-      return 
+      return
 
-    serviceName = service.find("Name").string
-    outputForward = []
-    outputReturn = []
+    serviceName = service["name"]
 
-    print "FORWARD  MSG of %s (SIN %s) :"%(serviceName,sin)
+    print("FORWARD  MSG of %s (SIN %s) :"%(serviceName,sin))
+    for msg in service["forward"]:
+      print("{ name =\"%s\", min=%s},"%(msg["name"],msg["min"]))
 
-    if forwardMessages:
-        for msg in forwardMessages.findAll("Message"):
-          outputForward.append({ "name" : msg.Name.string, "Min" : msg.MIN.string })
-          print "{ name =\"%s\", min=%s},"%(msg.Name.string,msg.MIN.string)
+    print("****")
+    print("RETURN  MSG of %s (SIN %s) :"%(serviceName,sin))
+    for msg in service["return"]:
+      print("{ name =\"%s\", min=%s},"%(msg["name"],msg["min"]))
 
-    print "****"
-    print "RETURN  MSG of %s (SIN %s) :"%(serviceName,sin)
+    print("****")
+    print("Properties of %s (SIN %s) :"%(serviceName,sin))
+    for property in service["properties"]:
+      print("{ name =\"%s\", pin=%s, ptype=\"%s\"},"%(property["name"],property["pin"], property["ptype"]))
 
-    if returnMessages:
-        for msg in returnMessages.findAll("Message"):
-          outputReturn.append({ "name" : msg.Name.string, "Min" : msg.MIN.string })
-          print "{ name =\"%s\", min=%s},"%(msg.Name.string,msg.MIN.string)
 
-	print "****"
-    print "Properties of %s (SIN %s) :"%(serviceName,sin)
-    if properties:
-	    for property in properties.findAll("Property"):
-			type = property["xsi:type"].lower().replace("property", "")
-			outputReturn.append({ "name" : property.Name.string, "pin" : property.PIN.string, "type" : type})
-			print "{ name =\"%s\", pin=%s, ptype=\"%s\"},"%(property.Name.string,property.PIN.string, type)
-      
-    
 parser = CoreServicesMsgParser()
 if len(sys.argv) == 2:
   parser.parse(sys.argv[1])
@@ -0,0 +1,173 @@
+"""Indexed lookups of messages and properties by SIN/MIN, SIN/PIN and name.
+
+The index is built from the service XML with catalogcompiler and pickled
+next to it, so tools decoding large logs load it once without parsing XML:
+
+  from catalog import Catalog
+  cat = Catalog.load()
+  cat.return_message(16, 1)      # {"sin": 16, "min": 1, "name": "terminalInfo", "service": "system", ...}
+  cat.property(16, 1)["name"]    # "executionWatchdogTimeout"
+  cat.by_name("terminalInfo")    # every message/property with that name
+"""
+import argparse
+import hashlib
+import os
+import pickle
+import re
+import sys
+
+from catalogcompiler import parse_catalog
+
+DEFAULT_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "metadata")
+INDEX_VERSION = 1
+SIN_RE = re.compile(r"\bSIN\s*=\s*(\d+)")
+MIN_RE = re.compile(r"\bMIN\s*=\s*(\d+)")
+PIN_RE = re.compile(r"\bPIN\s*=\s*(\d+)", re.IGNORECASE)
+
+
+class Catalog():
+  def __init__(self, forward, returned, properties, names, services, sources_hash=None):
+    self.forward = forward            # (sin, min) -> message
+    self.returned = returned          # (sin, min) -> message
+    self.properties = properties      # (sin, pin) -> property
+    self.names = names                # name -> [entry, ...]
+    self.services = services          # sin -> service name
+    self.sources_hash = sources_hash
+
+  @classmethod
+  def build(cls, *sources):
+    forward = {}
+    returned = {}
+    properties = {}
+    names = {}
+    services = {}
+    for sin, service in parse_catalog(*sources).items():
+      services[sin] = service["name"]
+      for kind, items, key, table in (("forward", service["forward"], "min", forward),
+                                      ("return", service["return"], "min", returned),
+                                      ("property", service["properties"], "pin", properties)):
+        for item in items:
+          entry = dict(item)
+          entry["sin"] = sin
+          entry["service"] = service["name"]
+          entry["kind"] = kind
+          table[(sin, item[key])] = entry
+          names.setdefault(item["name"], []).append(entry)
+    return cls(forward, returned, properties, names, services, _sources_hash(sources))
+
+  def save(self, path):
+    with open(path, "wb") as f:
+      pickle.dump((INDEX_VERSION, self.__dict__), f, pickle.HIGHEST_PROTOCOL)
+
+  @classmethod
+  def load(cls, path=None, sources=None):
+    """Loads a precompiled index, rebuilding it when missing, outdated or built from other XML.
+
+    An index whose sources are not there is used as it is.
+    """
+    sources = sources or [DEFAULT_SOURCE]
+    path = path or index_path(sources[0])
+    if os.path.abspath(path) in [os.path.abspath(source) for source in sources]:
+      # a rebuilt index would be saved over the XML
+      raise ValueError("Index %s is one of the sources" % path)
+    try:
+      expected_hash = _sources_hash(sources)
+    except (IOError, OSError):
+      expected_hash = None
+    try:
+      with open(path, "rb") as f:
+        version, state = pickle.load(f)
+      if version == INDEX_VERSION and (expected_hash is None or state.get("sources_hash") == expected_hash):
+        catalog = cls.__new__(cls)
+        catalog.__dict__.update(state)
+        return catalog
+    except (IOError, OSError, ValueError, EOFError, pickle.UnpicklingError):
+      pass
+    catalog = cls.build(*sources)
+    try:
+      catalog.save(path)
+    except (IOError, OSError):
+      pass
+    return catalog
+
+  def forward_message(self, sin, min):
+    return self.forward.get((int(sin), int(min)))
+
+  def return_message(self, sin, min):
+    return self.returned.get((int(sin), int(min)))
+
+  def property(self, sin, pin):
+    return self.properties.get((int(sin), int(pin)))
+
+  def by_name(self, name):
+    return self.names.get(name, [])
+
+  def service_name(self, sin):
+    return self.services.get(int(sin))
+
+
+def annotate(catalog, lines):
+  """Appends the decoded service/message/property name to every line mentioning SIN= (and MIN= or PIN=)."""
+  for line in lines:
+    sin = SIN_RE.search(line)
+    if not sin:
+      yield line
+      continue
+    sin = int(sin.group(1))
+    names = [catalog.service_name(sin) or "SIN %d" % sin]
+    min = MIN_RE.search(line)
+    if min:
+      msg = catalog.return_message(sin, min.group(1)) or catalog.forward_message(sin, min.group(1))
+      names.append(msg["name"] if msg else "MIN %s" % min.group(1))
+    pin = PIN_RE.search(line)
+    if pin:
+      prop = catalog.property(sin, pin.group(1))
+      names.append(prop["name"] if prop else "PIN %s" % pin.group(1))
+    yield "%s  [%s]\n" % (line.rstrip("\r\n"), "/".join(names))
+
+
+def index_path(source):
+  return source + ".idx"
+
+
+def _sources_hash(sources):
+  digest = hashlib.sha1()
+  for source in sources:
+    with open(source, "rb") as f:
+      digest.update(f.read())
+  return digest.hexdigest()
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Builds the catalog index or looks up SIN/MIN, SIN/PIN and names.")
+  parser.add_argument("--source", action="append", help="Service definition XML, can be repeated (default: metadata)")
+  parser.add_argument("--index", default=None, help="Index file (default: <first source>.idx)")
+  parser.add_argument("--sin", type=int)
+  parser.add_argument("--min", type=int, help="Message MIN, looked up in return and forward messages")
+  parser.add_argument("--pin", type=int)
+  parser.add_argument("--name")
+  parser.add_argument("--annotate", help="Log file to copy to stdout with SIN/MIN/PIN names appended, - for stdin")
+  args = parser.parse_args()
+
+  try:
+    catalog = Catalog.load(args.index, args.source)
+  except ValueError as e:
+    parser.error(str(e))
+  if args.annotate:
+    log = sys.stdin if args.annotate == "-" else open(args.annotate, errors="replace")
+    sys.stdout.writelines(annotate(catalog, log))
+    sys.exit(0)
+  found = []
+  if args.sin is not None and args.min is not None:
+    found += [entry for entry in (catalog.return_message(args.sin, args.min), catalog.forward_message(args.sin, args.min)) if entry]
+  if args.sin is not None and args.pin is not None:
+    found += [entry for entry in [catalog.property(args.sin, args.pin)] if entry]
+  if args.name:
+    found += catalog.by_name(args.name)
+  if not (args.min is not None or args.pin is not None or args.name):
+    print("Index with %d service(s), %d forward, %d return message(s), %d property(ies)" % (
+      len(catalog.services), len(catalog.forward), len(catalog.returned), len(catalog.properties)))
+  for entry in found:
+    print(entry)
+  if (args.min is not None or args.pin is not None or args.name) and not found:
+    sys.exit(1)
@@ -0,0 +1,223 @@
+"""Compiles service message definitions (metadata, AllMessages.xml) into Lua catalog tables.
+
+One streaming pass over the XML builds, per service, the SIN, forward and
+return messages (name, MIN) and properties (name, PIN, type, default,
+minimum, maximum, enum items). Every service is written to
+<output>/<service name>.lua, a service name defined twice (in one or several
+sources) is an error. A hash cache keeps services whose XML did not change
+from being regenerated.
+"""
+import argparse
+import hashlib
+import json
+import os
+import time
+import xml.etree.ElementTree as ET
+
+XSI_TYPE = "{http://www.w3.org/2001/XMLSchema-instance}type"
+CACHE_FILE = ".catalogcache.json"
+LUA_KEYWORDS = set("and break do else elseif end false for function goto if in local nil not or repeat return then true until while".split())
+
+
+def _text(element, path, default=None):
+  child = element.find(path)
+  if child is None or child.text is None:
+    return default
+  return child.text.strip()
+
+
+def _int(value):
+  try:
+    return int(value)
+  except (TypeError, ValueError):
+    return value
+
+
+def _messages(service, path):
+  messages = []
+  for msg in service.findall(path + "/Message"):
+    messages.append({"name" : _text(msg, "Name"), "min" : _int(_text(msg, "MIN"))})
+  return messages
+
+
+def _property(prop):
+  ptype = prop.get(XSI_TYPE, "").lower().replace("property", "")
+  result = {"name" : _text(prop, "Name"), "pin" : _int(_text(prop, "PIN")), "ptype" : ptype}
+  default = _text(prop, "Value")
+  if default is not None:
+    if ptype == "boolean":
+      default = default.lower() == "true"
+    elif ptype in ("unsignedint", "signedint", "enum"):
+      default = _int(default)
+    result["default"] = default
+  for key, path in (("min", "Minimum"), ("max", "Maximum")):
+    value = _text(prop, path)
+    if value is not None:
+      result[key] = _int(value)
+  items = prop.find("Items")
+  if items is not None:
+    # an empty <item/> keeps its place, the enum values are the item positions
+    result["enums"] = [item.text.strip() if item.text else None for item in items]
+  return result
+
+
+def parse_service(service):
+  """Builds the catalog model of one <Service> element."""
+  return {
+    "name" : _text(service, "Name"),
+    "sin" : _int(_text(service, "SIN")),
+    "forward" : _messages(service, "ForwardMessages"),
+    "return" : _messages(service, "ReturnMessages"),
+    "properties" : [_property(prop) for prop in service.findall("Properties/Property")],
+  }
+
+
+def iter_services(source):
+  """Yields (model, content hash) for every service in the file, keeping only one service in memory."""
+  found = False
+  root = None
+  for event, element in ET.iterparse(source, events=("start", "end")):
+    if event == "start":
+      if root is None:
+        root = element
+      continue
+    if element.tag == "Service":
+      found = True
+      digest = hashlib.sha1(ET.tostring(element)).hexdigest()
+      yield parse_service(element), digest
+      element.clear()
+  # single service files (e.g. VMS messages) keep messages directly under the root
+  if not found and root is not None and (root.find("ForwardMessages") is not None or root.find("ReturnMessages") is not None):
+    model = parse_service(root)
+    model["name"] = model["name"] or os.path.splitext(os.path.basename(source))[0]
+    yield model, hashlib.sha1(ET.tostring(root)).hexdigest()
+
+
+def parse_catalog(*sources):
+  """Returns {SIN: service model} for the given XML files."""
+  catalog = {}
+  for source in sources:
+    for model, digest in iter_services(source):
+      catalog[model["sin"]] = model
+  return catalog
+
+
+def _lua_value(value):
+  if isinstance(value, bool):
+    return "true" if value else "false"
+  if isinstance(value, int):
+    return str(value)
+  return '"%s"' % str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _lua_key(name):
+  if name.isidentifier() and name not in LUA_KEYWORDS:
+    return name
+  return "[%s]" % _lua_value(name)
+
+
+def _lua_item(item, keys):
+  fields = ["%s=%s" % (key, _lua_value(item[key])) for key in keys if key in item]
+  if "enums" in item:
+    enums = ", ".join("%s=%d" % (_lua_key(name), index) for index, name in enumerate(item["enums"]) if name)
+    fields.append("enums={ %s }" % enums)
+  return "{ %s}," % ", ".join(fields)
+
+
+def to_lua(model, source_name):
+  lines = [
+    "-- Generated by MessagesParser/catalogcompiler.py from %s, do not edit." % source_name,
+    "-- %s (SIN %s)" % (model["name"], model["sin"]),
+    "return {",
+    "  name = %s," % _lua_value(model["name"]),
+    "  sin = %s," % _lua_value(model["sin"]),
+  ]
+  for key, items, fields in (
+      ("messages_to", model["forward"], ("name", "min")),
+      ("messages_from", model["return"], ("name", "min")),
+      ("properties", model["properties"], ("name", "pin", "ptype", "default", "min", "max"))):
+    lines.append("  %s = {" % key)
+    for item in items:
+      lines.append("    " + _lua_item(item, fields))
+    lines.append("  },")
+  lines.append("}")
+  return "\n".join(lines) + "\n"
+
+
+def _load_cache(path):
+  try:
+    with open(path) as f:
+      return json.load(f)
+  except (IOError, ValueError):
+    return {"files" : {}, "services" : {}}
+
+
+def _file_hash(path):
+  with open(path, "rb") as f:
+    return hashlib.sha1(f.read()).hexdigest()
+
+
+def compile_catalog(sources, output, force=False):
+  """Writes Lua tables of changed services. Returns (compiled, unchanged, shadowed) service names.
+
+  A service defined by several sources is taken from the last of them, shadowed
+  lists (name, source, winning source) of the definitions left out.
+  """
+  if not os.path.isdir(output):
+    os.makedirs(output)
+  cache_path = os.path.join(output, CACHE_FILE)
+  cache = {"files" : {}, "services" : {}} if force else _load_cache(cache_path)
+  compiled = []
+  unchanged = []
+  shadowed = []
+  # service name -> source defining it; sources are read last first so that the later one wins
+  defined = {}
+  for source in reversed(sources):
+    source_hash = _file_hash(source)
+    cached = cache["files"].get(source)
+    if cached and cached["hash"] == source_hash and not any(name in defined for name in cached["services"]) and \
+        all(os.path.exists(os.path.join(output, name + ".lua")) for name in cached["services"]):
+      for name in cached["services"]:
+        defined[name] = source
+      unchanged.extend(cached["services"])
+      continue
+    names = []
+    for model, digest in iter_services(source):
+      name = model["name"]
+      if name in defined:
+        shadowed.append((name, source, defined[name]))
+        continue
+      defined[name] = source
+      names.append(name)
+      target = os.path.join(output, name + ".lua")
+      if cache["services"].get(name) == digest and os.path.exists(target):
+        unchanged.append(name)
+        continue
+      with open(target, "w") as f:
+        f.write(to_lua(model, os.path.basename(source)))
+      cache["services"][name] = digest
+      compiled.append(name)
+    if any(shadowed_source == source for _, shadowed_source, _ in shadowed):
+      # parsed again next time, the services left out may be its own then
+      cache["files"].pop(source, None)
+    else:
+      cache["files"][source] = {"hash" : source_hash, "services" : names}
+  with open(cache_path, "w") as f:
+    json.dump(cache, f, indent=1, sort_keys=True)
+  return compiled, unchanged, shadowed
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Compiles service XML definitions into Lua message/property tables.")
+  parser.add_argument("--source", action="append", help="Service definition XML, can be repeated (default: metadata)")
+  parser.add_argument("--output", default="catalog", help="Directory for generated Lua files")
+  parser.add_argument("--force", action="store_true", help="Regenerate all services ignoring the hash cache")
+  args = parser.parse_args()
+
+  start = time.time()
+  compiled, unchanged, shadowed = compile_catalog(args.source or ["metadata"], args.output, args.force)
+  for name in compiled:
+    print("compiled " + name)
+  for name, source, winner in shadowed:
+    print("warning: service %s of %s is also defined in %s, using %s" % (name, source, winner, winner))
+  print("%d service(s) compiled, %d unchanged in %.1f ms" % (len(compiled), len(unchanged), (time.time() - start) * 1000))
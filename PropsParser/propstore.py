@@ -0,0 +1,327 @@
+"""Snapshot store of terminal properties from 'prop list' dumps, diffed against each other or catalog defaults.
+
+Every dump (the pasted output of 'prop list <service>' for one or more
+services) becomes a snapshot keyed by terminal, run and time in one SQLite
+file; the values are kept once per (snapshot, SIN, PIN) in a table clustered
+on that key, so comparing two snapshots is one merge pass over two index
+ranges and a snapshot against the catalog one pass with dictionary lookups:
+
+  python propstore.py props.db --add dumps/*.txt --run before
+  python propstore.py props.db --list
+  python propstore.py props.db --diff terminal7@before terminal7@after
+  python propstore.py props.db --defaults terminal7
+  python propstore.py props.db --check
+
+A snapshot is given as its id, terminal (its latest snapshot) or terminal@run.
+The terminal of a dump is its file name unless --terminal is given.
+Defaults, minimum, maximum and enum items come from MessagesParser/catalog.py
+(metadata, more with --source).
+"""
+import argparse
+import glob
+import os
+import re
+import sqlite3
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "MessagesParser"))
+from catalog import Catalog
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+  id INTEGER PRIMARY KEY,
+  terminal TEXT,
+  run TEXT,
+  taken REAL,
+  source TEXT
+);
+CREATE INDEX IF NOT EXISTS snapshots_terminal ON snapshots (terminal, run, taken);
+CREATE TABLE IF NOT EXISTS pins (
+  sin INTEGER,
+  pin INTEGER,
+  name TEXT,
+  PRIMARY KEY (sin, pin)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS props (
+  snapshot INTEGER REFERENCES snapshots(id),
+  sin INTEGER,
+  pin INTEGER,
+  value TEXT,
+  PRIMARY KEY (snapshot, sin, pin)
+) WITHOUT ROWID;
+"""
+
+# services 'prop list' knows by a name the catalog XML does not define
+EXTRA_SERVICES = {"vms" : 115}
+# 'prop list VMS' / 'prop get VMS' starts the properties of a service
+COMMAND_RE = re.compile(r"\bprop\s+(?:list|get)\s+(\w+)", re.IGNORECASE)
+# <index or service> PIN=12(StandardReport1Interval) 60, optionally with SIN=115 on the line
+PROPERTY_RE = re.compile(r"\bPIN=(\d+)\(([^)]*)\)\s*[:=]?\s*(.*)$")
+LINE_SIN_RE = re.compile(r"\bSIN=(\d+)")
+
+CHANGED = "changed"
+ADDED = "added"
+REMOVED = "removed"
+DEFAULT = "default"
+OUT_OF_RANGE = "range"
+INVALID = "invalid"
+UNKNOWN = "unknown"
+
+
+def _value(text):
+  text = text.strip()
+  if len(text) > 1 and text[0] == text[-1] and text[0] in "\"'":
+    return text[1:-1]
+  return text
+
+
+def service_sins(catalog, extra=None):
+  """Lower case service name -> SIN of every service the catalog defines, and the extra ones."""
+  sins = dict((name.lower(), sin) for sin, name in catalog.services.items())
+  sins.update(EXTRA_SERVICES)
+  sins.update(dict((name.lower(), sin) for name, sin in (extra or {}).items()))
+  return sins
+
+
+def parse_dump(lines, sins, service=None):
+  """Yields (sin, pin, name, value) of a 'prop list' dump. service names the SIN of dumps without a prop command line."""
+  sin = sins.get(service.lower()) if service else None
+  if service and sin is None:
+    raise Exception("Unknown service %s, give its SIN with --service %s=<SIN>" % (service, service))
+  for line in lines:
+    match = PROPERTY_RE.search(line)
+    if not match:
+      command = COMMAND_RE.search(line)
+      if command:
+        sin = sins.get(command.group(1).lower())
+        if sin is None:
+          raise Exception("Unknown service %s, give its SIN with --service %s=<SIN>" % (command.group(1), command.group(1)))
+      continue
+    line_sin = LINE_SIN_RE.search(line) if "SIN=" in line else None
+    current = int(line_sin.group(1)) if line_sin else sin
+    if current is None:
+      raise Exception("No service for '%s', the dump needs its 'prop list <service>' line or --dumpservice" % line.strip())
+    yield current, int(match.group(1)), match.group(2), _value(match.group(3))
+
+
+def check_value(prop, value):
+  """None when value is the catalog default of the property, otherwise DEFAULT, OUT_OF_RANGE or INVALID."""
+  ptype = prop.get("ptype")
+  try:
+    if ptype == "boolean":
+      if value.lower() not in ("true", "false", "1", "0"):
+        return INVALID
+      parsed = value.lower() in ("true", "1")
+    elif ptype in ("unsignedint", "signedint"):
+      parsed = int(value)
+      if ("min" in prop and isinstance(prop["min"], int) and parsed < prop["min"]) or \
+          ("max" in prop and isinstance(prop["max"], int) and parsed > prop["max"]) or \
+          (ptype == "unsignedint" and parsed < 0):
+        return OUT_OF_RANGE
+    elif ptype == "enum":
+      enums = prop.get("enums") or []
+      parsed = enums.index(value) if value in enums else int(value)
+      if enums and not 0 <= parsed < len(enums):
+        return OUT_OF_RANGE
+    else:
+      parsed = value
+  except ValueError:
+    return INVALID
+  if "default" in prop and parsed != prop["default"]:
+    return DEFAULT
+  return None
+
+
+class PropertyStore():
+  def __init__(self, path):
+    self.connection = sqlite3.connect(path, timeout=60)
+    self.connection.execute("PRAGMA journal_mode=WAL")
+    # a snapshot lost to a power cut is pasted again, every dump need not wait for the disk
+    self.connection.execute("PRAGMA synchronous=NORMAL")
+    self.connection.executescript(SCHEMA)
+    self._names = None
+
+  def add(self, terminal, lines, run=None, taken=None, source=None, sins=None, service=None):
+    """Stores one dump as a snapshot, returns (snapshot id, number of values)."""
+    rows = {}
+    names = {}
+    for sin, pin, name, value in parse_dump(lines, sins or {}, service):
+      # a PIN listed twice keeps its last value, as the terminal would have it
+      rows[(sin, pin)] = value
+      names[(sin, pin)] = name
+    with self.connection:
+      cursor = self.connection.execute("INSERT INTO snapshots (terminal, run, taken, source) VALUES (?, ?, ?, ?)",
+        (terminal, run, taken if taken is not None else time.time(), source))
+      snapshot = cursor.lastrowid
+      # every terminal lists the same PINs, only new names are written
+      known = self.names()
+      changed = [(sin, pin, name) for (sin, pin), name in names.items() if known.get((sin, pin)) != name]
+      self.connection.executemany("INSERT OR REPLACE INTO pins (sin, pin, name) VALUES (?, ?, ?)", changed)
+      known.update(((sin, pin), name) for sin, pin, name in changed)
+      self.connection.executemany("INSERT INTO props (snapshot, sin, pin, value) VALUES (?, ?, ?, ?)",
+        [(snapshot, sin, pin, value) for (sin, pin), value in rows.items()])
+    return snapshot, len(rows)
+
+  def snapshots(self, terminal=None):
+    query = "SELECT s.id, s.terminal, s.run, s.taken, s.source, COUNT(p.pin) FROM snapshots s LEFT JOIN props p ON p.snapshot = s.id"
+    if terminal is not None:
+      return self.connection.execute(query + " WHERE s.terminal = ? GROUP BY s.id ORDER BY s.terminal, s.taken", (terminal,)).fetchall()
+    return self.connection.execute(query + " GROUP BY s.id ORDER BY s.terminal, s.taken").fetchall()
+
+  def latest(self):
+    """Ids of the latest snapshot of every terminal."""
+    return [row[0] for row in self.connection.execute(
+      "SELECT id FROM snapshots s WHERE id = (SELECT id FROM snapshots WHERE terminal = s.terminal ORDER BY taken DESC, id DESC LIMIT 1) ORDER BY terminal")]
+
+  def resolve(self, reference):
+    """Snapshot id of an id, terminal (latest snapshot) or terminal@run (latest snapshot of the run)."""
+    if reference.isdigit():
+      row = self.connection.execute("SELECT id FROM snapshots WHERE id = ?", (int(reference),)).fetchone()
+    else:
+      terminal, _, run = reference.partition("@")
+      if run:
+        row = self.connection.execute("SELECT id FROM snapshots WHERE terminal = ? AND run = ? ORDER BY taken DESC, id DESC LIMIT 1", (terminal, run)).fetchone()
+      else:
+        row = self.connection.execute("SELECT id FROM snapshots WHERE terminal = ? ORDER BY taken DESC, id DESC LIMIT 1", (terminal,)).fetchone()
+    if row is None:
+      raise Exception("No snapshot " + reference)
+    return row[0]
+
+  def describe(self, snapshot):
+    terminal, run, taken = self.connection.execute("SELECT terminal, run, taken FROM snapshots WHERE id = ?", (snapshot,)).fetchone()
+    return "#%d %s%s %s" % (snapshot, terminal, "@" + run if run else "", time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(taken)))
+
+  def values(self, snapshot):
+    """(sin, pin, value) of a snapshot in (sin, pin) order, read along the primary key."""
+    return self.connection.execute("SELECT sin, pin, value FROM props WHERE snapshot = ? ORDER BY sin, pin", (snapshot,))
+
+  def names(self):
+    """(sin, pin) -> property name as the dumps list it."""
+    if self._names is None:
+      self._names = dict(((sin, pin), name) for sin, pin, name in self.connection.execute("SELECT sin, pin, name FROM pins"))
+    return self._names
+
+  def diff(self, first, second):
+    """Yields (sin, pin, CHANGED/ADDED/REMOVED, first value, second value), merging both snapshots in one pass."""
+    a, b = self.values(first), self.values(second)
+    row_a, row_b = next(a, None), next(b, None)
+    while row_a is not None or row_b is not None:
+      key_a = row_a[:2] if row_a is not None else None
+      key_b = row_b[:2] if row_b is not None else None
+      if key_b is None or (key_a is not None and key_a < key_b):
+        yield key_a + (REMOVED, row_a[2], None)
+        row_a = next(a, None)
+      elif key_a is None or key_b < key_a:
+        yield key_b + (ADDED, None, row_b[2])
+        row_b = next(b, None)
+      else:
+        if row_a[2] != row_b[2]:
+          yield key_a + (CHANGED, row_a[2], row_b[2])
+        row_a, row_b = next(a, None), next(b, None)
+
+  def against_catalog(self, snapshot, catalog, ranges_only=False):
+    """Yields (sin, pin, DEFAULT/OUT_OF_RANGE/INVALID/UNKNOWN, value, catalog property or None)."""
+    for sin, pin, value in self.values(snapshot):
+      prop = catalog.property(sin, pin)
+      if prop is None:
+        # services the catalog XML does not define are not flagged pin by pin
+        if not ranges_only and sin in catalog.services:
+          yield sin, pin, UNKNOWN, value, None
+        continue
+      result = check_value(prop, value)
+      if result is None or (ranges_only and result == DEFAULT):
+        continue
+      yield sin, pin, result, value, prop
+
+
+def _label(sin, pin, names, prop=None):
+  name = prop["name"] if prop else names.get((sin, pin), "")
+  return "%d/%d %s" % (sin, pin, name)
+
+
+def _range(prop):
+  if not prop:
+    return ""
+  if prop.get("enums"):
+    return "enum " + ",".join(name or "" for name in prop["enums"])
+  if "min" in prop or "max" in prop:
+    return "%s..%s" % (prop.get("min", ""), prop.get("max", ""))
+  return prop.get("ptype", "")
+
+
+def expand(patterns):
+  """Dump files of the arguments, wildcards are expanded here as the Windows shell does not."""
+  paths = []
+  for pattern in patterns:
+    matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+    paths.extend(path for path in matches if path not in paths)
+  return paths
+
+
+def parse_services(values):
+  """NAME=SIN arguments -> {name: sin}."""
+  services = {}
+  for value in values or []:
+    name, _, sin = value.partition("=")
+    if not sin.isdigit():
+      raise Exception("Expected NAME=SIN, got " + value)
+    services[name] = int(sin)
+  return services
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Stores 'prop list' dumps as terminal property snapshots and diffs them.")
+  parser.add_argument("database", help="Snapshot store, created when missing")
+  parser.add_argument("--add", nargs="+", metavar="DUMP", help="'prop list' dumps or wildcards to store, one snapshot each")
+  parser.add_argument("--terminal", help="Terminal of the added dumps (default: the file name)")
+  parser.add_argument("--run", help="Run the added snapshots belong to, e.g. before or after")
+  parser.add_argument("--dumpservice", help="Service of dumps without their 'prop list <service>' line")
+  parser.add_argument("--service", action="append", metavar="NAME=SIN", help="SIN of a service the catalog does not define")
+  parser.add_argument("--source", action="append", help="Service definition XML of the catalog, can be repeated (default: metadata)")
+  parser.add_argument("--list", action="store_true", help="Lists the snapshots")
+  parser.add_argument("--diff", nargs=2, metavar="SNAPSHOT", help="Properties that differ between two snapshots")
+  parser.add_argument("--defaults", metavar="SNAPSHOT", help="Properties of a snapshot that are not at their catalog default or out of range")
+  parser.add_argument("--check", action="store_true", help="Out of range and invalid values in the latest snapshot of every terminal")
+  args = parser.parse_args()
+
+  store = PropertyStore(args.database)
+  catalog = None
+  if args.add or args.defaults or args.check:
+    catalog = Catalog.load(None, args.source)
+  found = 0
+  if args.add:
+    sins = service_sins(catalog, parse_services(args.service))
+    start = time.time()
+    values = 0
+    paths = expand(args.add)
+    for path in paths:
+      terminal = args.terminal or os.path.splitext(os.path.basename(path))[0]
+      with open(path, errors="replace") as f:
+        snapshot, count = store.add(terminal, f, args.run, os.path.getmtime(path), path, sins, args.dumpservice)
+      values += count
+    print("%d snapshot(s), %d value(s) stored in %.1f ms" % (len(paths), values, (time.time() - start) * 1000))
+  if args.list:
+    for snapshot, terminal, run, taken, source, count in store.snapshots():
+      print("%6d %-24s %-12s %s %5d %s" % (snapshot, terminal, run or "", time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(taken)), count, source or ""))
+  if args.diff:
+    first, second = store.resolve(args.diff[0]), store.resolve(args.diff[1])
+    names = store.names()
+    print("%s -> %s" % (store.describe(first), store.describe(second)))
+    for sin, pin, change, before, after in store.diff(first, second):
+      found += 1
+      print("%-8s %-40s %s -> %s" % (change, _label(sin, pin, names), "-" if before is None else before, "-" if after is None else after))
+  if args.defaults or args.check:
+    names = store.names()
+    snapshots = [store.resolve(args.defaults)] if args.defaults else store.latest()
+    for snapshot in snapshots:
+      flagged = list(store.against_catalog(snapshot, catalog, ranges_only=args.check and not args.defaults))
+      if flagged or args.defaults:
+        print(store.describe(snapshot))
+      for sin, pin, result, value, prop in flagged:
+        found += 1
+        print("%-8s %-40s %s (default %s, %s)" % (result, _label(sin, pin, names, prop), value,
+          prop.get("default", "-") if prop else "-", _range(prop)))
+  if args.diff or args.defaults or args.check:
+    print("%d difference(s)" % found)
+    sys.exit(1 if found else 0)
@@ -3,9 +3,13 @@
 -- @usage
 -- [-v]                     Verbose option
 -- [-t] [<string pattern>]  Execute test cases that match string pattern
+-- [-tl] [<name,name,...>]  Execute only the test cases of this list of exact names
 -- [-s] [<string pattern>]  Execute test suites that match string pattern
 -- [-p] [<port>]  Use specific gateway port
--- [-com] [<comport>]  Use specific com port for console communication
+-- [-com] [<comport>]  Use specific com port for console communication, tcp:<host>:<port> for a serialbridge.py port
+-- [-longpoll] [<seconds>]  Long-poll the gateway stand-in (Tools/Gateway) for return messages
+-- [-marktests]  Mark the start of every test in the traffic recording of the gateway stand-in (gateway.py --record)
+-- [-replay] [<speed>]  Run against a replayed recording (gateway.py --replay) with the Lua clock this many times faster, 0 skips sleeps
 
 for idx, val in ipairs(arg) do 
   print(idx, val) 
@@ -18,6 +22,18 @@ for idx, val in ipairs(arg) do
   if val == "-com" then
     ComPort = arg[idx+1]
   end
+
+  if val == "-longpoll" then
+    GatewayLongPoll = arg[idx+1]
+  end
+
+  if val == "-marktests" then
+    TrafficMarks = true
+  end
+
+  if val == "-replay" then
+    ReplaySpeed = tonumber(arg[idx+1])
+  end
 end
 ComPort = ComPort or "com"
 
@@ -28,6 +44,15 @@ require("Infrastructure/Annotations/Annotations")
 cfg, framework, gateway, lsf, device, gps = require "TestFramework"()
 lunatest = require "lunatest"
 
+-- Traffic recording and replay of the gateway stand-in
+if TrafficMarks or ReplaySpeed then
+  require("Infrastructure/Traffic/Traffic")
+  Traffic:markTests(lunatest, cfg.GATEWAY_URL)
+  if ReplaySpeed then
+    Traffic:replayClock(ReplaySpeed)
+  end
+end
+
 -- Global variables used in the tests
 GPS_PROCESS_TIME = 1                                                -- seconds
 GATEWAY_TIMEOUT = 60                                                -- in seconds
@@ -67,8 +92,14 @@ uniboxSW = UniboxServiceWrapper()
 InterfaceUnitHelpSW = InterfaceUnitHelpServiceWrapper()
 
 
-require("Serial/RealSerialWrapper")
-serialMain = RealSerialWrapper({name=ComPort, open=true, newline="\r\n"})
+-- "tcp:<host>:<port>" is the test end of a Tools/TestRunner/serialbridge.py virtual serial port
+if string.match(ComPort, "^tcp:") then
+  require("Serial/SocketSerialWrapper")
+  serialMain = SocketSerialWrapper({name=ComPort, open=true, newline="\r\n"})
+else
+  require("Serial/RealSerialWrapper")
+  serialMain = RealSerialWrapper({name=ComPort, open=true, newline="\r\n"})
+end
 
 -- Helm Panel
 helmPanelFactory = require("HelmPanelDevice/HelmPanelDeviceFactory")()
@@ -0,0 +1,102 @@
+require "Serial/SerialWrapper"
+local socket = require("socket")
+
+--- Serial port reached over TCP, name "tcp:<host>:<port>".
+-- The other end is Tools/TestRunner/serialbridge.py, which forwards the bytes
+-- to the simulator's RS232MainPort, so no COM port (or _ul_serial) is needed.
+SocketSerialWrapper = {}
+  SocketSerialWrapper.__index = SocketSerialWrapper
+  setmetatable(SocketSerialWrapper, {
+    __index = SerialWrapper, -- this is what makes the inheritance work
+    __call = function (cls, ...)
+    local self = setmetatable({}, cls)
+    self:_init(...)
+    return self
+    end,
+  })
+
+  local RECEIVE_SIZE = 65536
+  local SEND_TIMEOUT = 10 -- seconds
+
+  function SocketSerialWrapper:_init(args)
+    self.received = ""
+    SerialWrapper._init(self, args)
+  end
+
+  function SocketSerialWrapper:open(args)
+    SerialWrapper.open(self, args)
+    local host, port = string.match(self.args.name, "^tcp:([^:]+):(%d+)$")
+    if not host then
+      D:log("Serial port name should look like tcp:<host>:<port>: " .. self.args.name)
+      return nil
+    end
+    local client, err = socket.connect(host, tonumber(port))
+    if not client then
+      D:log("Serial bridge " .. self.args.name .. " not reachable: " .. tostring(err))
+      return nil
+    end
+    client:setoption("tcp-nodelay", true)
+    client:settimeout(0)
+    self.port = client
+    self.closed = false
+    return self.port
+  end
+
+  function SocketSerialWrapper:close()
+    if self.port then
+      self.port:close()
+      self.port = nil
+      return true
+    else
+      return nil
+    end
+  end
+
+  function SocketSerialWrapper:getPorts()
+    return {self.args.name}
+  end
+
+  function SocketSerialWrapper:write(data)
+    -- a slow reader may not take everything at once, unlike a serial port the socket has to wait for it
+    self.port:settimeout(SEND_TIMEOUT)
+    local last, err = self.port:send(data)
+    self.port:settimeout(0)
+    if not last then
+      D:log("Serial bridge write failed: " .. tostring(err))
+    end
+    return last
+  end
+
+  function SocketSerialWrapper:_receive()
+    while self.port and not self.closed do
+      local data, err, partial = self.port:receive(RECEIVE_SIZE)
+      data = data or partial
+      if data and #data > 0 then
+        self.received = self.received .. data
+      end
+      if err == "closed" then
+        D:log("Serial bridge closed the connection")
+        self.closed = true
+      end
+      if err then
+        break
+      end
+    end
+  end
+
+  function SocketSerialWrapper:read()
+    self:_receive()
+    local data = self.received
+    self.received = ""
+    return data
+  end
+
+  function SocketSerialWrapper:opened()
+    return self.port ~= nil and not self.closed
+  end
+
+  function SocketSerialWrapper:available()
+    if not self.port then return 0 end
+    self:_receive()
+    return #self.received
+  end
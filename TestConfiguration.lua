@@ -21,6 +21,8 @@
 -- @field PASSWORD 		Simulated gateway access password; don't change
 -- @field MOBILE_ID 	Simulated mobile ID; don't change
 -- @field GATEWAY_TIMEOUT Seconds framework waits for a particular message from gateway before timing out
+-- @field GATEWAY_LONG_POLL Seconds one return message request may be held by the gateway stand-in (Tools/Gateway)
+-- until a message arrives; nil polls every 3 seconds (the simulator gateway does not support long-poll)
 GatewayPort = GatewayPort or "8080"
 cfg = {
 	HTTP_PROXY 		= nil,                                  -- Uncomment if not snooping on traffic using Fiddler
@@ -33,6 +35,7 @@ cfg = {
 	ACCESS_ID 		= "00000000",
 	PASSWORD 		= "password",
 	MOBILE_ID 		= "00000000SKYEE3D",
-	GATEWAY_TIMEOUT = 12
+	GATEWAY_TIMEOUT = 12,
+	GATEWAY_LONG_POLL = tonumber(GatewayLongPoll)
 }
 return cfg
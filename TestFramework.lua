@@ -207,10 +207,11 @@ local function recordAndPrintMsg(msg)
 	elseif msg.SIN == 26 and msg.Payload.MIN == 1 and msg.Payload.success=="False" then
 		print("Invalid shell command: " .. tf.dump(msg))
 	else
+		-- ID and MessageUTC first: Tools/OutputParser/received.py builds report time series from these lines
 		if tf.trace2 == doNothing then
-			tf.trace1("Received: " ..  oneLineDump(msg.Payload))
+			tf.trace1("Received: ID=%s MessageUTC=%s%s", tostring(msg.ID), tostring(msg.MessageUTC), oneLineDump(msg.Payload))
 		else
-			tf.trace2("Received: " .. tf.dump(msg.Payload))
+			tf.trace2("Received: ID=%s MessageUTC=%s %s", tostring(msg.ID), tostring(msg.MessageUTC), tf.dump(msg.Payload))
 		end
 	end
 	gateway.returnMsgList[#gateway.returnMsgList+1] = brief
@@ -275,7 +276,8 @@ local function ISOToEpoch(s)
 	return os.time({ year = year, month = month, day = day, hour = hour, min = min, sec = sec })
 end
 
-local function getReturnMessages()
+-- longPoll: seconds the gateway stand-in may hold the request until a message arrives
+local function getReturnMessages(longPoll)
 	firstCallHouseKeeping()
 	local encoded = json.encode(msgs)
 	local source = ltn12.source.string(encoded);
@@ -288,7 +290,8 @@ local function getReturnMessages()
 	local params = {
 		["access_id"] = cfg.ACCESS_ID,
 		["password"] = cfg.PASSWORD,
-		["start_utc"] = startTime
+		["start_utc"] = startTime,
+		["long_poll"] = longPoll
 	}
 	local url = cfg.GATEWAY_URL .. cfg.GATEWAY_SUFFIX .. "/get_return_messages.json/?" .. encode(params)
 	ok, code, headers = http.request {
@@ -680,7 +683,11 @@ function gateway.getReturnMessage(checkFunction, checkParam, timeout)
 	time1 = os.time()
 	timeout = timeout and timeout or cfg.GATEWAY_TIMEOUT
 	while(true) do
-		local msgs = getReturnMessages()
+		local longPoll = nil
+		if cfg.GATEWAY_LONG_POLL then
+			longPoll = math.max(1, math.min(cfg.GATEWAY_LONG_POLL, timeout - (os.time() - time1)))
+		end
+		local msgs = getReturnMessages(longPoll)
 		if msgs then
 			for i, msg in ipairs(msgs) do
 				colmsg = tf.collapseMessage(msg)
@@ -695,7 +702,9 @@ function gateway.getReturnMessage(checkFunction, checkParam, timeout)
 			checkFunction(nil, checkParam)
 			break;
 		end
-		tf.delay(3)
+		if not longPoll then
+			tf.delay(3)
+		end
 	end
 	return nil
 end
@@ -1176,6 +1185,60 @@ function gps.set(parameters)
 	end
 end
 
+--- Uploads a whole track to the GPS stand-in (Tools/Gateway), which replays it on its own clock.
+-- Every point is a gps.set parameter table with an additional <code>time</code>, in seconds from the upload.
+-- Only the GPS stand-in knows this resource; the modem simulator's own GpsWebService answers with an HTTP error.
+-- @tparam table points list of points in time order
+-- @tparam ?bool loop start over after the last point until gps.stopTrack is called
+-- @return the decoded answer (Points, Duration) or false and the HTTP code when track upload is not available
+-- @usage
+-- gps.uploadTrack({{time=0, latitude=45.5, longitude=-73.5, speed=50, heading=90}, {time=30, heading=180}})
+-- @within gps
+function gps.uploadTrack(points, loop)
+	local encoded = json.encode({ Points = points, Loop = loop == true })
+	local source = ltn12.source.string(encoded)
+	local response = {}
+	local sink = ltn12.sink.table(response)
+	local headers = {
+		["Content-Type"] = "application/json",
+		["content-length"] = #encoded
+	}
+	local ok, code
+	ok, code, headers = http.request {
+		url = cfg.GPS_URL .. "/upload_track.json/",
+		proxy = cfg.HTTP_PROXY,
+		method = "POST", headers = headers, source = source, sink = sink
+	}
+	if not (ok and code == 200) then
+		return false, code
+	end
+	local decoded = json.decode(table.concat(response))
+	if decoded.ErrorID ~= 0 then
+		error("GPS track not uploaded: " .. tostring(decoded.Error))
+	end
+	-- later gps.set calls continue from where the track ends
+	for _, point in ipairs(points) do
+		for k, v in pairs(point) do
+			if gpsKeys[k] then
+				gpsValues[k] = v
+			end
+		end
+	end
+	return decoded
+end
+
+--- Returns the replay progress of the uploaded track (Running, Points, Sent, Rounds, Elapsed, MaxLag, UpstreamErrors).
+-- @within gps
+function gps.trackStatus()
+	return webServiceGetResource(cfg.GPS_URL, "track_status")
+end
+
+--- Stops the replay of the uploaded track; the GPS keeps the values of the last point sent.
+-- @within gps
+function gps.stopTrack()
+	return webServiceGetResource(cfg.GPS_URL, "stop_track")
+end
+
 print("Test Framework v" .. tf.version)
 if debugLevel == 2 then
 	tf.trace1 = printfLineDate
@@ -0,0 +1,434 @@
+"""Local stand-in for the message gateway used by the Lua tests.
+
+Serves the gateway resources used by TestFramework.lua under
+/GLGW/GWServices_v1/RestMessages.svc with the same JSON shapes:
+
+	info_utc_time.json         current gateway time
+	info_version.json          version string
+	submit_messages.json       POST of forward messages
+	get_return_messages.json   return messages received at or after start_utc
+
+get_return_messages.json also accepts long_poll=<seconds> (and optionally
+sin/min): when nothing new (or nothing matching) has arrived yet, the call is
+held until a message arrives or the time is up, instead of the client polling
+every few seconds. --submitlimit makes submit_messages answer 503 above a
+rate, like a busy gateway.
+
+With --upstream the stand-in fronts the gateway of a modem simulator: forward
+messages are relayed to it, its return messages are fetched in the background
+every --poll seconds, and every other path (DeviceWebService, ...) is proxied
+as is. /GpsWebService is answered by the GPS stand-in of gpsservice.py, which
+adds trajectory upload and forwards the per-call resources to the upstream. Without --upstream it runs on its own and terminals (or
+a terminal adapter) exchange messages through
+	POST /Mobile/return_messages.json   {"Messages": [{"SIN": .., "Payload": {..}}, ..]}
+	GET  /Mobile/forward_messages.json  forward messages not fetched yet, accepts long_poll too
+
+--record appends every exchange to a traffic file, --replay answers from one
+instead of a simulator (see traffic.py). /Replay/mark.json?name=.. marks the
+start of a test in either, /Replay/status.json tells what is recorded or replayed.
+"""
+import argparse
+import asyncio
+import bisect
+import calendar
+import json
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from gpsservice import GPS_PREFIX, GpsStandIn
+from traffic import REPLAY_PREFIX, TrafficRecorder, TrafficReplay
+
+GATEWAY_SUFFIX = "/GLGW/GWServices_v1/RestMessages.svc"
+MOBILE_PREFIX = "/Mobile"
+UTC_FORMAT = "%Y-%m-%d %H:%M:%S"
+VERSION = "Gateway stand-in 1.0"
+# any non-zero ErrorID makes the Lua client fail the call
+ERROR_NONE = 0
+ERROR_ACCESS_DENIED = 1
+ERROR_BAD_REQUEST = 2
+MAX_REQUEST_BYTES = 16 * 1024 * 1024
+# return messages per get_return_messages answer, the rest is announced with More
+MAX_RETURN_MESSAGES = 500
+STATUS_TEXT = {200 : "OK", 400 : "Bad Request", 404 : "Not Found", 502 : "Bad Gateway", 503 : "Service Unavailable"}
+
+
+def format_utc(seconds):
+	return time.strftime(UTC_FORMAT, time.gmtime(seconds))
+
+
+def parse_utc(text):
+	return calendar.timegm(time.strptime(text, UTC_FORMAT))
+
+
+class MessageStore():
+	"""Return and forward messages with NextStartUTC high-water-mark bookkeeping.
+
+	ReceiveUTC has a one second resolution, so a message is never stamped earlier
+	than a NextStartUTC already handed out; that way a client moving its
+	start_utc to NextStartUTC neither misses nor gets a message twice.
+	"""
+	def __init__(self, mobile_id):
+		self.mobile_id = mobile_id
+		self.returned = []            # return messages in receive order
+		self.received = []            # receive second of every return message, never decreasing
+		self.forward = []
+		self.forward_fetched = 0
+		self.next_return_id = 1
+		self.next_forward_id = 1
+		self.issued = 0               # latest NextStartUTC handed out, in seconds
+		self.changed = None           # asyncio.Condition, made by GatewayStandIn.serve() in the running loop
+
+	async def add_return(self, message):
+		second = max(int(time.time()), self.issued)
+		stored = {
+			"ID" : self.next_return_id,
+			"MessageUTC" : message.get("MessageUTC") or format_utc(second),
+			"ReceiveUTC" : format_utc(second),
+			"SIN" : message.get("SIN", (message.get("Payload") or {}).get("SIN")),
+			"MobileID" : message.get("MobileID") or self.mobile_id,
+			"RegionName" : message.get("RegionName", ""),
+			"OTAMessageSize" : message.get("OTAMessageSize", 0),
+		}
+		for key in ("Payload", "RawPayload"):
+			if key in message:
+				stored[key] = message[key]
+		self.next_return_id += 1
+		self.returned.append(stored)
+		self.received.append(second)
+		async with self.changed:
+			self.changed.notify_all()
+		return stored
+
+	async def add_forward(self, message):
+		stored = dict(message)
+		stored["ForwardMessageID"] = self.next_forward_id
+		stored["StateUTC"] = format_utc(time.time())
+		self.next_forward_id += 1
+		self.forward.append(stored)
+		async with self.changed:
+			self.changed.notify_all()
+		return stored
+
+	def returned_since(self, start):
+		return self.returned[bisect.bisect_left(self.received, start):]
+
+	def page(self, start):
+		"""Return messages since start for one answer and whether more are waiting.
+
+		A page ends on a second boundary, as the next call starts at a whole second.
+		"""
+		first = bisect.bisect_left(self.received, start)
+		last = len(self.returned)
+		if last - first <= MAX_RETURN_MESSAGES:
+			return self.returned[first:], False
+		boundary = bisect.bisect_left(self.received, self.received[first + MAX_RETURN_MESSAGES])
+		if boundary == first:
+			# more than a page in a single second, all of it has to go at once
+			boundary = bisect.bisect_right(self.received, self.received[first])
+		return self.returned[first:boundary], boundary < last
+
+	async def wait_for(self, select, timeout):
+		"""Returns select() as soon as it is not empty or when timeout seconds have passed."""
+		deadline = time.time() + (timeout or 0)
+		found = select()
+		while not found and time.time() < deadline:
+			async with self.changed:
+				try:
+					await asyncio.wait_for(self.changed.wait(), deadline - time.time())
+				except asyncio.TimeoutError:
+					pass
+			found = select()
+		return found
+
+	def next_start(self, messages):
+		if not messages:
+			return ""
+		self.issued = max(self.issued, max(parse_utc(message["ReceiveUTC"]) for message in messages) + 1)
+		return format_utc(self.issued)
+
+
+def _matches(message, sin, min_):
+	payload = message.get("Payload") or {}
+	if sin is not None and str(message.get("SIN")) != sin:
+		return False
+	if min_ is not None and str(payload.get("MIN")) != min_:
+		return False
+	return True
+
+
+class GatewayStandIn():
+	def __init__(self, port, upstream=None, poll=0.25, access_id="00000000", password="password",
+			mobile_id="00000000SKYEE3D", max_long_poll=60, submit_limit=0, record=None, replay=None, speed=0):
+		self.port = port
+		self.upstream = upstream.rstrip("/") if upstream else None
+		self.poll = poll
+		self.access_id = access_id
+		self.password = password
+		self.max_long_poll = max_long_poll
+		self.store = MessageStore(mobile_id)
+		self.upstream_seen = set()
+		# token bucket of forward messages per second, beyond it submissions get 503 like a busy gateway
+		self.submit_limit = submit_limit
+		self.submit_tokens = float(submit_limit)
+		self.submit_checked = time.time()
+		self.gps = GpsStandIn(self.upstream + GPS_PREFIX if self.upstream else None)
+		self.recorder = TrafficRecorder(record) if record else None
+		self.replay = TrafficReplay(replay, speed) if replay else None
+
+	# ---- HTTP plumbing ----
+
+	async def _handle(self, reader, writer):
+		try:
+			# HTTP/1.1 connections are kept open unless the client asks otherwise (LuaSocket always does)
+			keep_alive = True
+			while keep_alive:
+				request_line = (await reader.readline()).decode("latin-1").split()
+				if len(request_line) < 2:
+					return
+				method, target = request_line[0].upper(), request_line[1]
+				headers = {}
+				while True:
+					line = (await reader.readline()).decode("latin-1")
+					if line in ("\r\n", "\n", ""):
+						break
+					key, _, value = line.partition(":")
+					headers[key.strip().lower()] = value.strip()
+				keep_alive = request_line[2:] == ["HTTP/1.1"] and "close" not in headers.get("connection", "").lower()
+				length = min(int(headers.get("content-length", 0) or 0), MAX_REQUEST_BYTES)
+				body = await reader.readexactly(length) if length else b""
+				start = time.time()
+				status, content_type, content = await self.route(method, target, headers, body)
+				if self.recorder and not target.startswith(REPLAY_PREFIX + "/"):
+					self.recorder.record(start, time.time() - start, method, target, body, status, content_type, content)
+				head = "HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: %s\r\n\r\n" % (
+					status, STATUS_TEXT.get(status, "Status"), content_type, len(content), "keep-alive" if keep_alive else "close")
+				writer.write(head.encode("latin-1") + content)
+				await writer.drain()
+		except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+			pass
+		finally:
+			writer.close()
+
+	def _json(self, value, status=200):
+		return status, "application/json; charset=utf-8", json.dumps(value).encode("utf-8")
+
+	async def route(self, method, target, headers, body):
+		url = urllib.parse.urlsplit(target)
+		path = url.path.rstrip("/")
+		params = dict(urllib.parse.parse_qsl(url.query))
+		if path.startswith(REPLAY_PREFIX + "/"):
+			return self.traffic(path[len(REPLAY_PREFIX) + 1:], params)
+		if self.replay:
+			return await self.replay.route(method, target, body)
+		if path.startswith(GATEWAY_SUFFIX + "/"):
+			resource = path[len(GATEWAY_SUFFIX) + 1:]
+			if resource == "info_utc_time.json":
+				return self._json(format_utc(time.time()))
+			if resource == "get_return_messages.json":
+				return self._json(await self.get_return_messages(params))
+			if resource == "submit_messages.json" and method == "POST" and not self.upstream:
+				if not self._take_submit_token():
+					return 503, "text/plain", b"Gateway busy"
+				return self._json(await self.submit_messages(body))
+			if resource == "info_version.json" and not self.upstream:
+				return self._json(VERSION)
+		elif path.startswith(GPS_PREFIX + "/"):
+			answer = await self.gps.route(method, path[len(GPS_PREFIX) + 1:], params, body)
+			if answer is not None:
+				return answer
+		elif path.startswith(MOBILE_PREFIX + "/") and not self.upstream:
+			resource = path[len(MOBILE_PREFIX) + 1:]
+			if resource == "return_messages.json" and method == "POST":
+				return self._json(await self.mobile_return_messages(body))
+			if resource == "forward_messages.json":
+				return self._json(await self.mobile_forward_messages(params))
+		if self.upstream:
+			return await self.proxy(method, target, headers, body)
+		return self._json({"ErrorID" : ERROR_BAD_REQUEST}, 404)
+
+	async def proxy(self, method, target, headers, body):
+		def request():
+			forwarded = dict((key, value) for key, value in headers.items() if key in ("content-type", "accept"))
+			upstream_request = urllib.request.Request(self.upstream + target, data=body if method == "POST" else None,
+				headers=forwarded, method=method)
+			try:
+				with urllib.request.urlopen(upstream_request, timeout=60) as response:
+					return response.status, response.headers.get("Content-Type", "application/json"), response.read()
+			except urllib.error.HTTPError as e:
+				return e.code, e.headers.get("Content-Type", "text/plain"), e.read()
+			except (urllib.error.URLError, OSError) as e:
+				return 502, "text/plain", str(e).encode("utf-8")
+		return await asyncio.get_running_loop().run_in_executor(None, request)
+
+	# ---- traffic recording and replay ----
+
+	def traffic(self, resource, params):
+		if resource == "mark.json":
+			name = params.get("name", "")
+			if self.recorder:
+				self.recorder.mark(name)
+			found = self.replay.set_mark(name) if self.replay else True
+			return self._json({"ErrorID" : ERROR_NONE if found else ERROR_BAD_REQUEST})
+		if resource == "status.json":
+			status = {"ErrorID" : ERROR_NONE}
+			if self.recorder:
+				status.update({"Recording" : self.recorder.path, "Exchanges" : self.recorder.exchanges})
+			if self.replay:
+				status.update(self.replay.status())
+			return self._json(status)
+		return self._json({"ErrorID" : ERROR_BAD_REQUEST}, 404)
+
+	# ---- gateway resources ----
+
+	def _take_submit_token(self):
+		if not self.submit_limit:
+			return True
+		now = time.time()
+		self.submit_tokens = min(float(self.submit_limit), self.submit_tokens + (now - self.submit_checked) * self.submit_limit)
+		self.submit_checked = now
+		if self.submit_tokens < 1:
+			return False
+		self.submit_tokens -= 1
+		return True
+
+	def _authorized(self, access_id, password):
+		return access_id == self.access_id and password == self.password
+
+	async def get_return_messages(self, params):
+		if not self._authorized(params.get("access_id"), params.get("password")):
+			return {"ErrorID" : ERROR_ACCESS_DENIED, "Messages" : [], "More" : False, "NextStartUTC" : ""}
+		try:
+			start = parse_utc(params.get("start_utc", ""))
+			long_poll = min(float(params.get("long_poll", 0)), self.max_long_poll)
+		except ValueError:
+			return {"ErrorID" : ERROR_BAD_REQUEST, "Messages" : [], "More" : False, "NextStartUTC" : ""}
+		sin, min_ = params.get("sin"), params.get("min")
+		def select():
+			messages = self.store.returned_since(start)
+			if sin is None and min_ is None:
+				return messages
+			# with a filter the call is held until a matching message is there, but returns everything new
+			return messages if any(_matches(message, sin, min_) for message in messages) else []
+		await self.store.wait_for(select, long_poll)
+		messages, more = self.store.page(start)
+		return {
+			"ErrorID" : ERROR_NONE,
+			"Messages" : messages,
+			"More" : more,
+			"NextStartUTC" : self.store.next_start(messages),
+		}
+
+	async def submit_messages(self, body):
+		try:
+			request = json.loads(body.decode("utf-8"))
+		except ValueError:
+			return {"SubmitForwardMessages_JResult" : {"ErrorID" : ERROR_BAD_REQUEST, "Submissions" : []}}
+		if not self._authorized(request.get("accessID"), request.get("password")):
+			return {"SubmitForwardMessages_JResult" : {"ErrorID" : ERROR_ACCESS_DENIED, "Submissions" : []}}
+		submissions = []
+		for message in request.get("messages") or []:
+			stored = await self.store.add_forward(message)
+			submissions.append({
+				"ErrorID" : ERROR_NONE,
+				"ForwardMessageID" : stored["ForwardMessageID"],
+				"UserMessageID" : message.get("UserMessageID", 0),
+				"DestinationID" : message.get("DestinationID", self.store.mobile_id),
+				"StateUTC" : stored["StateUTC"],
+				"OTAMessageSize" : 0,
+			})
+		return {"SubmitForwardMessages_JResult" : {"ErrorID" : ERROR_NONE, "Submissions" : submissions}}
+
+	# ---- terminal side without upstream ----
+
+	async def mobile_return_messages(self, body):
+		try:
+			request = json.loads(body.decode("utf-8"))
+		except ValueError:
+			return {"ErrorID" : ERROR_BAD_REQUEST}
+		ids = []
+		for message in request.get("Messages") or []:
+			ids.append((await self.store.add_return(message))["ID"])
+		return {"ErrorID" : ERROR_NONE, "IDs" : ids}
+
+	async def mobile_forward_messages(self, params):
+		try:
+			long_poll = min(float(params.get("long_poll", 0)), self.max_long_poll)
+		except ValueError:
+			return {"ErrorID" : ERROR_BAD_REQUEST, "Messages" : []}
+		messages = await self.store.wait_for(lambda: self.store.forward[self.store.forward_fetched:], long_poll)
+		self.store.forward_fetched += len(messages)
+		return {"ErrorID" : ERROR_NONE, "Messages" : messages}
+
+	# ---- upstream relay ----
+
+	def _upstream_get(self, resource, params=None):
+		url = self.upstream + GATEWAY_SUFFIX + "/" + resource + "/"
+		if params:
+			url += "?" + urllib.parse.urlencode(params)
+		with urllib.request.urlopen(url, timeout=30) as response:
+			return json.loads(response.read().decode("utf-8"))
+
+	async def relay_return_messages(self):
+		"""Fetches upstream return messages every poll seconds and stores the new ones."""
+		loop = asyncio.get_running_loop()
+		start_utc = None
+		while True:
+			try:
+				if start_utc is None:
+					start_utc = await loop.run_in_executor(None, self._upstream_get, "info_utc_time.json")
+				result = await loop.run_in_executor(None, self._upstream_get, "get_return_messages.json",
+					{"access_id" : self.access_id, "password" : self.password, "start_utc" : start_utc})
+				if result.get("ErrorID") == ERROR_NONE:
+					for message in result.get("Messages") or []:
+						key = (message.get("ID"), message.get("MessageUTC"))
+						if key in self.upstream_seen:
+							continue
+						self.upstream_seen.add(key)
+						await self.store.add_return(message)
+					start_utc = result.get("NextStartUTC") or start_utc
+					if result.get("More"):
+						continue
+			except (urllib.error.URLError, OSError, ValueError):
+				# the simulator is still starting or restarting
+				pass
+			await asyncio.sleep(self.poll)
+
+	async def serve(self):
+		# made here rather than in __init__: before Python 3.10 they bind the loop current when made, not the one asyncio.run() starts
+		self.store.changed = asyncio.Condition()
+		self.gps.lock = asyncio.Lock()
+		server = await asyncio.start_server(self._handle, "localhost", self.port)
+		tasks = [asyncio.ensure_future(server.serve_forever())]
+		if self.upstream:
+			tasks.append(asyncio.ensure_future(self.relay_return_messages()))
+		print("Gateway stand-in listening on port %d%s%s%s" % (self.port, ", upstream " + self.upstream if self.upstream else "",
+			", recording to " + self.recorder.path if self.recorder else "",
+			", replaying %d exchange(s) of %s" % (self.replay.exchanges, self.replay.path) if self.replay else ""), flush=True)
+		await asyncio.gather(*tasks)
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Serves the gateway web resources used by the Lua tests.")
+	parser.add_argument("--port", type=int, default=8080, help="Port to listen on (the Lua -p port)")
+	parser.add_argument("--upstream", help="Modem simulator base URL to relay to, e.g. http://localhost:9010")
+	parser.add_argument("--poll", type=float, default=0.25, help="Seconds between upstream return message polls")
+	parser.add_argument("--maxlongpoll", type=float, default=60, help="Longest long_poll a client may ask for, in seconds")
+	parser.add_argument("--accessid", default="00000000")
+	parser.add_argument("--password", default="password")
+	parser.add_argument("--mobileid", default="00000000SKYEE3D")
+	parser.add_argument("--submitlimit", type=float, default=0, help="Forward message submissions per second before answering 503, 0 for no limit")
+	parser.add_argument("--record", help="Appends every request and its answer to this traffic file (traffic.py)")
+	parser.add_argument("--replay", help="Answers from a traffic file recorded with --record instead of a simulator")
+	parser.add_argument("--speed", type=float, default=0, help="With --replay answers take their recorded time divided by this, 0 answers at once")
+	args = parser.parse_args()
+	if args.replay and (args.upstream or args.record):
+		parser.error("--replay answers from the recording, --upstream and --record can not be given")
+
+	gateway = GatewayStandIn(args.port, args.upstream, args.poll, args.accessid, args.password, args.mobileid, args.maxlongpoll,
+		args.submitlimit, args.record, args.replay, args.speed)
+	try:
+		asyncio.run(gateway.serve())
+	except KeyboardInterrupt:
+		pass
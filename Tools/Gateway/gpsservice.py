@@ -0,0 +1,269 @@
+"""GpsWebService stand-in with trajectory upload, served by the gateway stand-in.
+
+The per-call resources used by gps.set in TestFramework.lua are kept:
+
+	set_fix_type.json        fix_type
+	set_location.json        latitude, longitude, altitude
+	set_speed_heading.json   speed, heading, simulate_linear_motion
+	set_jamming.json         jammingStatus, jammingLevel, jammingDetect, antennaCutDetect
+	set_blockage.json        blocked
+
+and a whole track can be handed over at once:
+
+	POST upload_track.json   {"Points": [{"time": 0, "latitude": .., "speed": ..}, ..], "Loop": false}
+	GET  track_status.json   replay progress
+	GET  stop_track.json     stops the replay
+	GET  state.json          current GPS settings, with linear motion applied
+
+Points use the gps.set parameter names plus "time", seconds from the upload.
+They are replayed on the stand-in's own clock; every point only sends the
+resources whose values changed. With an upstream (the modem simulator's
+GpsWebService) every change is forwarded to it, so the terminal sees the
+track while the test does a single request.
+"""
+import asyncio
+import json
+import math
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+GPS_PREFIX = "/GpsWebService"
+EARTH_RADIUS_M = 6378000.0
+
+# resource -> (query parameter, gps.set name, type), in the order gps.set would send them
+RESOURCES = (
+	("set_fix_type", (("fix_type", "fixType", int),)),
+	("set_location", (("latitude", "latitude", float), ("longitude", "longitude", float), ("altitude", "altitude", float))),
+	("set_speed_heading", (("speed", "speed", float), ("heading", "heading", float), ("simulate_linear_motion", "simulateLinearMotion", bool))),
+	("set_jamming", (("jammingStatus", "jammingStatus", int), ("jammingLevel", "jammingLevel", int),
+		("jammingDetect", "jammingDetect", bool), ("antennaCutDetect", "antennaCutDetect", bool))),
+	("set_blockage", (("blocked", "blockage", bool),)),
+)
+
+# same defaults as gpsValues in TestFramework.lua
+DEFAULTS = {
+	"latitude" : 0.0,
+	"longitude" : 0.0,
+	"altitude" : 0.0,
+	"speed" : 0.0,
+	"heading" : 0.0,
+	"simulateLinearMotion" : False,
+	"fixType" : 3,
+	"jammingStatus" : 1,
+	"jammingLevel" : 0,
+	"jammingDetect" : False,
+	"antennaCutDetect" : False,
+	"blockage" : False,
+}
+
+ERROR_NONE = 0
+ERROR_BAD_REQUEST = 2
+
+
+def _from_param(text, kind):
+	if kind is bool:
+		if text not in ("true", "false"):
+			raise ValueError("Expected true or false: " + text)
+		return text == "true"
+	return kind(float(text)) if kind is int else kind(text)
+
+
+def _to_param(value):
+	"""Formats like Lua's tostring, which is what the simulator gets from gps.set."""
+	if isinstance(value, bool):
+		return "true" if value else "false"
+	if isinstance(value, float) and value.is_integer():
+		return str(int(value))
+	return str(value)
+
+
+def resource_params(state, names=None):
+	"""(resource, query parameters) for every resource holding one of names, all of them when names is None."""
+	for resource, params in RESOURCES:
+		if names is None or any(name in names for param, name, kind in params):
+			yield resource, dict((param, _to_param(state[name])) for param, name, kind in params)
+
+
+def _json(value, status=200):
+	return status, "application/json; charset=utf-8", json.dumps(value).encode("utf-8")
+
+
+def move(latitude, longitude, speed, heading, seconds):
+	"""Position after seconds at speed (km/h) along heading (degrees), on a sphere."""
+	distance = speed / 3.6 * seconds / EARTH_RADIUS_M
+	if not distance:
+		return latitude, longitude
+	lat, lon, bearing = math.radians(latitude), math.radians(longitude), math.radians(heading)
+	lat2 = math.asin(math.sin(lat) * math.cos(distance) + math.cos(lat) * math.sin(distance) * math.cos(bearing))
+	lon2 = lon + math.atan2(math.sin(bearing) * math.sin(distance) * math.cos(lat), math.cos(distance) - math.sin(lat) * math.sin(lat2))
+	return math.degrees(lat2), (math.degrees(lon2) + 540) % 360 - 180
+
+
+def parse_track(body):
+	"""Validated, time ordered points and the loop flag of an upload_track.json body."""
+	request = json.loads(body.decode("utf-8"))
+	points = request.get("Points") if isinstance(request, dict) else None
+	if not isinstance(points, list) or not points:
+		raise ValueError("Points should be a non-empty list")
+	kinds = dict((name, kind) for resource, params in RESOURCES for param, name, kind in params)
+	track = []
+	for number, point in enumerate(points):
+		if not isinstance(point, dict) or not isinstance(point.get("time"), (int, float)) or point["time"] < 0:
+			raise ValueError("Point %d needs a time in seconds from the upload" % number)
+		values = {}
+		for name, value in point.items():
+			if name == "time":
+				continue
+			kind = kinds.get(name)
+			if kind is None:
+				raise ValueError("Unknown parameter in point %d: %s" % (number, name))
+			if kind is bool and not isinstance(value, bool) or kind is not bool and (isinstance(value, bool) or not isinstance(value, (int, float))):
+				raise ValueError("Bad %s in point %d: %r" % (name, number, value))
+			values[name] = kind(value)
+		track.append((float(point["time"]), values))
+	# stable, so points with the same time keep their order
+	track.sort(key=lambda point: point[0])
+	loop = bool(request.get("Loop"))
+	if loop and track_period(track) <= 0:
+		raise ValueError("A looped track needs points at different times")
+	return track, loop
+
+
+def track_period(track):
+	"""Seconds after which a looped track starts over: one point interval after its last point, or a second for a single point."""
+	return track[-1][0] + (track[-1][0] - track[-2][0] if len(track) > 1 else 1.0)
+
+
+class GpsStandIn():
+	def __init__(self, upstream=None):
+		self.upstream = upstream.rstrip("/") if upstream else None
+		self.state = dict(DEFAULTS)
+		# when latitude/longitude were last set, linear motion starts from there
+		self.moved_at = time.time()
+		self.replay = None
+		self.track = []
+		self.loop = False
+		self.track_started = None
+		self.track_index = 0
+		self.track_rounds = 0
+		self.max_lag = 0.0
+		self.upstream_errors = 0
+		# asyncio.Lock, made by GatewayStandIn.serve() in the running loop
+		self.lock = None
+
+	def current(self):
+		state = dict(self.state)
+		if state["simulateLinearMotion"]:
+			state["latitude"], state["longitude"] = move(state["latitude"], state["longitude"], state["speed"], state["heading"],
+				time.time() - self.moved_at)
+		return state
+
+	async def apply(self, values):
+		"""Sets gps.set style values and sends the resources they belong to, like gps.set does."""
+		async with self.lock:
+			if self.state["simulateLinearMotion"] and "latitude" not in values and "longitude" not in values:
+				# keep the position reached so far when speed or heading change
+				current = self.current()
+				self.state["latitude"], self.state["longitude"] = current["latitude"], current["longitude"]
+				self.moved_at = time.time()
+			if "latitude" in values or "longitude" in values:
+				self.moved_at = time.time()
+			self.state.update(values)
+			answer = None
+			for resource, params in resource_params(self.state, values):
+				answer = await self._send(resource, params)
+			return answer
+
+	async def _send(self, resource, params):
+		if not self.upstream:
+			return _json({"ErrorID" : ERROR_NONE})
+		def request():
+			url = "%s/%s.json/?%s" % (self.upstream, resource, urllib.parse.urlencode(params))
+			try:
+				with urllib.request.urlopen(url, timeout=30) as response:
+					return response.status, response.headers.get("Content-Type", "application/json"), response.read()
+			except urllib.error.HTTPError as e:
+				return e.code, e.headers.get("Content-Type", "text/plain"), e.read()
+			except (urllib.error.URLError, OSError) as e:
+				return 502, "text/plain", str(e).encode("utf-8")
+		answer = await asyncio.get_running_loop().run_in_executor(None, request)
+		if answer[0] != 200:
+			self.upstream_errors += 1
+		return answer
+
+	async def route(self, method, resource, params, body):
+		"""Answers a GpsWebService resource, None for ones it does not know (they go to the upstream as is)."""
+		name = resource[:-len(".json")] if resource.endswith(".json") else resource
+		for known, fields in RESOURCES:
+			if name == known:
+				try:
+					values = dict((key, _from_param(params[param], kind)) for param, key, kind in fields if param in params)
+				except ValueError as e:
+					return 400, "text/plain", str(e).encode("utf-8")
+				return (await self.apply(values)) or _json({"ErrorID" : ERROR_NONE})
+		if name == "upload_track" and method == "POST":
+			try:
+				track, loop = parse_track(body)
+			except ValueError as e:
+				return _json({"ErrorID" : ERROR_BAD_REQUEST, "Error" : str(e)})
+			self.start_track(track, loop)
+			return _json({"ErrorID" : ERROR_NONE, "Points" : len(track), "Duration" : track[-1][0]})
+		if name == "track_status":
+			return _json(self.status())
+		if name == "stop_track":
+			self.stop_track()
+			return _json(self.status())
+		if name == "state":
+			return _json(self.current())
+		return None
+
+	# ---- track replay ----
+
+	def start_track(self, track, loop):
+		self.stop_track()
+		self.track, self.loop = track, loop
+		self.track_index = self.track_rounds = 0
+		self.max_lag = 0.0
+		self.upstream_errors = 0
+		self.track_started = time.time()
+		self.replay = asyncio.ensure_future(self._replay())
+
+	def stop_track(self):
+		if self.replay is not None and not self.replay.done():
+			self.replay.cancel()
+		self.replay = None
+
+	def status(self):
+		return {
+			"ErrorID" : ERROR_NONE,
+			"Running" : self.replay is not None and not self.replay.done(),
+			"Points" : len(self.track),
+			"Sent" : self.track_index,
+			"Rounds" : self.track_rounds,
+			"Elapsed" : time.time() - self.track_started if self.track_started else 0,
+			"MaxLag" : self.max_lag,
+			"UpstreamErrors" : self.upstream_errors,
+		}
+
+	async def _replay(self):
+		period = track_period(self.track)
+		start = time.time()
+		while True:
+			for self.track_index, (offset, values) in enumerate(self.track):
+				wait = start + offset - time.time()
+				if wait > 0:
+					await asyncio.sleep(wait)
+				else:
+					# the upstream is slower than the track, the rest of it is shifted rather than rushed
+					self.max_lag = max(self.max_lag, -wait)
+					start -= wait
+				await self.apply(values)
+			self.track_index = len(self.track)
+			self.track_rounds += 1
+			if not self.loop:
+				return
+			start += period
+			# without an upstream a round may not wait at all, the gateway has to get its turn
+			await asyncio.sleep(0)
@@ -0,0 +1,317 @@
+"""Load generator for the gateway API, simulating many terminals at once.
+
+Every simulated terminal (MobileID) submits forward messages through
+submit_messages.json at --rate per second, retrying 503 answers with backoff
+the way TestFramework.lua does, and sends return messages through the
+stand-in's /Mobile/return_messages.json. --pollers applications poll
+get_return_messages.json, moving start_utc to NextStartUTC, and measure how
+long a return message takes to become visible (high-water-mark lag).
+
+All requests go through a pool of keep-alive connections. Run it against
+Tools/Gateway/gateway.py, or let --standin start one:
+
+	python loadgen.py --standin --terminals 500 --rate 0.5 --duration 60
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import urllib.parse
+
+from gateway import GATEWAY_SUFFIX, MOBILE_PREFIX
+
+STAND_IN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gateway.py")
+LOAD_SIN = 128
+
+
+def percentile(values, fraction):
+	"""Nearest rank percentile of sorted values."""
+	if not values:
+		return None
+	rank = max(int(round(fraction * len(values) + 0.5)) - 1, 0)
+	return values[min(rank, len(values) - 1)]
+
+
+class HttpPool():
+	"""Keep-alive HTTP/1.1 connections to one host, at most size of them open."""
+	def __init__(self, host, port, size):
+		self.host = host
+		self.port = port
+		self.idle = []
+		self.size = size
+		self.slots = None
+
+	async def request(self, method, path, body=None, timeout=90):
+		"""Returns (status, body bytes)."""
+		if self.slots is None:
+			# made in the running loop, before Python 3.10 a semaphore binds the loop current when it is made
+			self.slots = asyncio.Semaphore(self.size)
+		async with self.slots:
+			connection = self.idle.pop() if self.idle else None
+			try:
+				if connection is None:
+					connection = await asyncio.open_connection(self.host, self.port)
+				status, content, keep_alive = await asyncio.wait_for(self._exchange(connection, method, path, body), timeout)
+			except BaseException:
+				if connection:
+					connection[1].close()
+				raise
+			if keep_alive:
+				self.idle.append(connection)
+			else:
+				connection[1].close()
+			return status, content
+
+	async def _exchange(self, connection, method, path, body):
+		reader, writer = connection
+		body = body or b""
+		head = "%s %s HTTP/1.1\r\nHost: %s:%d\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n" % (
+			method, path, self.host, self.port, len(body))
+		writer.write(head.encode("latin-1") + body)
+		await writer.drain()
+		status_line = (await reader.readline()).decode("latin-1").split()
+		if len(status_line) < 2:
+			raise ConnectionError("Connection closed by server")
+		headers = {}
+		while True:
+			line = (await reader.readline()).decode("latin-1")
+			if line in ("\r\n", "\n", ""):
+				break
+			key, _, value = line.partition(":")
+			headers[key.strip().lower()] = value.strip()
+		content = await reader.readexactly(int(headers.get("content-length", 0)))
+		return int(status_line[1]), content, headers.get("connection", "").lower() != "close"
+
+	def close(self):
+		for reader, writer in self.idle:
+			writer.close()
+		self.idle = []
+
+
+class Stats():
+	"""Counters of a run; every polling application gets every return message, so seen and duplicates are per poller."""
+	def __init__(self, pollers=1):
+		self.submit_latency = []
+		self.submitted = 0
+		self.busy = 0               # 503 answers, each one retried
+		self.submit_errors = 0
+		self.returns_sent = {}      # sequence -> send time
+		self.return_errors = 0
+		self.poll_latency = []
+		self.polls = 0
+		self.poll_errors = 0
+		self.seen = [{} for _ in range(pollers)]        # per poller: sequence -> lag in seconds
+		self.duplicates = [0] * pollers
+
+	def report(self, duration):
+		def row(name, values, scale=1000.0):
+			values = sorted(values)
+			if not values:
+				return "%-22s -" % name
+			return "%-22s p50 %8.1f  p90 %8.1f  p99 %8.1f  max %8.1f ms" % (name,
+				percentile(values, 0.5) * scale, percentile(values, 0.9) * scale, percentile(values, 0.99) * scale, values[-1] * scale)
+		attempts = self.submitted + self.busy + self.submit_errors
+		lines = [
+			"duration %.1fs" % duration,
+			"forward: %d submitted, %.1f/s, %d x 503 (%.1f%% of %d attempts), %d errors" % (
+				self.submitted, self.submitted / duration, self.busy, 100.0 * self.busy / attempts if attempts else 0.0, attempts, self.submit_errors),
+			row("submit latency", self.submit_latency),
+			"return: %d sent, %d errors" % (len(self.returns_sent), self.return_errors),
+			"polls: %d, %.1f/s, %d errors" % (self.polls, self.polls / duration, self.poll_errors),
+			row("poll latency", self.poll_latency),
+		]
+		for poller, seen in enumerate(self.seen):
+			lines.append("application %d: %d seen, %d missing, %d duplicates" % (
+				poller + 1, len(seen), len(self.returns_sent) - len(seen), self.duplicates[poller]))
+			lines.append(row("  high-water-mark lag", list(seen.values())))
+		return "\n".join(lines)
+
+
+class LoadGenerator():
+	def __init__(self, url, terminals, rate, return_rate, pollers, poll_interval, long_poll, connections,
+			access_id="00000000", password="password"):
+		parts = urllib.parse.urlsplit(url)
+		self.pool = HttpPool(parts.hostname, parts.port or 80, connections)
+		self.base = parts.path.rstrip("/")
+		self.mobile_ids = ["%08dSKYLOAD" % i for i in range(terminals)]
+		self.rate = rate
+		self.return_rate = return_rate
+		self.pollers = pollers
+		self.poll_interval = poll_interval
+		self.long_poll = long_poll
+		self.access_id = access_id
+		self.password = password
+		self.stats = Stats(pollers)
+		self.sequence = 0
+		self.running = True
+		self.stopped = None
+
+	async def _sleep(self, seconds):
+		"""Sleeps, but wakes up as soon as the run is stopped."""
+		try:
+			await asyncio.wait_for(self.stopped.wait(), seconds)
+		except asyncio.TimeoutError:
+			pass
+
+	async def _paced(self, rate, action, *args):
+		"""Calls action at rate per second with exponential gaps, starting at a random point."""
+		await self._sleep(random.uniform(0, 1.0 / rate))
+		while self.running:
+			started = time.time()
+			await action(*args)
+			await self._sleep(max(random.expovariate(rate) - (time.time() - started), 0))
+
+	async def submit(self, mobile_id):
+		self.sequence += 1
+		body = json.dumps({"accessID" : self.access_id, "password" : self.password, "messages" : [{
+			"DestinationID" : mobile_id, "UserMessageID" : self.sequence, "Payload" : {"SIN" : 16, "MIN" : 1}}]}).encode("utf-8")
+		delay = 0.1
+		while self.running:
+			start = time.time()
+			try:
+				status, content = await self.pool.request("POST", self.base + GATEWAY_SUFFIX + "/submit_messages.json/", body)
+			except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+				self.stats.submit_errors += 1
+				return
+			if status == 503:
+				self.stats.busy += 1
+				await self._sleep(delay)
+				delay = min(delay * 2, 2.0)
+				continue
+			result = json.loads(content.decode("utf-8")).get("SubmitForwardMessages_JResult", {}) if status == 200 else {}
+			if status == 200 and result.get("ErrorID") == 0:
+				self.stats.submitted += 1
+				self.stats.submit_latency.append(time.time() - start)
+			else:
+				self.stats.submit_errors += 1
+			return
+
+	async def send_return(self, mobile_id):
+		self.sequence += 1
+		sequence = self.sequence
+		body = json.dumps({"Messages" : [{"SIN" : LOAD_SIN, "MobileID" : mobile_id, "Payload" : {
+			"Name" : "load", "SIN" : LOAD_SIN, "MIN" : 1, "Fields" : [{"Name" : "sequence", "Value" : str(sequence)}]}}]}).encode("utf-8")
+		self.stats.returns_sent[sequence] = time.time()
+		try:
+			status, content = await self.pool.request("POST", self.base + MOBILE_PREFIX + "/return_messages.json", body)
+		except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+			status = None
+		if status != 200:
+			del self.stats.returns_sent[sequence]
+			self.stats.return_errors += 1
+
+	async def poll(self, poller):
+		"""Polls get_return_messages as application number poller, with its own start_utc."""
+		seen = self.stats.seen[poller]
+		start_utc = None
+		# retried like the polls, a refused first request would end the poller without a trace in the report
+		while start_utc is None:
+			self.stats.polls += 1
+			try:
+				status, content = await self.pool.request("GET", self.base + GATEWAY_SUFFIX + "/info_utc_time.json/")
+				start_utc = json.loads(content.decode("utf-8")) if status == 200 else None
+			except (OSError, ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+				pass
+			if start_utc is None:
+				self.stats.poll_errors += 1
+				await asyncio.sleep(self.poll_interval)
+		# runs until cancelled, so that return messages sent at the end are still picked up
+		while True:
+			params = {"access_id" : self.access_id, "password" : self.password, "start_utc" : start_utc}
+			if self.long_poll:
+				params["long_poll"] = self.long_poll
+			started = time.time()
+			try:
+				status, content = await self.pool.request("GET",
+					self.base + GATEWAY_SUFFIX + "/get_return_messages.json/?" + urllib.parse.urlencode(params))
+				result = json.loads(content.decode("utf-8")) if status == 200 else {}
+			except (OSError, ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+				result = {}
+			now = time.time()
+			self.stats.polls += 1
+			if result.get("ErrorID") != 0:
+				self.stats.poll_errors += 1
+				await asyncio.sleep(self.poll_interval)
+				continue
+			self.stats.poll_latency.append(now - started)
+			for message in result.get("Messages") or []:
+				fields = (message.get("Payload") or {}).get("Fields") or []
+				if message.get("SIN") != LOAD_SIN or not fields:
+					continue
+				sequence = int(fields[0]["Value"])
+				if sequence in seen:
+					self.stats.duplicates[poller] += 1
+				elif sequence in self.stats.returns_sent:
+					seen[sequence] = now - self.stats.returns_sent[sequence]
+			start_utc = result.get("NextStartUTC") or start_utc
+			if not result.get("More") and not self.long_poll:
+				await asyncio.sleep(self.poll_interval)
+
+	async def run(self, duration, drain=3.0):
+		self.stopped = asyncio.Event()
+		tasks = []
+		for mobile_id in self.mobile_ids:
+			if self.rate:
+				tasks.append(asyncio.ensure_future(self._paced(self.rate, self.submit, mobile_id)))
+			if self.return_rate:
+				tasks.append(asyncio.ensure_future(self._paced(self.return_rate, self.send_return, mobile_id)))
+		pollers = [asyncio.ensure_future(self.poll(poller)) for poller in range(self.pollers)]
+		start = time.time()
+		await asyncio.sleep(duration)
+		self.running = False
+		self.stopped.set()
+		elapsed = time.time() - start
+		await asyncio.gather(*tasks, return_exceptions=True)
+		# let pollers pick up the last return messages
+		deadline = time.time() + drain
+		while any(len(seen) < len(self.stats.returns_sent) for seen in self.stats.seen) and time.time() < deadline:
+			await asyncio.sleep(0.1)
+		for poller in pollers:
+			poller.cancel()
+		await asyncio.gather(*pollers, return_exceptions=True)
+		self.pool.close()
+		return elapsed
+
+
+def start_stand_in(port, submit_limit):
+	process = subprocess.Popen([sys.executable, STAND_IN, "--port", str(port), "--submitlimit", str(submit_limit)])
+	deadline = time.time() + 10
+	while time.time() < deadline:
+		try:
+			socket.create_connection(("localhost", port), 0.5).close()
+			return process
+		except OSError:
+			time.sleep(0.05)
+	process.kill()
+	raise Exception("Gateway stand-in did not start on port %d" % port)
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Simulates many terminals and applications against the gateway API.")
+	parser.add_argument("--url", default="http://localhost:8080", help="Gateway base URL")
+	parser.add_argument("--standin", action="store_true", help="Start Tools/Gateway/gateway.py on the --url port for the run")
+	parser.add_argument("--submitlimit", type=float, default=0, help="With --standin: submissions per second before 503")
+	parser.add_argument("--terminals", type=int, default=100, help="Number of simulated MobileIDs")
+	parser.add_argument("--rate", type=float, default=0.2, help="Forward messages per second per terminal, 0 for none")
+	parser.add_argument("--returnrate", type=float, default=0.2, help="Return messages per second per terminal, 0 for none")
+	parser.add_argument("--pollers", type=int, default=1, help="Applications polling get_return_messages")
+	parser.add_argument("--pollinterval", type=float, default=1.0, help="Seconds between polls without long-poll")
+	parser.add_argument("--longpoll", type=int, default=0, help="long_poll seconds of every poll, 0 to poll every --pollinterval")
+	parser.add_argument("--connections", type=int, default=50, help="Size of the keep-alive connection pool")
+	parser.add_argument("--duration", type=float, default=30, help="Seconds to generate load")
+	args = parser.parse_args()
+
+	stand_in = start_stand_in(urllib.parse.urlsplit(args.url).port or 80, args.submitlimit) if args.standin else None
+	try:
+		generator = LoadGenerator(args.url, args.terminals, args.rate, args.returnrate, args.pollers,
+			args.pollinterval, args.longpoll, args.connections)
+		elapsed = asyncio.run(generator.run(args.duration))
+		print(generator.stats.report(elapsed))
+	finally:
+		if stand_in:
+			stand_in.kill()
@@ -0,0 +1,241 @@
+"""Recording of the web service traffic of a test run, and its replay without a simulator.
+
+gateway.py --record <file> appends every request the Lua tests make (gateway,
+GpsWebService, DeviceWebService) with its answer, arrival time and duration to
+an append-only file; RunAllModules.lua -marktests adds a mark at the start of
+every test. gateway.py --replay <file> then answers the same requests from the
+recording, so a failing test's checks run again offline:
+
+	python gateway.py --port 8000 --replay traffic.bin --speed 0
+	lua RunAllModules.lua -v -p 8000 -replay 0 -t test_Name
+
+--speed 0 answers at once, N holds every answer for its recorded duration / N.
+RunAllModules.lua -replay <speed> runs the Lua clock (os.time, socket.sleep) at
+the same speed, so the tests' own waits shrink too.
+
+A request is answered by the next recorded answer to the same request (method,
+path, query and JSON body, in any key order, without long_poll) within the
+mark of the current test, then of the same resource within that mark, then of
+the same request anywhere in the recording. Repeats of one answer (a poll that
+found nothing yet) are replayed once, the last answer of a request is repeated
+for as long as it is asked again.
+
+The file starts with TRAFFIC_MAGIC, every record is a RECORD header followed
+by request line, request body, content type and answer; zlib compressed
+together when that saves space:
+
+	python traffic.py traffic.bin           summary per resource
+	python traffic.py traffic.bin --dump    every exchange
+"""
+import argparse
+import asyncio
+import json
+import os
+import struct
+import time
+import urllib.parse
+import zlib
+
+TRAFFIC_MAGIC = b"GWTRAF1\n"
+# kind, arrival time, duration, status, stored length, request line, request body, content type and answer lengths
+RECORD = struct.Struct("<BdfHIIIII")
+EXCHANGE = 0
+MARK = 1
+COMPRESSED = 0x80
+# records with less than this are stored as they are
+COMPRESS_FROM = 256
+# resources of the stand-in itself: marks and status, never recorded
+REPLAY_PREFIX = "/Replay"
+# parameters that differ between runs of the same test (long_poll is what is left of the test's timeout)
+VOLATILE_PARAMS = ("long_poll",)
+
+
+def request_key(method, target, body):
+	"""(method, path, sorted query, body) of a request; LuaSocket sends parameters and JSON keys in pairs() order."""
+	url = urllib.parse.urlsplit(target)
+	params = sorted((key, value) for key, value in urllib.parse.parse_qsl(url.query, keep_blank_values=True) if key not in VOLATILE_PARAMS)
+	try:
+		body = json.dumps(json.loads(body.decode("utf-8")), sort_keys=True).encode("utf-8") if body else b""
+	except ValueError:
+		pass
+	return method, url.path.rstrip("/"), tuple(params), body
+
+
+class TrafficRecorder():
+	"""Appends exchanges and marks to a traffic file, each one flushed so a crashed run keeps what it did."""
+	def __init__(self, path):
+		self.path = path
+		self.file = open(path, "ab")
+		if self.file.tell() == 0:
+			self.file.write(TRAFFIC_MAGIC)
+			self.file.flush()
+		self.exchanges = 0
+
+	def _write(self, kind, start, duration, status, pieces):
+		data = b"".join(pieces)
+		if len(data) >= COMPRESS_FROM:
+			compressed = zlib.compress(data, 6)
+			if len(compressed) < len(data):
+				kind, data = kind | COMPRESSED, compressed
+		self.file.write(RECORD.pack(kind, start, duration, status, len(data), *[len(piece) for piece in pieces]) + data)
+		self.file.flush()
+
+	def record(self, start, duration, method, target, body, status, content_type, content):
+		self.exchanges += 1
+		self._write(EXCHANGE, start, duration, status, [("%s %s" % (method, target)).encode("latin-1"), body or b"",
+			content_type.encode("latin-1"), content])
+
+	def mark(self, name):
+		self._write(MARK, time.time(), 0.0, 0, [name.encode("utf-8"), b"", b"", b""])
+
+	def close(self):
+		self.file.close()
+
+
+def read_traffic(path):
+	"""Yields (kind, start, duration, status, request line or mark name, body, content type, answer); a cut off last record is left out."""
+	with open(path, "rb") as f:
+		if f.read(len(TRAFFIC_MAGIC)) != TRAFFIC_MAGIC:
+			raise Exception("Not a traffic recording: " + path)
+		while True:
+			header = f.read(RECORD.size)
+			if len(header) < RECORD.size:
+				return
+			kind, start, duration, status, stored, *lengths = RECORD.unpack(header)
+			data = f.read(stored)
+			if len(data) < stored:
+				return
+			if kind & COMPRESSED:
+				data = zlib.decompress(data)
+			pieces = []
+			for length in lengths:
+				pieces.append(data[:length])
+				data = data[length:]
+			line, body, content_type, content = pieces
+			yield kind & ~COMPRESSED, start, duration, status, line.decode("utf-8" if kind & ~COMPRESSED == MARK else "latin-1"), \
+				body, content_type.decode("latin-1"), content
+
+
+class _Answers():
+	"""Recorded answers to one request in one mark, in order, consecutive repeats dropped."""
+	def __init__(self):
+		self.answers = []
+		self.next = 0
+
+	def add(self, answer):
+		if not self.answers or self.answers[-1][1:] != answer[1:]:
+			self.answers.append(answer)
+
+	def take(self):
+		answer = self.answers[min(self.next, len(self.answers) - 1)]
+		self.next += 1
+		return answer
+
+
+class TrafficReplay():
+	"""Answers requests from a recording, see the module description for the order they are looked up in."""
+	def __init__(self, path, speed=0):
+		self.path = path
+		self.speed = speed
+		# mark -> {request key -> _Answers} and {(method, path) -> _Answers}; "" holds what came before the first mark
+		self.requests = {"" : {}}
+		self.resources = {"" : {}}
+		# request key -> _Answers over the whole recording
+		self.anywhere = {}
+		self.mark = ""
+		self.exchanges = 0
+		self.misses = []
+		self.answered = 0
+		current = ""
+		for kind, start, duration, status, line, body, content_type, content in read_traffic(path):
+			if kind == MARK:
+				current = line
+				# a test run twice (a rerun) is replayed from its first run
+				if current in self.requests:
+					current = "%s#%d" % (line, len(self.requests))
+				self.requests[current], self.resources[current] = {}, {}
+				continue
+			method, _, target = line.partition(" ")
+			key = request_key(method, target, body)
+			answer = (duration, status, content_type, content)
+			self.requests[current].setdefault(key, _Answers()).add(answer)
+			self.resources[current].setdefault(key[:2], _Answers()).add(answer)
+			self.anywhere.setdefault(key, _Answers()).add(answer)
+			self.exchanges += 1
+
+	def set_mark(self, name):
+		"""Moves to the recorded part of a test; a test not in the recording keeps the current one."""
+		if name in self.requests:
+			self.mark = name
+			return True
+		return False
+
+	def find(self, method, target, body):
+		key = request_key(method, target, body)
+		for table, lookup in ((self.requests[self.mark], key), (self.resources[self.mark], key[:2]), (self.anywhere, key)):
+			answers = table.get(lookup)
+			if answers:
+				return answers.take()
+		return None
+
+	async def route(self, method, target, body):
+		"""(status, content type, content) of the recorded answer, 404 when the request was never recorded."""
+		answer = self.find(method, target, body)
+		if answer is None:
+			self.misses.append("%s %s" % (method, target))
+			print("Not in the recording: %s %s" % (method, target), flush=True)
+			return 404, "application/json; charset=utf-8", json.dumps({"ErrorID" : 2, "Error" : "not recorded"}).encode("utf-8")
+		duration, status, content_type, content = answer
+		if self.speed:
+			await asyncio.sleep(duration / self.speed)
+		self.answered += 1
+		return status, content_type, content
+
+	def status(self):
+		return {"Recording" : self.path, "Exchanges" : self.exchanges, "Marks" : len(self.requests) - 1, "Mark" : self.mark,
+			"Answered" : self.answered, "Misses" : len(self.misses)}
+
+
+def summary(path):
+	"""(marks, {(method, path): [count, bytes, seconds]}, exchanges, first start, last end) of a recording."""
+	marks = []
+	resources = {}
+	exchanges = 0
+	first = last = None
+	for kind, start, duration, status, line, body, content_type, content in read_traffic(path):
+		if kind == MARK:
+			marks.append((start, line))
+			continue
+		exchanges += 1
+		method, _, target = line.partition(" ")
+		stats = resources.setdefault((method, urllib.parse.urlsplit(target).path.rstrip("/")), [0, 0, 0.0])
+		stats[0] += 1
+		stats[1] += len(body) + len(content)
+		stats[2] += duration
+		first = start if first is None else min(first, start)
+		last = start + duration if last is None else max(last, start + duration)
+	return marks, resources, exchanges, first, last
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Summary or dump of a gateway traffic recording (gateway.py --record).")
+	parser.add_argument("recording", help="Traffic file")
+	parser.add_argument("--dump", action="store_true", help="Prints every exchange and mark")
+	args = parser.parse_args()
+
+	if args.dump:
+		origin = None
+		for kind, start, duration, status, line, body, content_type, content in read_traffic(args.recording):
+			origin = start if origin is None else origin
+			if kind == MARK:
+				print("%10.3f ---- %s" % (start - origin, line))
+			else:
+				print("%10.3f %7.3fs %d %s %s -> %s" % (start - origin, duration, status, line, body.decode("utf-8", "replace"),
+					content.decode("utf-8", "replace")))
+	else:
+		marks, resources, exchanges, first, last = summary(args.recording)
+		print("%s: %d exchange(s), %d mark(s), %.1fs, %d bytes" % (args.recording, exchanges, len(marks),
+			(last - first) if first is not None else 0, os.path.getsize(args.recording)))
+		print("%-6s %-60s %8s %10s %10s" % ("method", "resource", "count", "bytes", "seconds"))
+		for (method, path), (count, size, seconds) in sorted(resources.items(), key=lambda item: -item[1][2]):
+			print("%-6s %-60s %8d %10d %10.1f" % (method, path, count, size, seconds))
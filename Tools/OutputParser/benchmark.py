@@ -0,0 +1,148 @@
+import argparse
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import testoutparse
+
+try:
+	import resource
+except ImportError:
+	#not available on Windows, peak memory is not reported there
+	resource = None
+
+DEFAULT_SIZES = "10000,100000,1000000"
+
+
+def synthetic_lines(seed=0):
+	"""Endless lunatest -v style output, roughly the mix produced by RunAllModules.lua."""
+	rnd = random.Random(seed)
+	yield "1\t-v\n"
+	yield "*** VMS Feature Tests Started ***\n"
+	yield "Starting tests, 9 suite(s)\n"
+	for suite_number in itertools.count():
+		yield '-- Starting suite "TestSyntheticModule%d", 40 test(s)\n' % suite_number
+		for test_number in range(40):
+			name = "test_Group%d_WhenSomethingHappens_ExpectedResult%d" % (suite_number, test_number)
+			yield "[STARTING]: %s\n" % name
+			for _ in range(rnd.randint(5, 60)):
+				yield "[2015-05-21 12:26:%02d] Received:  SIN=115 MIN=20 Name=StandardReport1 Latitude=%d Longitude=%d Speed=0 Course=361\n" % (
+					rnd.randint(0, 59), rnd.randint(0, 5400000), rnd.randint(0, 10800000))
+			outcome = rnd.random()
+			if outcome < 0.85:
+				yield "PASS: %s (%.2fms)\n" % (name, rnd.uniform(1000, 120000))
+			elif outcome < 0.93:
+				yield "FAIL: %s (%.2fms): Expected 60, got 61 - Standard report interval (1024)\n" % (name, rnd.uniform(1000, 120000))
+			elif outcome < 0.98:
+				yield "SKIP: %s() - HelmPanel is not installed!\n" % name
+			else:
+				yield "ERROR in %s():\n\tTestFramework.lua:320: Gateway message retrieval error\n" % name
+		yield '    Finished suite "TestSyntheticModule%d", +34 -3 E1 s2\n' % suite_number
+
+
+def replayed_lines(source):
+	"""Repeats a real lunatest output over and over."""
+	while True:
+		with open(source, errors="replace") as f:
+			for line in f:
+				yield line
+
+
+def write_case(path, lines, count):
+	with open(path, "w") as f:
+		f.writelines(itertools.islice(lines, count))
+
+
+def measure(path):
+	"""Parses one file and reports throughput. Runs in its own process so peak RSS belongs to this file only."""
+	lines = 0
+	start = time.time()
+	with open(os.devnull, "w") as result:
+		output_parser = testoutparse.TestOutputParser(testoutparse.JUnitWriter(result), trace_limit=65536)
+		with open(path, errors="replace") as data:
+			for line in data:
+				output_parser.feed(line)
+				lines += 1
+		output_parser.close()
+	seconds = time.time() - start
+	peak_rss = None
+	if resource:
+		peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		if sys.platform == "darwin":
+			peak_rss = peak_rss // 1024
+	return {
+		"lines" : lines,
+		"seconds" : seconds,
+		"lines_per_second" : lines / seconds if seconds else 0.0,
+		"peak_rss_kb" : peak_rss,
+	}
+
+
+def run_case(path):
+	output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--measure", path], universal_newlines=True)
+	return json.loads(output)
+
+
+def compare(results, baseline, tolerance):
+	regressions = []
+	for name, result in results.items():
+		if name not in baseline:
+			continue
+		base = baseline[name]
+		if result["lines_per_second"] < base["lines_per_second"] * (1 - tolerance):
+			regressions.append("%s: %.0f lines/s, baseline %.0f lines/s" % (name, result["lines_per_second"], base["lines_per_second"]))
+		if result["peak_rss_kb"] and base.get("peak_rss_kb") and result["peak_rss_kb"] > base["peak_rss_kb"] * (1 + tolerance):
+			regressions.append("%s: peak RSS %d kB, baseline %d kB" % (name, result["peak_rss_kb"], base["peak_rss_kb"]))
+	return regressions
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Benchmarks testoutparse on synthetic and replayed lunatest outputs.')
+	parser.add_argument('--sizes', default=DEFAULT_SIZES, help="Comma separated line counts, e.g. 10000,1000000,10000000")
+	parser.add_argument('--source', action="append", default=[], help="Real lunatest output to replay up to each size, can be repeated")
+	parser.add_argument('--save', default=None, help="Writes results as JSON, usable later as --compare baseline")
+	parser.add_argument('--compare', default=None, help="Baseline JSON to check results against")
+	parser.add_argument('--tolerance', default=0.25, type=float, help="Allowed relative slowdown or memory growth against baseline")
+	parser.add_argument('--measure', default=None, help=argparse.SUPPRESS)
+	args = parser.parse_args()
+
+	if args.measure:
+		print(json.dumps(measure(args.measure)))
+		sys.exit(0)
+
+	sizes = [int(size) for size in args.sizes.split(",")]
+	sources = [("synthetic", None)] + [(os.path.basename(source), source) for source in args.source]
+	results = {}
+	workdir = tempfile.mkdtemp(prefix="testoutparse_bench_")
+	try:
+		for label, source in sources:
+			for size in sizes:
+				name = "%s-%d" % (label, size)
+				path = os.path.join(workdir, name + ".txt")
+				write_case(path, replayed_lines(source) if source else synthetic_lines(), size)
+				result = run_case(path)
+				os.remove(path)
+				results[name] = result
+				print("%-32s %10d lines %8.2fs %12.0f lines/s  peak RSS %s kB" % (
+					name, result["lines"], result["seconds"], result["lines_per_second"], result["peak_rss_kb"]))
+	finally:
+		for leftover in os.listdir(workdir):
+			os.remove(os.path.join(workdir, leftover))
+		os.rmdir(workdir)
+
+	if args.save:
+		with open(args.save, "w") as f:
+			json.dump(results, f, indent=2, sort_keys=True)
+
+	if args.compare:
+		with open(args.compare) as f:
+			regressions = compare(results, json.load(f), args.tolerance)
+		for regression in regressions:
+			print("REGRESSION " + regression)
+		if regressions:
+			sys.exit(1)
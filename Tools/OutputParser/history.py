@@ -0,0 +1,141 @@
+"""Per-test timing history of parsed lunatest runs, kept in SQLite.
+
+Every run (one lua invocation) gets a row in runs, every test case parsed
+from its output a row in results. TestRunner.py uses the estimates to
+schedule the longest suites first.
+"""
+import argparse
+import sqlite3
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+	id INTEGER PRIMARY KEY,
+	started REAL,
+	firmware TEXT,
+	instance TEXT,
+	source TEXT,
+	suites TEXT,
+	wall_seconds REAL,
+	selection TEXT
+);
+CREATE TABLE IF NOT EXISTS results (
+	run_id INTEGER REFERENCES runs(id),
+	suite TEXT,
+	test TEXT,
+	result TEXT,
+	duration_ms REAL,
+	recorded REAL
+);
+CREATE INDEX IF NOT EXISTS results_test ON results (suite, test, run_id);
+"""
+
+# estimates are the median of this many latest measurements
+DEFAULT_WINDOW = 5
+# tests not run for this long before the latest run of their suite are taken as removed
+RECENT_DAYS = 30
+
+
+def median(values):
+	values = sorted(values)
+	if not values:
+		return None
+	middle = len(values) // 2
+	return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+
+class TimingHistory():
+	def __init__(self, path):
+		# parallel TestRunner workers write to the same file, each through its own connection
+		self.connection = sqlite3.connect(path, timeout=60)
+		self.connection.execute("PRAGMA journal_mode=WAL")
+		self.connection.executescript(SCHEMA)
+		if "selection" not in [row[1] for row in self.connection.execute("PRAGMA table_info(runs)")]:
+			# databases written before runs of selected tests were told apart
+			self.connection.execute("ALTER TABLE runs ADD COLUMN selection TEXT")
+
+	def start_run(self, firmware=None, instance=None, source=None, selection=None):
+		"""selection is the -t pattern or -tl list of a run of only some tests, its wall time says nothing about whole suites."""
+		with self.connection:
+			cursor = self.connection.execute("INSERT INTO runs (started, firmware, instance, source, selection) VALUES (?, ?, ?, ?, ?)",
+				(time.time(), firmware, instance, source, selection))
+		return cursor.lastrowid
+
+	def record(self, run_id, suite, test_case):
+		"""Stores a test case as handed to a TestOutputParser listener (time in seconds as text)."""
+		with self.connection:
+			self.connection.execute("INSERT INTO results (run_id, suite, test, result, duration_ms, recorded) VALUES (?, ?, ?, ?, ?, ?)",
+				(run_id, suite, test_case["name"], test_case["result"], float(test_case["time"]) * 1000, time.time()))
+
+	def finish_run(self, run_id, suites, wall_seconds=None):
+		with self.connection:
+			self.connection.execute("UPDATE runs SET suites = ?, wall_seconds = ? WHERE id = ?", (",".join(suites), wall_seconds, run_id))
+
+	def test_estimates(self, window=DEFAULT_WINDOW):
+		"""{(suite, test): seconds} of every test recorded within RECENT_DAYS of the latest record of its suite.
+
+		Skipped tests count with their zero duration, a test of a @randIn batch usually costs nothing.
+		"""
+		durations, latest = {}, {}
+		for suite, test, duration, recorded in self.connection.execute(
+				"SELECT suite, test, duration_ms, recorded FROM results ORDER BY run_id DESC"):
+			key = (suite, test)
+			if key not in durations:
+				durations[key] = []
+				latest[key] = recorded
+			if len(durations[key]) < window:
+				durations[key].append(duration)
+		suite_latest = {}
+		for (suite, test), recorded in latest.items():
+			suite_latest[suite] = max(suite_latest.get(suite, recorded), recorded)
+		return dict((key, median(values) / 1000.0) for key, values in durations.items()
+			if latest[key] >= suite_latest[key[0]] - RECENT_DAYS * 86400)
+
+	def suite_estimates(self, window=DEFAULT_WINDOW):
+		"""{suite: seconds}, the median wall time of runs of just that suite, or the sum of its test estimates."""
+		estimates = {}
+		for (suite, test), seconds in self.test_estimates(window).items():
+			estimates[suite] = estimates.get(suite, 0) + seconds
+		for suite in list(estimates):
+			walls = [row[0] for row in self.connection.execute(
+				"SELECT wall_seconds FROM runs WHERE suites = ? AND wall_seconds IS NOT NULL AND selection IS NULL ORDER BY id DESC LIMIT ?", (suite, window))]
+			if walls:
+				# the wall time also covers suite setup and teardown, which have no duration of their own
+				estimates[suite] = max(estimates[suite], median(walls))
+		return estimates
+
+	def failed_tests(self, results=("FAIL", "ERROR")):
+		"""[(suite, test, result)] of the tests whose latest record is one of results, same recency rule as test_estimates."""
+		latest = {}
+		for suite, test, result, recorded in self.connection.execute(
+				"SELECT suite, test, result, recorded FROM results ORDER BY run_id DESC"):
+			if (suite, test) not in latest:
+				latest[(suite, test)] = (result, recorded)
+		suite_latest = {}
+		for (suite, test), (result, recorded) in latest.items():
+			suite_latest[suite] = max(suite_latest.get(suite, recorded), recorded)
+		return sorted((suite, test, result) for (suite, test), (result, recorded) in latest.items()
+			if result in results and recorded >= suite_latest[suite] - RECENT_DAYS * 86400)
+
+	def close(self):
+		self.connection.close()
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Prints timing estimates from a test history database.")
+	parser.add_argument("database", help="History database written by testoutparse.py/TestRunner.py --history")
+	parser.add_argument("--tests", action="store_true", help="Per test estimates instead of per suite")
+	parser.add_argument("--window", type=int, default=DEFAULT_WINDOW, help="Latest measurements the median is taken from")
+	args = parser.parse_args()
+
+	history = TimingHistory(args.database)
+	if args.tests:
+		estimates = history.test_estimates(args.window)
+		for (suite, test), seconds in sorted(estimates.items(), key=lambda item: -item[1]):
+			print("%10.1f  %-32s %s" % (seconds, suite, test))
+	else:
+		estimates = history.suite_estimates(args.window)
+		for suite, seconds in sorted(estimates.items(), key=lambda item: -item[1]):
+			print("%10.1f  %s" % (seconds, suite))
+		print("%10.1f  total" % sum(estimates.values()))
+	history.close()
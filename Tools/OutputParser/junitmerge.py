@@ -0,0 +1,261 @@
+"""Merges JUnit results of sharded, parallel and rerun test runs into one report.
+
+	python junitmerge.py result_*.xml --output result.xml
+
+The files are read with iterparse one test case at a time, only the test case
+elements are kept until the report is written, never whole documents. Same-named <testsuite>
+elements (the shards of a suite, or one suite run on several instances) become
+one, with tests, failures, errors, skipped and time summed up over its test
+cases. A test case found more than once (a rerun) is resolved by --duplicates:
+
+	last   the one read last wins, files are read in the given order
+	flaky  a test that failed and passed is kept as passed with the failures as
+	       <flakyFailure>/<flakyError>, one failing every time keeps its first
+	       failure and gets the others as <rerunFailure>/<rerunError>
+	       (rerun property "flaky" or "failed", as rerun.py writes them)
+
+Test cases keep the instance and port properties written by TestRunner.py and
+testoutparse.py --instance, ones without them get the file they came from as
+"source" property.
+"""
+import argparse
+import glob
+import os
+import re
+import time
+import xml.etree.ElementTree as ET
+
+import testoutparse
+
+FAILED = ("FAIL", "ERROR")
+RERUN_PROPERTY = "rerun"
+SOURCE_PROPERTY = "source"
+FLAKY = "flaky"
+STILL_FAILING = "failed"
+
+# result -> element it is written as
+RESULT_TAGS = (("FAIL", "failure"), ("ERROR", "error"), ("SKIP", "skipped"))
+FLAKY_TAGS = {"FAIL" : "flakyFailure", "ERROR" : "flakyError"}
+RERUN_TAGS = {"FAIL" : "rerunFailure", "ERROR" : "rerunError"}
+# lunatest reports errors as "ERROR in test_Name():"
+ERROR_NAME_RE = re.compile(r"^(\w+)\(\):?$")
+
+# characters that make a value go through the full escaping of testoutparse
+SPECIAL_RE = re.compile('[&<>"\'\n\r\t\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+LAST = "last"
+POLICIES = (LAST, FLAKY)
+
+
+def lunatest_name(name):
+	match = ERROR_NAME_RE.match(name.strip())
+	return match.group(1) if match else name.strip()
+
+
+def case_result(case):
+	for result, tag in RESULT_TAGS:
+		if case.find(tag) is not None:
+			return result
+	return "PASS"
+
+
+def case_property(case, name):
+	for item in case.iterfind("properties/property"):
+		if item.get("name") == name:
+			return item.get("value")
+	return None
+
+
+def set_case_property(case, name, value):
+	"""Sets a testcase property, replacing an earlier value of it."""
+	properties = case.find("properties")
+	if properties is None:
+		properties = ET.Element("properties")
+		case.insert(0, properties)
+	for item in properties.iterfind("property"):
+		if item.get("name") == name:
+			item.set("value", value)
+			return
+	ET.SubElement(properties, "property", name=name, value=value)
+
+
+def case_time(case):
+	try:
+		return float(case.get("time") or 0)
+	except ValueError:
+		return 0.0
+
+
+def _add_run(case, tag, run):
+	"""Adds the failure of another run of the test to case as tag, with its output."""
+	result = case_result(run)
+	element = ET.SubElement(case, tag, message=run.find(dict(RESULT_TAGS)[result]).get("message", ""))
+	output = run.find("system-out")
+	if output is not None:
+		ET.SubElement(element, "system-out").text = output.text
+	return element
+
+
+def fold_flaky(kept, new):
+	"""The test case element of a test run as kept and later as new, under the flaky policy."""
+	kept_result, new_result = case_result(kept), case_result(new)
+	if new_result == "SKIP" and kept_result != "SKIP":
+		return kept
+	if kept_result == "SKIP":
+		return new
+	if kept_result in FAILED and new_result in FAILED:
+		_add_run(kept, RERUN_TAGS[new_result], new)
+		set_case_property(kept, RERUN_PROPERTY, STILL_FAILING)
+		return kept
+	# passed at least once: the passing run is the test case, every failing one becomes a flaky one
+	passed, other = (new, kept) if new_result == "PASS" else (kept, new)
+	if case_result(other) in FAILED:
+		_add_run(passed, FLAKY_TAGS[case_result(other)], other)
+	# reruns the other run already had are flaky now as well
+	for result in FAILED:
+		for element in other.findall(FLAKY_TAGS[result]) + other.findall(RERUN_TAGS[result]):
+			element.tag = FLAKY_TAGS[result]
+			passed.append(element)
+	if passed.find(FLAKY_TAGS["FAIL"]) is not None or passed.find(FLAKY_TAGS["ERROR"]) is not None:
+		set_case_property(passed, RERUN_PROPERTY, FLAKY)
+	return passed
+
+
+def serialize(element, level=2):
+	"""XML of a testcase element, indented as JUnitWriter writes it (ET.tostring takes most of a merge otherwise)."""
+	indent = "\t" * level
+	out = [indent, "<", element.tag]
+	for name, value in element.items():
+		# names and numbers rarely need escaping, the fast path matters with thousands of test cases
+		out.append(' %s="%s"' % (name, value) if not SPECIAL_RE.search(value) else " %s=%s" % (name, testoutparse.xml_attr(value)))
+	children = list(element)
+	if children:
+		out.append(">\n")
+		for child in children:
+			out.append(serialize(child, level + 1))
+		out.append("%s</%s>\n" % (indent, element.tag))
+	elif element.text:
+		out.append(">%s</%s>\n" % (testoutparse.xml_text(element.text), element.tag))
+	else:
+		out.append(" />\n")
+	return "".join(out)
+
+
+class JUnitMerger():
+	def __init__(self, policy=LAST):
+		if policy not in POLICIES:
+			raise Exception("Unknown duplicate policy %s, one of %s" % (policy, ", ".join(POLICIES)))
+		self.policy = policy
+		self.name = None
+		# suite name -> (attributes of its first occurrence, {(suite, test): testcase element})
+		# the elements are detached from their documents, the rest of which is dropped while reading
+		self.suites = {}
+		self.files = 0
+		self.cases = 0
+		self.duplicates = 0
+
+	def _add_case(self, suite, case, source):
+		self.cases += 1
+		if case_property(case, testoutparse.INSTANCE_PROPERTY) is None and case_property(case, SOURCE_PROPERTY) is None:
+			set_case_property(case, SOURCE_PROPERTY, source)
+		name = case_property(case, testoutparse.TEST_NAME_PROPERTY)
+		key = (suite, lunatest_name(name if name is not None else case.get("name", "")))
+		cases = self.suites[suite][1]
+		if key in cases:
+			self.duplicates += 1
+			if self.policy == FLAKY:
+				case = fold_flaky(cases[key], case)
+		cases[key] = case
+
+	def add_file(self, path):
+		"""Reads the test cases of a JUnit file, what was read before a parse error is kept."""
+		self.files += 1
+		source = os.path.basename(path)
+		root = None
+		suite = None
+		try:
+			for event, element in ET.iterparse(path, events=("start", "end")):
+				if event == "start":
+					if root is None:
+						root = element
+						if self.name is None and element.tag == "testsuites":
+							self.name = element.get("name")
+					if element.tag == "testsuite":
+						suite = element.get("name", "")
+						if suite not in self.suites:
+							self.suites[suite] = (dict(element.attrib), {})
+				elif element.tag == "testcase" and suite is not None:
+					self._add_case(suite, element, source)
+				elif element.tag == "testsuite":
+					# drops the cleared test cases too
+					root.clear()
+		except ET.ParseError as e:
+			print("%s not fully read: %s" % (path, e))
+
+	def write(self, output):
+		"""Writes the merged report to the output file object, returns (tests, failures, errors, skipped, time)."""
+		totals = [0, 0, 0, 0, 0.0]
+		suites = []
+		for suite, (attributes, cases) in self.suites.items():
+			counts = [len(cases), 0, 0, 0, 0.0]
+			for case in cases.values():
+				result = case_result(case)
+				if result in ("FAIL", "ERROR", "SKIP"):
+					counts[("FAIL", "ERROR", "SKIP").index(result) + 1] += 1
+				counts[4] += case_time(case)
+			suites.append((attributes, counts, cases))
+			totals = [total + count for total, count in zip(totals, counts)]
+		output.write('<?xml version="1.0" encoding="utf-8"?>\n')
+		output.write('<testsuites name=%s tests="%d" failures="%d" errors="%d" skipped="%d" time="%.3f">\n' % (
+			(testoutparse.xml_attr(self.name or ""),) + tuple(totals)))
+		for attributes, counts, cases in suites:
+			attributes = dict(attributes)
+			attributes.update(zip(("tests", "failures", "errors", "skipped"), [str(count) for count in counts[:4]]))
+			attributes["time"] = "%.3f" % counts[4]
+			output.write("\t<testsuite%s>\n" % "".join(" %s=%s" % (name, testoutparse.xml_attr(value)) for name, value in attributes.items()))
+			for case in cases.values():
+				output.write(serialize(case))
+			output.write("\t</testsuite>\n")
+		output.write("</testsuites>\n")
+		return tuple(totals)
+
+
+def merge_files(paths, output, policy=LAST):
+	"""Merges the JUnit files into the output path, returns (merger, (tests, failures, errors, skipped, time))."""
+	merger = JUnitMerger(policy)
+	for path in paths:
+		merger.add_file(path)
+	with open(output + ".tmp", "w", encoding="utf-8") as f:
+		totals = merger.write(f)
+	# the output may be one of the inputs
+	os.replace(output + ".tmp", output)
+	return merger, totals
+
+
+def expand(patterns, output=None):
+	"""Paths of the arguments in the given order, wildcards are expanded here as the Windows shell does not.
+	
+	A wildcard does not pick up the output, an earlier merged report would count every test twice.
+	"""
+	paths = []
+	for pattern in patterns:
+		if glob.has_magic(pattern):
+			matches = [path for path in sorted(glob.glob(pattern))
+				if not output or os.path.abspath(path) != os.path.abspath(output)]
+		else:
+			matches = [pattern]
+		paths.extend(path for path in matches if path not in paths)
+	return paths
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Merges JUnit XML results of sharded, parallel and rerun test runs into one report.")
+	parser.add_argument("results", nargs="+", help="JUnit XML files or wildcards, duplicates are resolved in this order")
+	parser.add_argument("--output", required=True, help="Merged JUnit report")
+	parser.add_argument("--duplicates", choices=POLICIES, default=LAST, help="Test cases found more than once: the last one wins, or marked flaky when they passed and failed")
+	args = parser.parse_args()
+
+	start = time.time()
+	merger, (tests, failures, errors, skipped, seconds) = merge_files(expand(args.results, args.output), args.output, args.duplicates)
+	print("%d file(s), %d test case(s) (%d duplicate(s)) -> %s: %d suite(s), %d test(s), %d failure(s), %d error(s), %d skipped in %.2fs" % (
+		merger.files, merger.cases, merger.duplicates, args.output, len(merger.suites), tests, failures, errors, skipped, time.time() - start))
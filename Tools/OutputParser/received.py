@@ -0,0 +1,368 @@
+"""Return message time series of lunatest outputs: report intervals, gaps, duplicates, rates and drift.
+
+	python received.py soak_day1.txt soak_day2.txt.gz --join
+
+Every "Received:" line TestFramework.lua prints at debug level 1 or 2
+(recordAndPrintMsg) becomes one row of NumPy columns: run, series (SIN, MIN,
+Name), time, message ID and a digest of the payload. The outputs are read
+line by line and the rows collected in chunks, so weeks of soak output take
+one pass and a few bytes per message.
+
+Times are the gateway MessageUTC of a message, or the time of its trace line
+for outputs printed before the ID and MessageUTC were part of it. Each file is
+a run of its own, intervals are not taken across runs unless --join is given
+(one soak split over several files).
+
+Periodic VMS reports (StandardReport, AcceleratedReport, LogReport) are
+checked for drift as Infrastructure/DataAnalyse/DriftAnalyse.lua does, against
+the --interval given for them or the median interval of the run. Intervals
+longer than --gapfactor times that are gaps (missed reports), they are listed
+and left out of the drift.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "TraceAnalyser"))
+import archive
+
+# trace1: [2015-05-21 12:26:01] Received: ID=1234 MessageUTC=2015-05-21 12:25:58 SIN=115 MIN=21 Name=StandardReport1 ...
+# trace2 is the same header followed by a multi-line tf.dump of the payload
+RECEIVED_RE = re.compile(r"^\[(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)\] Received: (?:ID=(\S*) MessageUTC=(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d|\S*) ?)?(.*?)\r?$")
+FIELD_RE = re.compile(r"(?:^| )(SIN|MIN|Name)=(\S*)")
+DUMP_FIELD_RE = re.compile(r'^    (SIN|MIN|Name) = "?([^"\n]*)"?$')
+PERIODIC_RE = re.compile(r"^(Standard|Accelerated|Log)Report\d*$")
+UNNAMED = "<Unnamed>"
+NO_ID = -1
+NO_TIME = np.iinfo(np.int64).min
+# rows converted to NumPy columns at once
+CHUNK_ROWS = 100000
+
+
+def is_periodic(name):
+	return PERIODIC_RE.match(name) is not None
+
+
+def _integer(text, default=NO_ID):
+	try:
+		return int(text)
+	except (TypeError, ValueError):
+		return default
+
+
+class ReceivedSeries():
+	"""Collects the received messages of one or more lunatest outputs."""
+	def __init__(self, join=False):
+		self.join = join
+		self.runs = []
+		# (SIN, MIN, Name) -> series number, and the other way round
+		self.series = {}
+		self.keys = []
+		# SIN, MIN and Name fields as found in a line -> series number, saves converting them for every message
+		self._fields = {}
+		self.lines = 0
+		self._chunks = []
+		self._pending = ([], [], [], [], [], [])
+		self._dump = None
+
+	def _series(self, sin, min_, name):
+		key = (_integer(sin), _integer(min_), name or UNNAMED)
+		number = self.series.get(key)
+		if number is None:
+			number = self.series[key] = len(self.keys)
+			self.keys.append(key)
+		return number
+
+	def _add(self, run, trace_time, message_id, utc, fields, payload):
+		runs, series, trace_times, utcs, ids, digests = self._pending
+		runs.append(run)
+		number = self._fields.get(fields)
+		if number is None:
+			found = dict(fields)
+			number = self._fields[fields] = self._series(found.get("SIN"), found.get("MIN"), found.get("Name"))
+		series.append(number)
+		trace_times.append(trace_time)
+		utcs.append(utc if utc and utc[0].isdigit() else "NaT")
+		ids.append(_integer(message_id))
+		# only compared within this process, the salted str hash will do
+		digests.append(hash(payload))
+		if len(runs) >= CHUNK_ROWS:
+			self._flush()
+
+	def _flush(self):
+		runs, series, trace_times, utcs, ids, digests = self._pending
+		if not runs:
+			return
+		trace_times = np.array(trace_times, dtype="datetime64[s]").astype(np.int64)
+		utcs = np.array(utcs, dtype="datetime64[s]").astype(np.int64)
+		self._chunks.append({
+			"run" : np.array(runs, dtype=np.int32),
+			"series" : np.array(series, dtype=np.int32),
+			# the gateway time of a message where the output has it
+			"time" : np.where(utcs != NO_TIME, utcs, trace_times),
+			"trace_time" : trace_times,
+			"id" : np.array(ids, dtype=np.int64),
+			"digest" : np.array(digests, dtype=np.int64),
+		})
+		self._pending = ([], [], [], [], [], [])
+
+	def _end_dump(self):
+		run, trace_time, message_id, utc, fields, payload = self._dump
+		self._dump = None
+		self._add(run, trace_time, message_id, utc, tuple(sorted(fields.items())), "".join(payload))
+
+	def feed(self, line, run):
+		if self._dump is not None:
+			# trace2: the tf.dump of the payload up to its closing brace
+			if line.startswith("}"):
+				self._end_dump()
+			else:
+				self._dump[5].append(line)
+				match = DUMP_FIELD_RE.match(line.rstrip("\r\n"))
+				if match:
+					self._dump[4][match.group(1)] = match.group(2)
+				return
+		# most lines of an output are something else, the substring test is the cheap way out
+		if "Received: " not in line:
+			return
+		match = RECEIVED_RE.match(line)
+		if not match:
+			return
+		trace_time, message_id, utc, payload = match.groups()
+		if payload.startswith("{"):
+			self._dump = (run, trace_time, message_id, utc, {}, [])
+			return
+		self._add(run, trace_time, message_id, utc, tuple(FIELD_RE.findall(payload)), payload)
+
+	def read(self, path):
+		run = 0 if self.join and self.runs else len(self.runs)
+		if not (self.join and self.runs):
+			self.runs.append(path)
+		with archive.open_text(path) as f:
+			for line in f:
+				self.lines += 1
+				self.feed(line, run)
+		if self._dump is not None:
+			self._end_dump()
+		return self
+
+	def columns(self):
+		"""Dict of equally long NumPy columns, sorted by run, series and time."""
+		self._flush()
+		if self._chunks:
+			columns = dict((key, np.concatenate([chunk[key] for chunk in self._chunks])) for key in self._chunks[0])
+		else:
+			columns = dict((key, np.zeros(0, dtype=np.int64)) for key in ("run", "series", "time", "trace_time", "id", "digest"))
+		# one array per column from now on, the chunks are not needed twice
+		self._chunks = [columns]
+		order = np.lexsort((columns["time"], columns["series"], columns["run"]))
+		return dict((key, column[order]) for key, column in columns.items())
+
+
+def _groups(columns):
+	"""Start and end row of every (run, series) group of sorted columns."""
+	run, series = columns["run"], columns["series"]
+	changes = np.flatnonzero((run[1:] != run[:-1]) | (series[1:] != series[:-1])) + 1
+	starts = np.concatenate(([0], changes)) if len(run) else np.zeros(0, dtype=np.int64)
+	ends = np.concatenate((changes, [len(run)])) if len(run) else np.zeros(0, dtype=np.int64)
+	return starts, ends
+
+
+def duplicates(columns):
+	"""Boolean column, true for a message received before: same ID, or without IDs the same payload at the same time."""
+	run, series, time, ids = columns["run"], columns["series"], columns["time"], columns["id"]
+	keys = np.where(ids != NO_ID, ids, columns["digest"])
+	# without an ID the time has to match too, with one it must not (a message polled again later is still the same)
+	times = np.where(ids != NO_ID, 0, time)
+	order = np.lexsort((time, times, keys, ids == NO_ID, series, run))
+	same = np.zeros(len(run), dtype=bool)
+	if len(run) > 1:
+		previous, current = order[:-1], order[1:]
+		same[current] = (run[current] == run[previous]) & (series[current] == series[previous]) & \
+			((ids[current] == NO_ID) == (ids[previous] == NO_ID)) & (keys[current] == keys[previous]) & (times[current] == times[previous])
+	return same
+
+
+def drift(intervals, interval, tolerance_max, tolerance_min):
+	"""DriftAnalyse:perform() of intervals. Returns (passed, cumulated difference after every interval)."""
+	cumulated = np.cumsum(np.asarray(intervals, dtype=np.float64) - interval)
+	final = cumulated[-1] if len(cumulated) else 0.0
+	return bool(tolerance_min <= final <= tolerance_max), cumulated
+
+
+def _percentiles(values):
+	if not len(values):
+		return dict((key, None) for key in ("min", "p50", "p90", "max"))
+	p50, p90 = np.percentile(values, (50, 90))
+	return {"min" : int(values.min()), "p50" : float(p50), "p90" : float(p90), "max" : int(values.max())}
+
+
+def analyse(received, expected=None, gap_factor=1.5, tolerance_max=2.0, tolerance_min=-2.0, gap_limit=10):
+	"""Summary of every series: counts, intervals, gaps, duplicates and for periodic reports their drift."""
+	expected = expected or {}
+	columns = received.columns()
+	repeated = duplicates(columns)
+	series_count = len(received.keys)
+	# duplicates do not make intervals, the first reception of a message does
+	unique = dict((key, column[~repeated]) for key, column in columns.items())
+	starts, ends = _groups(unique)
+	time = unique["time"]
+	summaries = []
+	for number, (sin, min_, name) in enumerate(received.keys):
+		summaries.append({"sin" : sin, "min" : min_, "name" : name, "periodic" : is_periodic(name),
+			"count" : 0, "duplicates" : 0, "runs" : [], "gaps" : [], "first" : None, "last" : None})
+	counts = np.bincount(columns["series"], minlength=series_count)
+	repeated_counts = np.bincount(columns["series"][repeated], minlength=series_count)
+	all_intervals = [[] for _ in range(series_count)]
+	for start, end in zip(starts, ends):
+		number = int(unique["series"][start])
+		summary = summaries[number]
+		times = time[start:end]
+		intervals = np.diff(times)
+		all_intervals[number].append(intervals)
+		summary["first"] = int(times[0]) if summary["first"] is None else min(summary["first"], int(times[0]))
+		summary["last"] = int(times[-1]) if summary["last"] is None else max(summary["last"], int(times[-1]))
+		if not len(intervals):
+			continue
+		nominal = float(expected.get(summary["name"], np.median(intervals)))
+		run = {"run" : received.runs[int(unique["run"][start])], "count" : len(times)}
+		# events come when they come, only periodic reports have an interval to miss or drift from
+		if summary["periodic"]:
+			missed = intervals > gap_factor * nominal
+			gaps = np.flatnonzero(missed)
+			summary["gaps"].extend((int(times[i]), int(intervals[i])) for i in gaps)
+			run.update({"interval" : nominal, "gaps" : len(gaps)})
+			kept = ~missed & (intervals >= nominal / gap_factor)
+			regular = intervals[kept]
+			passed, cumulated = drift(regular, nominal, tolerance_max, tolerance_min)
+			run["drift"] = float(cumulated[-1]) if len(cumulated) else 0.0
+			run["max_drift"] = float(np.abs(cumulated).max()) if len(cumulated) else 0.0
+			# change of the interval over the run, seconds per day: the drift builds up slowly or steadily
+			ends_of_intervals = times[1:][kept]
+			if len(regular) > 2 and ends_of_intervals[-1] > ends_of_intervals[0]:
+				run["trend"] = 0.0 + float(np.polyfit((ends_of_intervals - ends_of_intervals[0]) / 86400.0, regular, 1)[0])
+			else:
+				run["trend"] = 0.0
+			# with a configured interval a report sent at another (steady) interval is wrong too
+			off_interval = summary["name"] in expected and len(regular) and abs(float(np.median(regular)) - nominal) > tolerance_max
+			run["drifting"] = bool(not passed or off_interval)
+		summary["runs"].append(run)
+	for number, summary in enumerate(summaries):
+		summary["count"] = int(counts[number])
+		summary["duplicates"] = int(repeated_counts[number])
+		intervals = np.concatenate(all_intervals[number]) if all_intervals[number] else np.zeros(0, dtype=np.int64)
+		summary["intervals"] = _percentiles(intervals)
+		span = (summary["last"] - summary["first"]) if summary["first"] is not None else 0
+		summary["per_hour"] = (summary["count"] - summary["duplicates"]) * 3600.0 / span if span else None
+		summary["gap_count"] = len(summary["gaps"])
+		summary["gaps"] = sorted(summary["gaps"], key=lambda gap: -gap[1])[:gap_limit]
+		summary["drifting"] = any(run.get("drifting") for run in summary["runs"])
+	return summaries, unique
+
+
+def rates(unique, series_count, bucket_seconds):
+	"""(bucket start times, series x bucket counts) of the messages received in each time bucket."""
+	time = unique["time"]
+	if not len(time):
+		return np.zeros(0, dtype=np.int64), np.zeros((series_count, 0), dtype=np.int64)
+	first = time.min() - time.min() % bucket_seconds
+	buckets = (time - first) // bucket_seconds
+	bucket_count = int(buckets.max()) + 1
+	counts = np.bincount(unique["series"].astype(np.int64) * bucket_count + buckets, minlength=series_count * bucket_count)
+	return first + np.arange(bucket_count) * bucket_seconds, counts.reshape(series_count, bucket_count)
+
+
+def format_time(seconds):
+	if seconds is None:
+		return "-"
+	return str(np.datetime64(int(seconds), "s")).replace("T", " ")
+
+
+def _label(summary):
+	return "%s %s/%s" % (summary["name"], summary["sin"], summary["min"])
+
+
+def _value(value):
+	return "-" if value is None else ("%.1f" % value if isinstance(value, float) else str(value))
+
+
+def print_summary(received, summaries, starts, counts, rate_series, bucket_seconds):
+	print("%d line(s) of %d run(s), %d message(s) of %d kind(s)" % (received.lines, len(received.runs),
+		sum(summary["count"] for summary in summaries), len(summaries)))
+	print("%-32s %8s %6s %8s %7s %7s %7s %7s %6s" % ("message SIN/MIN", "count", "dups", "per h", "min", "p50", "p90", "max", "gaps"))
+	for summary in sorted(summaries, key=lambda s: (s["sin"], s["min"], s["name"])):
+		intervals = summary["intervals"]
+		print("%-32s %8d %6d %8s %7s %7s %7s %7s %6d" % (_label(summary), summary["count"], summary["duplicates"],
+			_value(summary["per_hour"]), _value(intervals["min"]), _value(intervals["p50"]), _value(intervals["p90"]),
+			_value(intervals["max"]), summary["gap_count"]))
+
+	periodic = [summary for summary in summaries if summary["periodic"]]
+	if periodic:
+		print("")
+		print("periodic reports: interval, cumulated drift (s), largest drift (s), interval trend (s/day)")
+		for summary in periodic:
+			for run in summary["runs"]:
+				if "drift" not in run:
+					continue
+				print("%-32s %-24s %7.1f %8.1f %8.1f %8.3f%s" % (_label(summary), os.path.basename(run["run"])[-24:], run["interval"],
+					run["drift"], run["max_drift"], run["trend"], "  DRIFTING" if run["drifting"] else ""))
+
+	gaps = [(start, length, summary) for summary in summaries for start, length in summary["gaps"]]
+	if gaps:
+		print("")
+		print("longest gaps")
+		for start, length, summary in sorted(gaps, key=lambda gap: -gap[1])[:20]:
+			print("%-20s %-32s %8d s" % (format_time(start), _label(summary), length))
+
+	if len(starts) and rate_series:
+		print("")
+		print("messages per %d min" % (bucket_seconds // 60))
+		print("%-20s %s" % ("from", " ".join("%12s" % summaries[number]["name"][:12] for number in rate_series)))
+		for column, start in enumerate(starts):
+			print("%-20s %s" % (format_time(start), " ".join("%12d" % counts[number, column] for number in rate_series)))
+
+
+def parse_expected(values):
+	"""Name=seconds arguments -> {name: seconds}."""
+	expected = {}
+	for value in values or []:
+		name, _, seconds = value.partition("=")
+		try:
+			expected[name] = float(seconds)
+		except ValueError:
+			raise Exception("Expected Name=seconds, got " + value)
+	return expected
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Time series of the return messages received in lunatest outputs.")
+	parser.add_argument("outputs", nargs="+", help="Lunatest output files, or .gz/.zst archives of them, in time order")
+	parser.add_argument("--join", action="store_true", help="The outputs are parts of one run, take intervals across them")
+	parser.add_argument("--interval", action="append", metavar="NAME=SECONDS", help="Expected interval of a periodic report, e.g. StandardReport1=900; default is its median interval")
+	parser.add_argument("--gapfactor", type=float, default=1.5, help="An interval this many times the expected one is a gap")
+	parser.add_argument("--tolmax", type=float, default=2.0, help="Largest allowed cumulated drift in seconds")
+	parser.add_argument("--tolmin", type=float, default=-2.0, help="Smallest allowed cumulated drift in seconds")
+	parser.add_argument("--bucket", type=int, default=60, help="Minutes per bucket of the rate over time view")
+	parser.add_argument("--rates", choices=("periodic", "all", "none"), default="periodic", help="Series shown in the rate over time view")
+	parser.add_argument("--json", help="Writes the summaries and rates to this file as well")
+	args = parser.parse_args()
+
+	received = ReceivedSeries(args.join)
+	for path in args.outputs:
+		received.read(path)
+	summaries, unique = analyse(received, parse_expected(args.interval), args.gapfactor, args.tolmax, args.tolmin)
+	starts, counts = rates(unique, len(summaries), args.bucket * 60)
+	rate_series = [number for number, summary in enumerate(summaries)
+		if args.rates == "all" or (args.rates == "periodic" and summary["periodic"])]
+	print_summary(received, summaries, starts, counts, rate_series, args.bucket * 60)
+	if args.json:
+		with open(args.json, "w") as f:
+			json.dump({"runs" : received.runs, "series" : summaries, "rates" : {
+				"starts" : [format_time(start) for start in starts],
+				"counts" : dict((_label(summaries[number]), counts[number].tolist()) for number in range(len(summaries))),
+			}}, f, indent=1)
+	sys.exit(1 if any(summary["drifting"] for summary in summaries) else 0)
@@ -0,0 +1,69 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import history
+
+
+def record_run(timing_history, suite, durations, wall_seconds=None, selection=None, result="PASS"):
+	"""Records one run of suite with {test: seconds}, as TestRunner.py does while parsing."""
+	run_id = timing_history.start_run("fw", "0", "test", selection)
+	for test, seconds in durations.items():
+		timing_history.record(run_id, suite, {"name" : test, "result" : result, "time" : str(seconds)})
+	timing_history.finish_run(run_id, [suite], wall_seconds)
+	return run_id
+
+
+class TestEstimates(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.history = history.TimingHistory(os.path.join(self.directory.name, "history.db"))
+
+	def tearDown(self):
+		self.history.close()
+		self.directory.cleanup()
+
+	def test_no_history(self):
+		self.assertEqual(self.history.test_estimates(), {})
+		self.assertEqual(self.history.suite_estimates(), {})
+		self.assertEqual(self.history.failed_tests(), [])
+
+	def test_median_of_latest_window(self):
+		for seconds in (100.0, 100.0, 1.0, 2.0, 3.0, 4.0, 5.0):
+			record_run(self.history, "TestA", {"test_One" : seconds})
+		# the two oldest runs are outside the window of 5
+		self.assertEqual(self.history.test_estimates(), {("TestA", "test_One") : 3.0})
+		self.assertEqual(self.history.test_estimates(window=2), {("TestA", "test_One") : 4.5})
+
+	def test_partial_history(self):
+		# a selective run (-t) times one test, its wall time is not the suite's
+		record_run(self.history, "TestA", {"test_One" : 2.0, "test_Two" : 3.0}, wall_seconds=8.0)
+		record_run(self.history, "TestA", {"test_One" : 4.0}, wall_seconds=5.0, selection="test_One")
+		self.assertEqual(self.history.test_estimates(), {("TestA", "test_One") : 3.0, ("TestA", "test_Two") : 3.0})
+		# suite setup and teardown show in the wall time of the whole suite run only
+		self.assertEqual(self.history.suite_estimates(), {"TestA" : 8.0})
+
+	def test_new_tests_and_suites(self):
+		record_run(self.history, "TestA", {"test_One" : 2.0})
+		record_run(self.history, "TestA", {"test_One" : 2.0, "test_New" : 1.0})
+		record_run(self.history, "TestB", {"test_Other" : 0.5})
+		estimates = self.history.test_estimates()
+		self.assertEqual(estimates[("TestA", "test_New")], 1.0)
+		self.assertEqual(self.history.suite_estimates(), {"TestA" : 3.0, "TestB" : 0.5})
+
+	def test_removed_tests_drop_out(self):
+		record_run(self.history, "TestA", {"test_Gone" : 9.0, "test_One" : 1.0})
+		self.history.connection.execute("UPDATE results SET recorded = recorded - ? WHERE test = 'test_Gone'",
+			((history.RECENT_DAYS + 1) * 86400,))
+		self.assertEqual(self.history.test_estimates(), {("TestA", "test_One") : 1.0})
+
+	def test_failed_tests_use_latest_result(self):
+		record_run(self.history, "TestA", {"test_One" : 1.0, "test_Two" : 1.0}, result="FAIL")
+		record_run(self.history, "TestA", {"test_One" : 1.0})
+		self.assertEqual(self.history.failed_tests(), [("TestA", "test_Two", "FAIL")])
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,196 @@
+import io
+import os
+import sys
+import tempfile
+import unittest
+import xml.etree.ElementTree as ET
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import junitmerge
+
+# shard 1 of TestSuiteA on instance 10
+SHARD_1 = """<?xml version="1.0" encoding="utf-8"?>
+<testsuites name="VMS Feature Tests">
+	<testsuite name="TestSuiteA">
+		<testcase name="Group: When One - Passes" classname="TestSuiteA" time="1.5">
+			<properties>
+				<property name="test" value="test_Group_WhenOne_Passes" />
+				<property name="instance" value="10" />
+			</properties>
+		</testcase>
+		<testcase name="Group: When Flaky - Passes" classname="TestSuiteA" time="2.0">
+			<properties>
+				<property name="test" value="test_Group_WhenFlaky_Passes" />
+				<property name="instance" value="10" />
+			</properties>
+			<failure message="timeout waiting for message" />
+			<system-out>first run output</system-out>
+		</testcase>
+		<testcase name="Group: When Broken - Fails" classname="TestSuiteA" time="0.5">
+			<properties>
+				<property name="test" value="test_Group_WhenBroken_Fails" />
+				<property name="instance" value="10" />
+			</properties>
+			<failure message="wrong value" />
+		</testcase>
+	</testsuite>
+</testsuites>
+"""
+
+# shard 2 of TestSuiteA and TestSuiteB, written without instance properties
+SHARD_2 = """<?xml version="1.0" encoding="utf-8"?>
+<testsuites name="VMS Feature Tests">
+	<testsuite name="TestSuiteA">
+		<testcase name="Group: When Two - Passes" classname="TestSuiteA" time="3.0">
+			<properties>
+				<property name="test" value="test_Group_WhenTwo_Passes" />
+			</properties>
+		</testcase>
+		<testcase name="Group: When Skipped - Skips" classname="TestSuiteA" time="0.0">
+			<properties>
+				<property name="test" value="test_Group_WhenSkipped_Skips" />
+			</properties>
+			<skipped />
+		</testcase>
+	</testsuite>
+	<testsuite name="TestSuiteB">
+		<testcase name="test_Other_WhenRun_Errors" classname="TestSuiteB" time="0.25">
+			<error message="attempt to index a nil value" />
+		</testcase>
+	</testsuite>
+</testsuites>
+"""
+
+# rerun of the failed tests on instance 11
+RERUN = """<?xml version="1.0" encoding="utf-8"?>
+<testsuites name="VMS Feature Tests">
+	<testsuite name="TestSuiteA">
+		<testcase name="Group: When Flaky - Passes" classname="TestSuiteA" time="2.5">
+			<properties>
+				<property name="test" value="test_Group_WhenFlaky_Passes" />
+				<property name="instance" value="11" />
+			</properties>
+		</testcase>
+		<testcase name="Group: When Broken - Fails" classname="TestSuiteA" time="0.5">
+			<properties>
+				<property name="test" value="test_Group_WhenBroken_Fails" />
+				<property name="instance" value="11" />
+			</properties>
+			<failure message="wrong value again" />
+			<system-out>rerun output</system-out>
+		</testcase>
+	</testsuite>
+	<testsuite name="TestSuiteB">
+		<testcase name="test_Other_WhenRun_Errors():" classname="TestSuiteB" time="0.25">
+			<error message="attempt to index a nil value" />
+		</testcase>
+	</testsuite>
+</testsuites>
+"""
+
+
+class TestJUnitMerge(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.paths = []
+		for name, content in (("result_1.xml", SHARD_1), ("result_2.xml", SHARD_2), ("result_rerun.xml", RERUN)):
+			path = os.path.join(self.directory.name, name)
+			with open(path, "w", encoding="utf-8") as f:
+				f.write(content)
+			self.paths.append(path)
+		self.output = os.path.join(self.directory.name, "merged.xml")
+
+	def tearDown(self):
+		self.directory.cleanup()
+
+	def merge(self, paths, policy=junitmerge.LAST):
+		merger, totals = junitmerge.merge_files(paths, self.output, policy)
+		root = ET.parse(self.output).getroot()
+		cases = {}
+		for suite in root.iter("testsuite"):
+			for case in suite.iter("testcase"):
+				name = junitmerge.case_property(case, "test") or junitmerge.lunatest_name(case.get("name"))
+				cases[(suite.get("name"), name)] = case
+		return merger, totals, root, cases
+
+	def test_shards_become_one_suite(self):
+		merger, totals, root, cases = self.merge(self.paths[:2])
+		self.assertEqual(merger.duplicates, 0)
+		self.assertEqual(totals[:4], (6, 2, 1, 1))
+		suites = dict((suite.get("name"), suite) for suite in root.iter("testsuite"))
+		self.assertEqual(sorted(suites), ["TestSuiteA", "TestSuiteB"])
+		self.assertEqual([suites["TestSuiteA"].get(name) for name in ("tests", "failures", "errors", "skipped", "time")],
+			["5", "2", "0", "1", "7.000"])
+		self.assertEqual(root.get("tests"), "6")
+		# test cases without instance property tell which file they came from
+		self.assertEqual(junitmerge.case_property(cases[("TestSuiteA", "test_Group_WhenTwo_Passes")], "source"), "result_2.xml")
+		self.assertIsNone(junitmerge.case_property(cases[("TestSuiteA", "test_Group_WhenOne_Passes")], "source"))
+
+	def test_last_run_wins(self):
+		merger, totals, root, cases = self.merge(self.paths)
+		self.assertEqual(merger.duplicates, 3)
+		self.assertEqual(totals[:4], (6, 1, 1, 1))
+		flaky = cases[("TestSuiteA", "test_Group_WhenFlaky_Passes")]
+		self.assertEqual(junitmerge.case_result(flaky), "PASS")
+		self.assertIsNone(flaky.find("flakyFailure"))
+
+	def test_flaky_policy(self):
+		merger, totals, root, cases = self.merge(self.paths, junitmerge.FLAKY)
+		self.assertEqual(merger.duplicates, 3)
+		# the flaky test counts as passed, the broken one and the error still count
+		self.assertEqual(totals[:4], (6, 1, 1, 1))
+		flaky = cases[("TestSuiteA", "test_Group_WhenFlaky_Passes")]
+		self.assertEqual(junitmerge.case_result(flaky), "PASS")
+		self.assertEqual(junitmerge.case_property(flaky, junitmerge.RERUN_PROPERTY), junitmerge.FLAKY)
+		self.assertEqual(junitmerge.case_property(flaky, "instance"), "11")
+		failure = flaky.find("flakyFailure")
+		self.assertEqual(failure.get("message"), "timeout waiting for message")
+		self.assertEqual(failure.find("system-out").text, "first run output")
+
+		broken = cases[("TestSuiteA", "test_Group_WhenBroken_Fails")]
+		self.assertEqual(junitmerge.case_result(broken), "FAIL")
+		self.assertEqual(broken.find("failure").get("message"), "wrong value")
+		self.assertEqual(broken.find("rerunFailure").get("message"), "wrong value again")
+		self.assertEqual(junitmerge.case_property(broken, junitmerge.RERUN_PROPERTY), junitmerge.STILL_FAILING)
+
+		# "name():", as lunatest names an erroring test, is the same test
+		errors = [case for (suite, name), case in cases.items() if suite == "TestSuiteB"]
+		self.assertEqual(len(errors), 1)
+		self.assertIsNotNone(errors[0].find("rerunError"))
+
+	def test_flaky_then_failing_again_stays_flaky(self):
+		again = os.path.join(self.directory.name, "result_rerun2.xml")
+		with open(again, "w", encoding="utf-8") as f:
+			f.write(SHARD_1)
+		merger, totals, root, cases = self.merge(self.paths + [again], junitmerge.FLAKY)
+		flaky = cases[("TestSuiteA", "test_Group_WhenFlaky_Passes")]
+		self.assertEqual(junitmerge.case_result(flaky), "PASS")
+		self.assertEqual(len(flaky.findall("flakyFailure")), 2)
+
+	def test_output_among_inputs(self):
+		junitmerge.merge_files(self.paths[:2], self.output)
+		pattern = os.path.join(self.directory.name, "*.xml")
+		# a wildcard does not pick up the earlier merged report
+		self.assertNotIn(self.output, junitmerge.expand([pattern], self.output))
+		merger, totals, root, cases = self.merge([self.output, self.paths[2]], junitmerge.FLAKY)
+		self.assertEqual(totals[0], 6)
+
+	def test_truncated_file_keeps_what_was_read(self):
+		path = os.path.join(self.directory.name, "result_cut.xml")
+		with open(path, "w", encoding="utf-8") as f:
+			f.write(SHARD_1[:SHARD_1.index("<testcase name=\"Group: When Broken")])
+		merger = junitmerge.JUnitMerger()
+		sys.stdout, stdout = io.StringIO(), sys.stdout
+		try:
+			merger.add_file(path)
+		finally:
+			sys.stdout = stdout
+		self.assertEqual(merger.cases, 2)
+
+	def test_unknown_policy(self):
+		with self.assertRaises(Exception):
+			junitmerge.JUnitMerger("first")
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,150 @@
+import io
+import os
+import sys
+import tempfile
+import unittest
+import xml.etree.ElementTree as ET
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import testoutparse
+
+SAMPLE = """Lua modules loaded
+*** VMS Feature Tests Started ***
+-- Starting suite "TestSuiteA", 4 test(s)
+[STARTING]: test_Group_WhenPassing_Passes
+trace of the passing test
+PASS: test_Group_WhenPassing_Passes (120ms)
+[STARTING]: test_Group_WhenFailing_Fails
+FAIL: test_Group_WhenFailing_Fails (35ms): Expected 1 but was 2
+[STARTING]: test_Group_WhenSkipped_Skips
+SKIP: test_Group_WhenSkipped_Skips - service not installed
+[STARTING]: test_Group_WhenBroken_Errors
+ERROR in test_Group_WhenBroken_Errors():
+TestFramework.lua:100: attempt to index a nil value
+stack traceback:
+	TestFramework.lua:100: in function 'send'
+    Finished suite "TestSuiteA", +1 -1 E1 s1
+-- Starting suite "TestSuiteB", 1 test(s)
+[STARTING]: test_Other_WhenRun_Passes
+PASS: test_Other_WhenRun_Passes (7ms)
+    Finished suite "TestSuiteB", +1 -0 E0 s0
+PASS: test_Group_WhenPassing_Passes (120ms)
+"""
+
+# lua killed in the middle of the second test
+TRUNCATED = """*** VMS Feature Tests Started ***
+-- Starting suite "TestSuiteA", 3 test(s)
+[STARTING]: test_Group_WhenPassing_Passes
+PASS: test_Group_WhenPassing_Passes (120ms)
+[STARTING]: test_Group_WhenKilled_HasNoResult
+last trace line before the end
+"""
+
+
+def parse(text, output=None, **kwargs):
+	output = output if output is not None else io.StringIO()
+	received = []
+	parser = testoutparse.TestOutputParser(testoutparse.JUnitWriter(output, **kwargs),
+		listener=lambda suite, test_case: received.append((suite, test_case["name"], test_case["result"])))
+	for line in io.StringIO(text):
+		parser.feed(line)
+	parser.close()
+	return output.getvalue(), received
+
+
+def cases(document):
+	"""{lunatest name: testcase element} of a JUnit document."""
+	return dict((case.get("name"), case) for case in ET.fromstring(document).iter("testcase"))
+
+
+class TestClassifyLine(unittest.TestCase):
+	def test_kinds(self):
+		self.assertEqual(testoutparse.classify_line("*** Name Started ***\n"), (testoutparse.TEST_START, "Name"))
+		self.assertEqual(testoutparse.classify_line('-- Starting suite "S", 2 test(s)\n'), (testoutparse.SUITE_START, "S"))
+		self.assertEqual(testoutparse.classify_line('    Finished suite "S", +2\n'), (testoutparse.SUITE_END, "S"))
+		self.assertEqual(testoutparse.classify_line("[STARTING]: test_A\n"), (testoutparse.TEST_CASE_START, "test_A"))
+		self.assertEqual(testoutparse.classify_line("\n"), (testoutparse.TRACE, None))
+
+	def test_fail_with_and_without_time(self):
+		kind, test_case = testoutparse.classify_line("FAIL: test_A (20ms): a: b\n")
+		self.assertEqual((kind, test_case["name"], test_case["time"], test_case["msg"]), (testoutparse.TEST_CASE, "test_A", "0.02", "a: b"))
+		kind, test_case = testoutparse.classify_line("FAIL: test_A: message\n")
+		self.assertEqual((test_case["name"], test_case["time"], test_case["msg"]), ("test_A", "0.0", "message"))
+
+
+class TestJUnitOutput(unittest.TestCase):
+	def test_results(self):
+		document, received = parse(SAMPLE)
+		found = cases(document)
+		self.assertEqual(len(found), 5)
+		passing = found["Group: When Passing - Passes"]
+		self.assertIsNone(passing.find("failure"))
+		self.assertEqual(passing.get("time"), "0.12")
+		self.assertEqual(found["Group: When Failing - Fails"].find("failure").get("message"), "Expected 1 but was 2")
+		self.assertIsNotNone(found["Group: When Skipped - Skips"].find("skipped"))
+		self.assertIn("service not installed", found["Group: When Skipped - Skips"].find("system-out").text)
+		# the summary repeated after the last suite belongs to no test case
+		self.assertEqual([result for _, _, result in received], ["PASS", "FAIL", "SKIP", "ERROR", "PASS"])
+
+	def test_multi_line_error_trace(self):
+		document, _ = parse(SAMPLE)
+		case = cases(document)["Group: When Broken - Errors"]
+		self.assertIsNotNone(case.find("error"))
+		output = case.find("system-out").text
+		self.assertIn("attempt to index a nil value", output)
+		self.assertIn("in function 'send'", output)
+		# suite end lines are no trace
+		self.assertNotIn("Finished suite", output)
+
+	def test_suite_counts(self):
+		document, _ = parse(SAMPLE)
+		suites = dict((suite.get("name"), suite) for suite in ET.fromstring(document).iter("testsuite"))
+		self.assertEqual([suites["TestSuiteA"].get(name) for name in testoutparse.SUITE_COUNTS], ["4", "1", "1", "1"])
+		self.assertEqual([suites["TestSuiteB"].get(name) for name in testoutparse.SUITE_COUNTS], ["1", "0", "0", "0"])
+
+	def test_truncated_run(self):
+		document, received = parse(TRUNCATED)
+		case = cases(document)["Group: When Killed - Has No Result"]
+		self.assertEqual(case.find("error").get("message"), testoutparse.NO_RESULT_MESSAGE)
+		self.assertIn("last trace line before the end", case.find("system-out").text)
+		self.assertIsNone(case.get("time"))
+		suite = ET.fromstring(document).find("testsuite")
+		self.assertEqual((suite.get("tests"), suite.get("errors")), ("2", "1"))
+		# no duration is recorded for it
+		self.assertEqual(received, [("TestSuiteA", "test_Group_WhenPassing_Passes", "PASS")])
+
+	def test_keep_valid_file(self):
+		with tempfile.TemporaryDirectory() as directory:
+			path = os.path.join(directory, "result.xml")
+			with open(path, "w", encoding="utf-8") as output:
+				parser = testoutparse.TestOutputParser(testoutparse.JUnitWriter(output, keep_valid=True))
+				for line in io.StringIO(TRUNCATED):
+					parser.feed(line)
+					# complete after every line, as a crashed run leaves it
+					ET.parse(path)
+				parser.close()
+			with open(path, encoding="utf-8") as f:
+				found = cases(f.read())
+			self.assertEqual(sorted(found), ["Group: When Killed - Has No Result", "Group: When Passing - Passes"])
+
+	def test_trace_limit(self):
+		buffer = testoutparse.TraceBuffer(limit=20)
+		for number in range(10):
+			buffer.append("line %d" % number)
+		text = buffer.text()
+		self.assertTrue(text.startswith("... 8 trace line(s) truncated ...\n"))
+		self.assertTrue(text.endswith("line 8\nline 9\n"))
+
+	def test_testcase_without_suite(self):
+		with self.assertRaises(testoutparse.ParseError):
+			parse("*** Started ***\n[STARTING]: test_A\n")
+
+	def test_invalid_xml_characters(self):
+		document, _ = parse('*** Started ***\n-- Starting suite "S"\n[STARTING]: test_A\nbinary \x01 <&>\nFAIL: test_A (1ms): "quoted" \x02\n')
+		case = cases(document)["test_A"]
+		self.assertEqual(case.find("failure").get("message"), '"quoted" ?')
+		self.assertIn("binary ? <&>", case.find("system-out").text)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -1,238 +1,431 @@
 import re
-import xml.etree.cElementTree as ET
 import argparse
 import sys
+import collections
+from xml.sax.saxutils import escape, quoteattr
+
+# line kinds returned by classify_line
+TEST_START = "start"
+SUITE_START = "suite_start"
+SUITE_END = "suite_end"
+TEST_CASE_START = "test_case_start"
+TEST_CASE = "test_case"
+TRACE = "trace"
+
+TEST_START_RE = re.compile(r'\*\*\*(.*)Started.*\*\*\*')
+SUITE_START_RE = re.compile(r'-- Starting suite "(.*)"')
+SUITE_END_RE = re.compile(r'Finished suite "(.+?)"')
+TEST_CASE_START_RE = re.compile(r'\[STARTING\]: (.*)')
+# FAIL lines come with or without time, the first alternative wins when time is present
+FAIL_RE = re.compile(r'FAIL: (?:(.*) \((.*)ms\): (.*)|(.*): (.*))')
+PASS_RE = re.compile(r'PASS: (.*) \((.*)ms\)')
+SKIP_RE = re.compile(r'SKIP: (.*) - (.*)')
+ERROR_RE = re.compile(r'ERROR in (.*)')
+
+def _test_case(result, name, time, msg):
+	return  {
+			"result" : result,
+			"name" : name,
+			"time" : str(float(time)/1000),
+			"msg" : msg,
+			}
+
+def _match_test_case(line):
+	first = line[:1]
+	if first == "P" and line.startswith("PASS: "):
+		match = PASS_RE.match(line)
+		if match:
+			return _test_case("PASS", match.group(1), match.group(2), "")
+		return _test_case("PASS", "Problem with parsing PASS output", "0.0", line[6:].rstrip("\n"))
+	if first == "F" and line.startswith("FAIL: "):
+		match = FAIL_RE.match(line)
+		if match:
+			if match.group(1) is not None:
+				return _test_case("FAIL", match.group(1), match.group(2), match.group(3))
+			return _test_case("FAIL", match.group(4), "0.0", match.group(5))
+		return _test_case("FAIL", "Problem with parsing FAIL output", "0.0", line[6:].rstrip("\n"))
+	if first == "S" and line.startswith("SKIP: "):
+		match = SKIP_RE.match(line)
+		if match:
+			return _test_case("SKIP", match.group(1), "0.0", match.group(2))
+		return _test_case("SKIP", "Problem with parsing SKIP output", "0.0", line[6:].rstrip("\n"))
+	if first == "E" and line.startswith("ERROR in "):
+		return _test_case("ERROR", ERROR_RE.match(line).group(1), "0.0", "")
+	return None
+
+def classify_line(line):
+	"""Returns (kind, value) of a lunatest output line in a single pass. Value is None for lines carrying nothing."""
+	first = line[:1]
+	if first == "*":
+		match = TEST_START_RE.match(line)
+		if match:
+			return TEST_START, match.group(1).strip()
+	elif first == "-":
+		match = SUITE_START_RE.match(line)
+		if match:
+			return SUITE_START, match.group(1)
+	if 'Finished suite "' in line:
+		match = SUITE_END_RE.search(line)
+		if match:
+			return SUITE_END, match.group(1)
+	if first == "[" and line.startswith("[STARTING]: "):
+		return TEST_CASE_START, TEST_CASE_START_RE.match(line).group(1)
+	if first in "PFSE":
+		test_case = _match_test_case(line)
+		if test_case:
+			return TEST_CASE, test_case
+	trace = line.rstrip()
+	return TRACE, trace or None
 
 def find_test_start(line):
-	match = re.match('\*\*\*(.*)Started.*\*\*\*', line)
+	match = TEST_START_RE.match(line)
 	if match:
-		test_suites["name"] = match.group(1).strip()
-		test_suites["suites"] = {}
-		return True
+		return match.group(1).strip()
 	return None
 	
 def find_test_suite_start(line):
-	match = re.match('-- Starting suite \"(.*)\".*', line)
+	match = SUITE_START_RE.match(line)
 	if match:
-		suite_name = match.group(1)
-		test_suites["suites"][suite_name] = []
-		return suite_name
+		return match.group(1)
+	return None
+
+def find_test_suite_end(line):
+	match = SUITE_END_RE.search(line)
+	if match:
+		return match.group(1)
 	return None
 
 def find_test_case_start(line):
-	match = re.match('\[STARTING\]: (.*)', line)
+	match = TEST_CASE_START_RE.match(line)
 	if match:
 		return match.group(1)
 	else:
 		return None
 	
 def find_test_case(line):
-	match = re.match('(FAIL|PASS|SKIP): (.*)', line)
-	if match:
-		result = match.group(1)
-		result_line = match.group(2)
-		
-		if result == "FAIL":
-			try:
-				#result contains time
-				match = re.match('(.*) \((.*)ms\): (.*)', result_line)			
-				name = match.group(1)
-				time = match.group(2)
-				msg = match.group(3)
-			except:
-				#result does not containt time
-				match = re.match('(.*): (.*)', result_line)
-				time = "0.0"
-				if match:
-					name = match.group(1)
-					msg = match.group(2)
-				else:
-					name = "Problem with parsing FAIL output"
-					msg = result_line
-				
-		elif result == "PASS":
-			try:
-				match = re.match('(.*) \((.*)ms\)', result_line)			
-				msg = ""
-				time = match.group(2)
-				name = match.group(1)
-			except:
-				msg = result_line
-				time = "0.0"
-				name = "Problem with parsing PASS output"
-				
-		elif result == "SKIP":
-			time = "0.0"
-			try:
-				match = re.match('(.*) - (.*)', result_line)
-				msg = match.group(2)
-				name = match.group(1)
-			except:
-				name = "Problem with parsing SKIP output"
-				msg = result_line
-		
-	
-		return  {
-				"result" : result, 
-				"name" : name, 
-				"time" : str(float(time)/1000),
-				"msg" : msg,
-				}
-	
-	match = re.match('ERROR in (.*)', line)
-	if match:
-		return  {
-				"result" : "ERROR", 
-				"name" : match.group(1), 
-				"time" : "0.0",
-				"msg" : "",
-				}
-	return None
+	return _match_test_case(line)
 
 def find_trace(line):
-	match = re.search('.*Finished suite \"(.+?)\"', line)
-	if not match:
+	if not SUITE_END_RE.search(line):
 		return line.rstrip()
 	return None
-	
-def create_xml(data):
-	xml_test_suites = ET.Element("testsuites")
-	xml_test_suites.set("name", test_suites["name"])
-	
-	for test_suite_name, test_suite_data in test_suites["suites"].items():
-		xml_test_suite = ET.SubElement(xml_test_suites, "testsuite")
-		xml_test_suite.set("name", test_suite_name)
-		
-		for test_case in test_suite_data:
-			xml_test_case = ET.SubElement(xml_test_suite, "testcase")
-			xml_test_case_std = None
-			try:
-				tokens = test_case["name"].split("_")
-				test_group = tokens[1]
-				test_condition = " ".join(re.findall("[A-Z][^A-Z]*", tokens[2]))
-				test_expected_result = " ".join(re.findall("[A-Z][^A-Z]*", tokens[3]))
-				test_case_name = "%s: %s - %s" % (test_group, test_condition, test_expected_result)
-			except:
-				test_case_name = test_case["name"]
-			xml_test_case.set("name", test_case_name)
-			#no idea why next line failed. test_case["time"] should never be none
-			try:
-				xml_test_case.set("time", test_case["time"])
-			except:
-				pass
-			
-			if test_case["result"] == "FAIL":
-				xml_test_case_failure = ET.SubElement(xml_test_case, "failure")
-				xml_test_case_failure.set("message", test_case["msg"])
-			
-			if test_case["result"] == "SKIP":
-				xml_test_case_skip = ET.SubElement(xml_test_case, "skipped")
-				xml_test_case_std = ET.SubElement(xml_test_case, "system-out")
-				xml_test_case_std.text = test_case["msg"]
-			
-			if test_case["result"] == "ERROR":
-				xml_test_case_failure = ET.SubElement(xml_test_case, "error")
-				xml_test_case_failure.set("message", test_case["msg"])
-				
-			if "trace" in test_case:
-				try:
-					xml_test_case_std.text =  xml_test_case_std.text + "\n" + test_case["trace"]
-				except:
-					xml_test_case_std = ET.SubElement(xml_test_case, "system-out")
-					xml_test_case_std.text = test_case["trace"]
-			
-	return xml_test_suites
-	
 
-#----------------------
-test_suites = {}
-	
-parser = argparse.ArgumentParser(description='Creates an JUnity style XML from lunatest output.')
-parser.add_argument('--source', default=None)
-parser.add_argument('--result', default=None)
-parser.add_argument('--log', default=None)
-parser.add_argument('--verbose', default=False, action="store_true")
-args = parser.parse_args()
-all_data = ""
-if args.source:
-	data = open(args.source)
-else:
-	data = sys.stdin
-
-#find tests starting point
-for line in data:
-	if args.verbose:
-		print(line.strip())
-	all_data = all_data + line
-	if find_test_start(line):
-		break
-
-current_test_case_data = None
-current_suite = None
-		
-#parse test cases results
-for line in data:
-	all_data = all_data + line
-	new_suite = find_test_suite_start(line)
-	if new_suite:
-		if current_test_case_data:
-			test_suites["suites"][current_suite].append(current_test_case_data)
-		current_suite = new_suite
-		current_test_case_data = None
-		continue
-	
-	test_case_start = find_test_case_start(line)
-	if test_case_start:
-		if not current_suite:
-			print("Found testcase but no testsuite detected in first place. Parser source seems malformed")
-			sys.exit(-1)
-		if current_test_case_data:
-			test_suites["suites"][current_suite].append(current_test_case_data)
-		current_test_case_data = {}
-		current_test_case_data["name"] = test_case_start
-		current_test_case_data["trace"] = ""
-		continue
-			
-	test_case = find_test_case(line)
-	if test_case:
-		current_test_case_data["result"] = test_case["result"]
-		current_test_case_data["time"] = test_case["time"]
-		current_test_case_data["msg"] = test_case["msg"]
-		continue
+CAPITALIZED_WORD_RE = re.compile("[A-Z][^A-Z]*")
+
+def junit_case_name(name):
+	# test_Group_WhenCondition_ExpectedResult -> "Group: When Condition - Expected Result"
+	try:
+		tokens = name.split("_")
+		test_group = tokens[1]
+		test_condition = " ".join(CAPITALIZED_WORD_RE.findall(tokens[2]))
+		test_expected_result = " ".join(CAPITALIZED_WORD_RE.findall(tokens[3]))
+		return "%s: %s - %s" % (test_group, test_condition, test_expected_result)
+	except:
+		return name
+
+# characters which are not allowed in XML 1.0 documents
+INVALID_XML_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+def xml_text(text):
+	return escape(INVALID_XML_CHARS.sub("?", text))
+
+def xml_attr(text):
+	return quoteattr(INVALID_XML_CHARS.sub("?", text))
+
+
+# testcase property holding the lunatest test name
+TEST_NAME_PROPERTY = "test"
+# testcase properties telling which simulator instance (and its web services port) ran the test
+INSTANCE_PROPERTY = "instance"
+PORT_PROPERTY = "port"
+# message of a test case the run ended in before lunatest printed its result (lua died or was killed)
+NO_RESULT_MESSAGE = "no result: run ended during the test"
+# testsuite attributes counted over its test cases, and the digits kept free for each of them
+SUITE_COUNTS = ("tests", "failures", "errors", "skipped")
+COUNT_DIGITS = 6
+
+
+class ParseError(Exception):
+	pass
+
+
+class TraceBuffer():
+	"""Collects trace lines of one test case, keeping only the last `limit` characters."""
+	def __init__(self, limit=None):
+		self.limit = limit
+		self.lines = collections.deque()
+		self.size = 0
+		self.dropped = 0
+
+	def append(self, line):
+		self.lines.append(line)
+		self.size += len(line) + 1
+		if self.limit:
+			while self.size > self.limit and len(self.lines) > 1:
+				self.size -= len(self.lines.popleft()) + 1
+				self.dropped += 1
+
+	def __len__(self):
+		return len(self.lines)
+
+	def text(self):
+		text = "\n".join(self.lines) + "\n"
+		if self.dropped:
+			text = "... %d trace line(s) truncated ...\n" % self.dropped + text
+		return text
+
+
+class JUnitWriter():
+	"""Writes JUnit XML incrementally, one <testcase> at a time.
 	
-	trace = find_trace(line)
-	if trace:
-		if current_test_case_data:
-			current_test_case_data["trace"] = current_test_case_data["trace"] + trace + "\n"
-
-if current_test_case_data:
-	if not current_suite:
-		print("Found testcase but no testsuite detected in first place. Parser source seems malformed")
-		sys.exit(-1)
-	test_suites["suites"][current_suite].append(current_test_case_data)
-			
-try:
-	xml_data = create_xml(test_suites)		
-except:
-	print("*** EXCEPTION IN CREATING XML ***")
-	print("Unexpected error:", sys.exc_info()[0])
-	print("*** RECEIVED DATA ***")
-	print(all_data)
-	print("*** END OF RECEIVED DATA ***")
-	raise
+	With keep_valid the closing tags are written after every element and
+	overwritten by the next one, so the (seekable) output is always a
+	complete document even if the run is interrupted.
+	The properties ([(name, value)]) are written for every test case, e.g. the
+	instance that ran them.
+	On a seekable output the <testsuite> tag gets SUITE_COUNTS, rewritten in
+	place (padded to a fixed length) after every test case.
+	"""
+	def __init__(self, output, keep_valid=False, properties=None):
+		self.output = output
+		self.keep_valid = keep_valid
+		self.properties = list(properties or [])
+		self.started = False
+		self.suite_open = False
+		self.suite_name = None
+		self.suite_position = None
+		self.counts = None
+		self.tail_position = None
+		if keep_valid:
+			# empty document until the lunatest start marker shows up
+			self.output.write('<?xml version="1.0" encoding="utf-8"?>\n<testsuites />\n')
+			self.output.flush()
+			self.tail_position = 0
+
+	def _write(self, data):
+		if self.tail_position is not None:
+			self.output.seek(self.tail_position)
+		self.output.write(data)
+		if self.keep_valid:
+			self.tail_position = self.output.tell()
+			if self.suite_open:
+				self.output.write('\t</testsuite>\n')
+			self.output.write('</testsuites>\n')
+			self.output.truncate()
+			self.output.flush()
+
+	def start(self, name):
+		self._write('<?xml version="1.0" encoding="utf-8"?>\n<testsuites name=%s>\n' % xml_attr(name))
+		self.started = True
+
+	def start_suite(self, name):
+		self.end_suite()
+		self.suite_open = True
+		self.suite_name = name
+		self.counts = dict.fromkeys(SUITE_COUNTS, 0)
+		self.suite_position = None
+		if self.output.seekable():
+			self.suite_position = self.tail_position if self.tail_position is not None else self.output.tell()
+		self._write(self._suite_tag())
+
+	def _suite_tag(self):
+		if self.suite_position is None:
+			return '\t<testsuite name=%s>\n' % xml_attr(self.suite_name)
+		counts = "".join(' %s="%d"' % (name, self.counts[name]) for name in SUITE_COUNTS)
+		padding = len(SUITE_COUNTS) * COUNT_DIGITS - sum(len(str(self.counts[name])) for name in SUITE_COUNTS)
+		return '\t<testsuite name=%s%s%s>\n' % (xml_attr(self.suite_name), counts, " " * padding)
+
+	def _count(self, result):
+		self.counts["tests"] += 1
+		if result in ("FAIL", "ERROR", "SKIP"):
+			self.counts[SUITE_COUNTS[("FAIL", "ERROR", "SKIP").index(result) + 1]] += 1
+		if self.suite_position is not None:
+			position = self.output.tell()
+			self.output.seek(self.suite_position)
+			self.output.write(self._suite_tag())
+			self.output.seek(position)
+			self.output.flush()
+
+	def end_suite(self):
+		if self.suite_open:
+			self.suite_open = False
+			self._write('\t</testsuite>\n')
+
+	def test_case(self, test_case):
+		out = ['\t\t<testcase name=%s' % xml_attr(junit_case_name(test_case["name"]))]
+		if self.suite_name is not None:
+			out.append(' classname=%s' % xml_attr(self.suite_name))
+		if test_case.get("time") is not None:
+			out.append(' time=%s' % xml_attr(test_case["time"]))
+		out.append('>\n')
+		# the lunatest name is kept as is, the readable name above can not be turned back into it (e.g. to rerun the test)
+		properties = [(TEST_NAME_PROPERTY, test_case["name"])] + self.properties + list(test_case.get("properties") or [])
+		out.append('\t\t\t<properties>\n')
+		for name, value in properties:
+			out.append('\t\t\t\t<property name=%s value=%s />\n' % (xml_attr(name), xml_attr(str(value))))
+		out.append('\t\t\t</properties>\n')
+
+		result = test_case.get("result")
+		system_out = []
+		if result == "FAIL":
+			out.append('\t\t\t<failure message=%s />\n' % xml_attr(test_case["msg"]))
+		elif result == "SKIP":
+			out.append('\t\t\t<skipped />\n')
+			system_out.append(test_case["msg"])
+		elif result == "ERROR":
+			out.append('\t\t\t<error message=%s />\n' % xml_attr(test_case["msg"]))
+
+		if test_case.get("trace"):
+			system_out.append(test_case["trace"])
+		if system_out:
+			out.append('\t\t\t<system-out>%s</system-out>\n' % xml_text("\n".join(system_out)))
+		out.append('\t\t</testcase>\n')
+		self._write("".join(out))
+		if self.suite_open:
+			self._count(result)
+
+	def close(self):
+		if not self.started:
+			self.start("")
+		self.end_suite()
+		self.keep_valid = False
+		self._write('</testsuites>\n')
+		if self.tail_position is not None:
+			self.output.truncate()
+		self.output.flush()
+
+
+class TestOutputParser():
+	"""Line driven lunatest output parser. Completed test cases are handed to the writer straight away.
 	
-if args.log:
-	try:
-		lunates_out = open(args.log, 'w')
-		lunates_out.write(all_data)
-		lunates_out.close()
-	except Exception as e:
-		print(e)
-		print("Failed to save lunatest log " +args.log)
+	The optional listener is called with (suite name, test case) as soon as a test result line is parsed.
+	"""
+	def __init__(self, writer, trace_limit=None, listener=None):
+		self.writer = writer
+		self.trace_limit = trace_limit
+		self.listener = listener
+		self.started = False
+		self.current_suite = None
+		self.current_test_case_data = None
 
-if args.result:
-	tree = ET.ElementTree(xml_data)
-	tree.write(args.result)
-else:
-	print (ET.tostring(xml_data, 'utf-8'))
+	def _finish_test_case(self):
+		if self.current_test_case_data:
+			test_case = self.current_test_case_data
+			if "result" not in test_case:
+				# [STARTING] without PASS/FAIL/SKIP/ERROR: lua died or the run was killed during the test
+				test_case.update({"result" : "ERROR", "time" : None, "msg" : NO_RESULT_MESSAGE})
+			trace = test_case["trace"]
+			test_case["trace"] = trace.text() if len(trace) else ""
+			self.writer.test_case(test_case)
+		self.current_test_case_data = None
 
+	def feed(self, line):
+		kind, value = classify_line(line)
+		#find tests starting point
+		if not self.started:
+			if kind == TEST_START:
+				self.writer.start(value)
+				self.started = True
+			return
+
+		if kind == TRACE:
+			if value and self.current_test_case_data:
+				self.current_test_case_data["trace"].append(value)
+
+		elif kind == TEST_CASE_START:
+			if not self.current_suite:
+				raise ParseError("Found testcase but no testsuite detected in first place. Parser source seems malformed")
+			self._finish_test_case()
+			self.current_test_case_data = {
+				"name" : value,
+				"trace" : TraceBuffer(self.trace_limit),
+			}
+
+		elif kind == TEST_CASE:
+			# results repeated in the summary after the last suite do not belong to any test case
+			if self.current_test_case_data is None:
+				return
+			self.current_test_case_data["result"] = value["result"]
+			self.current_test_case_data["time"] = value["time"]
+			self.current_test_case_data["msg"] = value["msg"]
+			if self.listener:
+				self.listener(self.current_suite, self.current_test_case_data)
+
+		elif kind == SUITE_START:
+			self._finish_test_case()
+			self.current_suite = value
+			self.writer.start_suite(value)
+
+		elif kind == SUITE_END:
+			self._finish_test_case()
+			self.writer.end_suite()
+
+	def close(self):
+		if self.current_test_case_data and not self.current_suite:
+			raise ParseError("Found testcase but no testsuite detected in first place. Parser source seems malformed")
+		self._finish_test_case()
+		self.writer.close()
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Creates an JUnity style XML from lunatest output.')
+	parser.add_argument('--source', default=None)
+	parser.add_argument('--result', default=None)
+	parser.add_argument('--log', default=None)
+	parser.add_argument('--verbose', default=False, action="store_true")
+	parser.add_argument('--tracelimit', default=65536, type=int, help="Maximum number of trace characters kept per test case, 0 for no limit")
+	parser.add_argument('--history', default=None, help="SQLite database the test durations are added to (see history.py)")
+	parser.add_argument('--firmware', default=None, help="Firmware revision recorded with the durations")
+	parser.add_argument('--instance', default=None, help="Simulator instance recorded with the durations and as a property of every test case")
+	args = parser.parse_args()
+
+	if args.source:
+		data = open(args.source, errors="replace")
+	else:
+		data = sys.stdin
+
+	lunatest_out = None
+	if args.log:
+		try:
+			lunatest_out = open(args.log, 'w')
+		except Exception as e:
+			print(e)
+			print("Failed to save lunatest log " +args.log)
+
+	if args.result:
+		result = open(args.result, 'w', encoding="utf-8")
+	else:
+		result = sys.stdout
+
+	listener = None
+	if args.history:
+		import history
+		timing_history = history.TimingHistory(args.history)
+		run_id = timing_history.start_run(args.firmware, args.instance, args.source or "stdin")
+		suites = []
+		def listener(suite, test_case):
+			if suite not in suites:
+				suites.append(suite)
+			timing_history.record(run_id, suite, test_case)
+
+	properties = [(INSTANCE_PROPERTY, args.instance)] if args.instance is not None else []
+	output_parser = TestOutputParser(JUnitWriter(result, properties=properties), trace_limit=args.tracelimit, listener=listener)
+	try:
+		for line in data:
+			if args.verbose and not output_parser.started:
+				print(line.strip())
+			if lunatest_out:
+				lunatest_out.write(line)
+			output_parser.feed(line)
+		output_parser.close()
+	except ParseError as e:
+		print(e)
+		sys.exit(-1)
+	finally:
+		if args.history:
+			timing_history.finish_run(run_id, suites)
+			timing_history.close()
+		if lunatest_out:
+			lunatest_out.close()
+		if args.result:
+			result.close()
@@ -1,13 +1,57 @@
 import argparse
+import heapq
+import io
 import subprocess
 import time
 import os
+import threading
+import queue
+import socket
+import json
+import math
+import urllib.parse
+import urllib.request
+import urllib.error
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "OutputParser"))
+import testoutparse
+import junitmerge
+import history
+import discovery
+import impact
+import rerun
+import resources
+import serialbridge
+
+GATEWAY_SUFFIX = "/GLGW/GWServices_v1/RestMessages.svc"
+GATEWAY_STAND_IN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Gateway", "gateway.py")
+# with the gateway stand-in on 8000+N the simulator web services move to 9000+N behind it
+SIMULATOR_PORT_OFFSET = 1000
+
+
+def instance_port(instance):
+	return 8000 + int(instance)
+
+
+def web_service_ready(url):
+	# any HTTP answer, even an error status, means the web service is listening
+	try:
+		urllib.request.urlopen(url, timeout=2).close()
+	except urllib.error.HTTPError:
+		pass
+	except (urllib.error.URLError, socket.error):
+		return False
+	return True
+
 
 class ModemSimulator():
 	def __init__(self, path, com_port):
 		self.path = path
 		self.default_options()
 		self.process = None
+		# serialbridge.SerialBridge on RS232MainPort, closed with the simulator
+		self.serial_bridge = None
 		try:
 			self.com_port = int(com_port)
 		except:
@@ -53,8 +97,8 @@ class ModemSimulator():
 			#"OptionsFile" : "filename", #Read options from file (one option per line, no "--" prefix)
 		}
 		
-	def set_instance(self, instance):
-		port = str(8000 + int(instance))
+	def set_instance(self, instance, port=None):
+		port = str(port or instance_port(instance))
 		
 		
 		new_options = {
@@ -94,22 +138,207 @@ class ModemSimulator():
 	def run(self):
 		if not self.process:
 			params = self.build_args()
+			self.start_time = time.time()
 			self.process = subprocess.Popen([self.path] + params)
 		else:
 			raise Exception("Already running")
+	
+	def probe_urls(self):
+		urls = []
+		gateway = self.options.get("GatewayURL")
+		if gateway:
+			urls.append(gateway + GATEWAY_SUFFIX + "/info_utc_time.json/")
+		for key in ("GpsURL", "DeviceURL"):
+			url = self.options.get(key)
+			if url and url.startswith("http"):
+				urls.append(url)
+		return urls
+	
+	def _probe(self, url):
+		return web_service_ready(url)
+	
+	def wait_until_ready(self, timeout=60):
+		"""Polls simulator web services with backoff and returns the measured startup time in seconds."""
+		if not self.process:
+			raise Exception("Readiness check while not running")
+		pending = self.probe_urls()
+		delay = 0.05
+		while True:
+			if self.process.poll() is not None:
+				raise Exception("Modem simulator exited with code %s during startup" % self.process.returncode)
+			pending = [url for url in pending if not self._probe(url)]
+			elapsed = time.time() - self.start_time
+			if not pending:
+				return elapsed
+			if elapsed > timeout:
+				raise Exception("Modem simulator not ready after %ds, no answer from: %s" % (timeout, ", ".join(pending)))
+			time.sleep(delay)
+			delay = min(delay * 1.5, 0.5)
 			
 	def close(self):
+		if self.serial_bridge:
+			self.serial_bridge.close()
+			self.serial_bridge = None
 		if self.process:
 			self.process.kill()
 		else:
 			raise Exception("Kill attempt while not running")
 
 
+class GatewayProcess():
+	"""Runs Tools/Gateway/gateway.py in front of a simulator and restarts it when it dies.
+
+	record appends the traffic to a file, replay answers from one instead of a simulator (Tools/Gateway/traffic.py).
+	"""
+	def __init__(self, port, upstream=None, record=None, replay=None, speed=0):
+		self.port = port
+		self.upstream = upstream
+		self.record = record
+		self.replay = replay
+		self.speed = speed
+		self.process = None
+		
+	def run(self):
+		if self.process and self.process.poll() is None:
+			raise Exception("Already running")
+		command = [sys.executable, GATEWAY_STAND_IN, "--port", str(self.port)]
+		if self.upstream:
+			command += ["--upstream", self.upstream]
+		if self.record:
+			command += ["--record", self.record]
+		if self.replay:
+			command += ["--replay", self.replay, "--speed", str(self.speed)]
+		self.start_time = time.time()
+		self.process = subprocess.Popen(command)
+	
+	def wait_until_ready(self, timeout=60):
+		# a gateway request would end up in the recording, or take an answer from it
+		if self.record or self.replay:
+			url = "http://localhost:%d/Replay/status.json/" % self.port
+		else:
+			url = "http://localhost:%d%s/info_utc_time.json/" % (self.port, GATEWAY_SUFFIX)
+		delay = 0.05
+		while not web_service_ready(url):
+			if self.process.poll() is not None:
+				raise Exception("Gateway stand-in exited with code %s during startup" % self.process.returncode)
+			if time.time() - self.start_time > timeout:
+				raise Exception("Gateway stand-in not ready after %ds" % timeout)
+			time.sleep(delay)
+			delay = min(delay * 1.5, 0.5)
+		return time.time() - self.start_time
+	
+	def ensure_running(self, timeout=60):
+		if self.process.poll() is not None:
+			print("Gateway stand-in on port %d exited with code %s, restarting" % (self.port, self.process.returncode))
+			self.run()
+			self.wait_until_ready(timeout)
+	
+	def close(self):
+		if self.process and self.process.poll() is None:
+			self.process.kill()
+			self.process.wait()
+
+
+class PoolLease():
+	"""An instance leased from a simpool.py daemon, in place of a simulator started for this run."""
+	def __init__(self, pool_url, client, timeout=600):
+		self.pool_url = pool_url.rstrip("/")
+		self.client = client
+		self.timeout = timeout
+		self.id = None
+		
+	def acquire(self):
+		start = time.time()
+		query = urllib.parse.urlencode({"client" : self.client, "timeout" : self.timeout})
+		try:
+			with urllib.request.urlopen(self.pool_url + "/lease?" + query, timeout=self.timeout + 30) as response:
+				leased = json.loads(response.read().decode("utf-8"))
+		except urllib.error.HTTPError as e:
+			raise Exception("No instance leased from %s: %s" % (self.pool_url, e.read().decode("utf-8", "replace")))
+		self.id = leased["lease"]
+		self.instance = leased["instance"]
+		self.gateway = leased["gateway"]
+		# pids of the pool's processes, it runs on this host
+		self.processes = leased.get("processes", {})
+		self.serial = leased.get("serial")
+		print("Leased instance %s in %.2fs (lease %d of %d since its start, which took %.1fs)" % (
+			self.instance, time.time() - start, leased["leases"], leased["max_leases"], leased["boot_time"] or 0))
+		return self
+	
+	def release(self):
+		if self.id is None:
+			return
+		try:
+			urllib.request.urlopen(self.pool_url + "/release?lease=%d" % self.id, timeout=30).close()
+		except (urllib.error.URLError, socket.error) as e:
+			print("Lease %d not released: %s" % (self.id, e))
+		self.id = None
+
+
+def start_instance(args, instance, com_port=None, record=None):
+	"""Starts the simulator of an instance, and the gateway stand-in in front of it with --gateway.
+
+	record is the traffic file the gateway stand-in appends to (--record).
+	Returns (modem simulator, gateway stand-in or None) once their web services answer.
+	"""
+	modemsim = ModemSimulator(args.modemsim, com_port=com_port)
+	modemsim.update_options({"DefaultDirectory" : args.firmwaredir,})
+	gateway = None
+	if args.gateway:
+		simulator_port = instance_port(instance) + SIMULATOR_PORT_OFFSET
+		modemsim.set_instance(instance, simulator_port)
+		gateway = GatewayProcess(instance_port(instance), "http://localhost:%d" % simulator_port, record=record)
+	else:
+		modemsim.set_instance(instance)
+	if getattr(args, "serialbridge", None):
+		# ModemSimulator.exe outside Windows runs through Wine, which needs a COM port name
+		wine = sys.platform != "win32" and args.modemsim.lower().endswith(".exe")
+		modemsim.serial_bridge = serialbridge.SerialBridge(instance, args.serialbridge, instance_output(args.serialcapture, instance),
+			args.serialcom, wine).start()
+		modemsim.update_options({"RS232MainPort" : modemsim.serial_bridge.simulator_port})
+	try:
+		modemsim.run()
+		startup = modemsim.wait_until_ready(args.readytimeout)
+		if gateway:
+			gateway.run()
+			gateway.wait_until_ready(args.readytimeout)
+	except:
+		if modemsim.process:
+			modemsim.close()
+		elif modemsim.serial_bridge:
+			# the simulator did not start, the bridge would keep its ptys and the TCP port of the instance
+			modemsim.serial_bridge.close()
+			modemsim.serial_bridge = None
+		if gateway:
+			gateway.close()
+		raise
+	print("Instance %s ready in %.2fs" % (instance, startup))
+	return modemsim, gateway
+
+
 class TestRunner():
-	def __init__(self, luapath = "lua.exe", test_output=None, com_port=None):
+	def __init__(self, luapath = "lua.exe", test_output=None, com_port=None, result=None, trace_limit=None, long_poll=None,
+			history=None, firmware=None, resource_log=None, resource_interval=1.0, record=False, replay_speed=None):
 		self.luapath = luapath
 		self.default_args()
 		self.test_output = test_output
+		self.result = result
+		self.trace_limit = trace_limit
+		self.history = history
+		self.firmware = firmware
+		self.instance = None
+		self.timing_history = None
+		self.resource_log = resource_log
+		self.resource_interval = resource_interval
+		# label -> pid of the processes sampled besides lua
+		self.watched = {}
+		self.sampler = None
+		if long_poll:
+			self.args["longpoll"] = str(long_poll)
+		if record:
+			self.args["marktests"] = ""
+		if replay_speed is not None:
+			self.args["replay"] = str(replay_speed)
 		try:
 			self.com_port = int(com_port)
 		except:
@@ -126,12 +355,28 @@ class TestRunner():
 		}
 	
 	def set_instance(self, instance):
-		port = str(8000 + int(instance))
+		self.instance = instance
+		port = str(instance_port(instance))
 		self.args["p"] = port
 		if self.com_port:
 			comport = "COM" + str(self.com_port)
 			self.args["com"] = comport
 	
+	def set_serial_port(self, name):
+		"""Serial port name handed to RunAllModules.lua -com, e.g. the test end of a serial bridge."""
+		if name:
+			self.args["com"] = name
+	
+	def case_properties(self):
+		"""JUnit properties of every test case telling where it ran, so merged reports still show it."""
+		if self.instance is None:
+			return []
+		return [(testoutparse.INSTANCE_PROPERTY, str(self.instance)), (testoutparse.PORT_PROPERTY, self.args.get("p"))]
+	
+	def watch_process(self, label, pid):
+		if pid:
+			self.watched[label] = pid
+	
 	def _build_item(self, key, value):
 		if value==None:
 			return None
@@ -150,50 +395,504 @@ class TestRunner():
 	
 	def run(self):
 		args = self.build_args()
-		if self.test_output:
+		if self.result or self.history or self.resource_log:
+			self.process = self.run_live([self.luapath] + args)
+		elif self.test_output:
 			output = open(self.test_output, "w")
 			self.process = subprocess.call([self.luapath] + args, cwd=self.test_env, stdout=output)
 			output.close()
 		else:
 			self.process = subprocess.call([self.luapath] + args, cwd=self.test_env)
 	
+	def report_progress(self, suite, test_case):
+		if self.sampler:
+			test_case["properties"] = self.sampler.test_case(suite, test_case)
+		if self.timing_history:
+			if suite not in self.suites:
+				self.suites.append(suite)
+			self.timing_history.record(self.run_id, suite, test_case)
+		print("[%s] %s: %s (%.2fs)" % (self.args.get("p"), test_case["result"], test_case["name"], float(test_case["time"])))
+		sys.stdout.flush()
+	
+	def run_live(self, command):
+		"""Runs lua with stdout piped through the lunatest output parser, keeping the JUnit result valid during the run.
+		
+		With a history database every test duration is recorded in it, together with the wall time of the run.
+		With a resource log the simulator and lua processes are sampled, every test case gets the summary as properties.
+		"""
+		result = open(self.result, "w", encoding="utf-8") if self.result else io.StringIO()
+		output = open(self.test_output, "w") if self.test_output else None
+		if self.history:
+			self.timing_history = history.TimingHistory(self.history)
+			self.run_id = self.timing_history.start_run(self.firmware, self.instance, "TestRunner",
+				self.args.get("tl") or self.args.get("t"))
+			self.suites = []
+		start = time.time()
+		writer = testoutparse.JUnitWriter(result, keep_valid=bool(self.result), properties=self.case_properties())
+		output_parser = testoutparse.TestOutputParser(writer, trace_limit=self.trace_limit, listener=self.report_progress)
+		process = subprocess.Popen(command, cwd=self.test_env, stdout=subprocess.PIPE, universal_newlines=True, errors="replace")
+		if self.resource_log:
+			if resources.available():
+				self.sampler = resources.ResourceSampler(self.resource_log, self.resource_interval)
+				for label, pid in self.watched.items():
+					self.sampler.watch(label, pid)
+				self.sampler.watch("lua", process.pid)
+				self.sampler.start()
+			else:
+				print("Resource sampling needs /proc or the psutil module, %s not written" % self.resource_log)
+		parsing = True
+		try:
+			for line in process.stdout:
+				if output:
+					output.write(line)
+					output.flush()
+				if parsing:
+					try:
+						output_parser.feed(line)
+					except testoutparse.ParseError as e:
+						print(e)
+						parsing = False
+			return process.wait()
+		finally:
+			if process.poll() is None:
+				process.kill()
+			try:
+				output_parser.close()
+			except testoutparse.ParseError as e:
+				print(e)
+			result.close()
+			if output:
+				output.close()
+			if self.sampler:
+				self.sampler.close()
+				self.sampler = None
+			if self.timing_history:
+				self.timing_history.finish_run(self.run_id, self.suites, time.time() - start)
+				self.timing_history.close()
+				self.timing_history = None
+	
 
-argparser = argparse.ArgumentParser()
-argparser.add_argument("--modemsim", help="Specifies path to IDP Modem Simulator", required=True)
-argparser.add_argument("--firmwaredir", help="Specifies path firmware directory", required=True)
-argparser.add_argument("--instance", help="Specifies instance number of simulator", default="0")
-argparser.add_argument("--suite", help="Specifies a test suite to run")
-argparser.add_argument("--test", help="Specifies a test name to run")
-argparser.add_argument("--testoutput", help="Specifies a test output file")
-argparser.add_argument("--comportA", help="Specifies com port. E.g 200 ", default=None)
-argparser.add_argument("--comportB", help="Specifies com port. E.g 201 ", default=None)
+# estimate for tests without history when planning shards
+DEFAULT_TEST_SECONDS = 60
+
+# suites registered in RunAllModules.lua, used when no suite is given in parallel mode
+ALL_SUITES = [
+	"TestNormalReportsModule",
+	"TestCommonReportModule",
+	"TestAbnormalReportsModule",
+	"TestGeofenceModule",
+	"TestHelmPanelModule",
+	"TestSmtpModule",
+	"TestShellModule",
+	"TestPop3Module",
+	"TestMainModule",
+]
+
+
+def instance_output(test_output, name):
+	# log.txt -> log_<name>.txt so that parallel runs do not overwrite each other
+	if not test_output:
+		return None
+	root, ext = os.path.splitext(test_output)
+	return root + "_" + name + ext
+
+
+class ParallelRunner():
+	def __init__(self, args, instances):
+		self.args = args
+		self.instances = instances
+		self.work = queue.Queue()
+		self.lock = threading.Lock()
+		self.results = []
+		# work item name -> (suite, test names) of shards holding part of a suite
+		self.shards = {}
+		
+	def add_work(self, name, suite=None, tests=None):
+		if tests:
+			self.shards[name] = (suite, tests)
+		self.work.put(name)
+		
+	def _run_suite(self, instance, name, processes, serial_port=None):
+		suite, tests = self.shards.get(name, (name, None))
+		test_runner = TestRunner(
+			test_output=instance_output(self.args.testoutput, name),
+			result=instance_output(self.args.result, name),
+			trace_limit=self.args.tracelimit,
+			long_poll=self.args.longpoll,
+			history=self.args.history,
+			firmware=firmware_revision(self.args),
+			resource_log=instance_output(self.args.resources, name),
+			resource_interval=self.args.resourceinterval,
+			record=bool(self.args.record))
+		test_runner.set_instance(instance)
+		for label, pid in processes.items():
+			test_runner.watch_process(label, pid)
+		test_runner.set_serial_port(serial_port)
+		test_runner.args["s"] = suite
+		test_runner.args["t"] = self.args.test
+		if tests:
+			test_runner.args["tl"] = ",".join(tests)
+		start = time.time()
+		test_runner.run()
+		with self.lock:
+			print("Instance %s finished %s in %.1fs (exit code %s)" % (instance, name, time.time() - start, test_runner.process))
+			self.results.append((instance, name, test_runner.process))
+	
+	def _next_suite(self):
+		try:
+			return self.work.get_nowait()
+		except queue.Empty:
+			return None
+	
+	def _worker(self, instance):
+		# one recording per instance, the marks of tests running side by side would interleave
+		modemsim, gateway = start_instance(self.args, instance, record=instance_output(self.args.record, instance))
+		try:
+			suite = self._next_suite()
+			while suite:
+				if gateway:
+					gateway.ensure_running(self.args.readytimeout)
+				self._run_suite(instance, suite, instance_processes(modemsim, gateway), serial_port(modemsim))
+				suite = self._next_suite()
+		finally:
+			modemsim.close()
+			if gateway:
+				gateway.close()
+	
+	def _pool_worker(self, worker):
+		# every suite gets its own lease, so the pool resets the instance in between
+		suite = self._next_suite()
+		while suite:
+			lease = lease_instance(self.args, "TestRunner %d/%s" % (os.getpid(), worker))
+			try:
+				self._run_suite(lease.instance, suite, lease.processes, lease.serial)
+			finally:
+				lease.release()
+			suite = self._next_suite()
+	
+	def run(self):
+		threads = []
+		for instance in self.instances:
+			thread = threading.Thread(target=self._pool_worker if self.args.pool else self._worker, args=(instance,))
+			thread.start()
+			threads.append(thread)
+		for thread in threads:
+			thread.join()
+		return self.results
+
+
+def instance_processes(modemsim, gateway):
+	"""{label: pid} of the processes of an instance, for resource sampling."""
+	processes = {"modemsim" : modemsim.process.pid}
+	if gateway and gateway.process:
+		processes["gateway"] = gateway.process.pid
+	return processes
+
+
+def serial_port(modemsim):
+	return modemsim.serial_bridge.tests_port if modemsim.serial_bridge else None
+
+
+def lease_instance(args, client):
+	lease = PoolLease(args.pool, client, args.leasetimeout).acquire()
+	if args.longpoll and not lease.gateway:
+		lease.release()
+		raise Exception("--longpoll needs a pool started with --gateway")
+	return lease
+
+
+def run_single(args):
+	if args.replay:
+		gateway = GatewayProcess(instance_port(args.instance), replay=args.replay, speed=args.replayspeed)
+		gateway.run()
+		gateway.wait_until_ready(args.readytimeout)
+		instance, close, processes, serial = args.instance, gateway.close, {"gateway" : gateway.process.pid}, None
+	elif args.pool:
+		lease = lease_instance(args, "TestRunner %d" % os.getpid())
+		instance, close, processes, serial = lease.instance, lease.release, lease.processes, lease.serial
+	else:
+		modemsim, gateway = start_instance(args, args.instance, com_port=args.comportB, record=args.record)
+		instance, processes, serial = args.instance, instance_processes(modemsim, gateway), serial_port(modemsim)
+		def close():
+			modemsim.close()
+			if gateway:
+				gateway.close()
+	test_runner = TestRunner(test_output=args.testoutput, com_port=args.comportA, result=args.result, trace_limit=args.tracelimit,
+		long_poll=args.longpoll, history=args.history, firmware=firmware_revision(args),
+		resource_log=args.resources, resource_interval=args.resourceinterval, record=bool(args.record),
+		replay_speed=args.replayspeed if args.replay else None)
+	test_runner.set_instance(instance)
+	for label, pid in processes.items():
+		test_runner.watch_process(label, pid)
+	test_runner.set_serial_port(serial)
+
+	test_runner.args["s"] = args.suite
+	test_runner.args["t"] = args.test
+
+	try:
+		test_runner.run()
+	finally:
+		close()
+
+
+def firmware_revision(args):
+	if args.firmware:
+		return args.firmware
+	return os.path.basename(os.path.normpath(args.firmwaredir)) if args.firmwaredir else None
+
+
+def lpt_order(items, estimates, workers):
+	"""Longest processing time first: items by decreasing estimate, unknown ones first as they may be the longest.
+	
+	Returns (ordered items, predicted makespan, total estimated work) for workers taking the next item when they get free.
+	"""
+	known = [estimates[item] for item in items if item in estimates]
+	unknown = max(known) if known else 0
+	ordered = sorted(items, key=lambda item: (item in estimates, -estimates.get(item, unknown)))
+	loads = [0.0] * workers
+	for item in ordered:
+		heapq.heapreplace(loads, loads[0] + estimates.get(item, unknown))
+	return ordered, max(loads), sum(estimates.get(item, unknown) for item in items)
+
+
+def plan_shards(suites, workers, suite_estimates, test_estimates, discovered):
+	"""Splits suites estimated above half an instance's share of the work into per-test shards.
+	
+	Tests that have to stay together (discovery.test_groups) are packed into shards longest first.
+	Every shard also pays the suite's own overhead (lua start, suite_setup), taken from the history as
+	the suite wall time not covered by its tests. Returns ([(name, suite, tests or None)], {name: estimate}).
+	"""
+	known = sorted(test_estimates.values())
+	default = known[len(known) // 2] if known else DEFAULT_TEST_SECONDS
+	totals, groups, overheads = {}, {}, {}
+	for suite in suites:
+		tests = discovered[suite]["tests"] if suite in discovered else []
+		groups[suite] = [(sum(test_estimates.get((suite, name), default) for name in group), group)
+			for group in discovery.test_groups(discovered[suite])] if tests else []
+		tests_total = sum(estimate for estimate, group in groups[suite])
+		totals[suite] = suite_estimates.get(suite, tests_total)
+		overheads[suite] = max(totals[suite] - tests_total, 0)
+	share = sum(totals.values()) / float(workers)
+	items, estimates = [], {}
+	for suite in suites:
+		count = min(len(groups[suite]), workers, int(math.ceil(2 * totals[suite] / share)) if share else 1)
+		if count < 2:
+			items.append((suite, suite, None))
+			estimates[suite] = totals[suite]
+			continue
+		shards = [(0.0, index, []) for index in range(count)]
+		for estimate, group in sorted(groups[suite], key=lambda item: -item[0]):
+			load, index, tests = heapq.heappop(shards)
+			heapq.heappush(shards, (load + estimate, index, tests + group))
+		for load, index, tests in sorted(shards, key=lambda shard: shard[1]):
+			name = "%s-%d" % (suite, index + 1)
+			items.append((name, suite, tests))
+			estimates[name] = load + overheads[suite]
+	return items, estimates
+
+
+def test_root():
+	return os.environ.get("WORKSPACE") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+
+
+def run_parallel(args, items=None):
+	"""Runs suites (or the given [(name, suite, tests or None)] work items) across --parallel instances.
+	
+	Returns the exit code of the run: 1 when a work item's lua exited non-zero or did not run at all, else 0.
+	"""
+	if args.suite:
+		suites = [suite.strip() for suite in args.suite.split(",") if suite.strip()]
+	else:
+		suites = ALL_SUITES
+	suite_estimates, test_estimates = {}, {}
+	if args.history and os.path.exists(args.history):
+		timing_history = history.TimingHistory(args.history)
+		suite_estimates = timing_history.suite_estimates()
+		test_estimates = timing_history.test_estimates()
+		timing_history.close()
+	if items is not None:
+		estimates = {}
+		for name, suite, tests in items:
+			if not tests and suite in suite_estimates:
+				estimates[name] = suite_estimates[suite]
+			elif tests and all((suite, test) in test_estimates for test in tests):
+				estimates[name] = sum(test_estimates[(suite, test)] for test in tests)
+	elif args.shard:
+		items, estimates = plan_shards(suites, args.parallel, suite_estimates, test_estimates, discovery.discover(test_root()))
+	else:
+		items, estimates = [(suite, suite, None) for suite in suites], suite_estimates
+	# with --pool these only name the workers, the instances come with the leases
+	instances = [str(int(args.instance) + i) for i in range(min(args.parallel, len(items)))]
+	names, makespan, total = lpt_order([name for name, suite, tests in items], estimates, len(instances))
+	if total:
+		for name in names:
+			print("  %-32s %s" % (name, "%.0fs" % estimates[name] if name in estimates else "no history"))
+		print("Longest first on %d instance(s): predicted %.0fs, total work %.0fs (%.0fs per instance)" % (
+			len(instances), makespan, total, total / len(instances)))
+	elif args.history:
+		print("No timing history for these suites yet, they run in the given order")
+	runner = ParallelRunner(args, instances)
+	work = dict((name, (suite, tests)) for name, suite, tests in items)
+	for name in names:
+		runner.add_work(name, *work[name])
+	start = time.time()
+	results = runner.run()
+	print("Ran %d work item(s) on %d instance(s) in %.1fs" % (len(results), len(instances), time.time() - start))
+	failed = sorted(name for instance, name, code in results if code)
+	# a worker whose instance did not start leaves its work items unrun
+	missing = sorted(set(names) - set(name for instance, name, code in results))
+	if failed:
+		print("Lua exited non-zero for %s" % ", ".join(failed))
+	if missing:
+		print("Not run: %s" % ", ".join(missing))
+	if args.result:
+		paths = [path for path in (instance_output(args.result, name) for name in names) if os.path.exists(path)]
+		merger, totals = junitmerge.merge_files(paths, args.result)
+		# the shards of a suite hold different tests, a duplicate means a test ran in two of them
+		print("Merged %d result file(s) into %s: %d test(s), %d failure(s), %d error(s), %d skipped%s" % ((len(paths), args.result) + totals[:4] +
+			(", %d test case(s) found more than once" % merger.duplicates if merger.duplicates else "",)))
+	return 1 if failed or missing else 0
+
+
+def run_changed(args):
+	"""Runs the tests the changes since --changed can affect (impact.py), whole suites or the selected tests of them.
+	
+	Returns the exit code of run_parallel, 0 when nothing is affected.
+	"""
+	start = time.time()
+	graph = impact.load_graph(test_root())
+	selection, reasons, notes = impact.select(graph, impact.git_changes(test_root(), args.changed))
+	for note in notes:
+		print(note)
+	# suites not run by RunAllModules.lua are left out
+	items = [item for item in impact.work_items(selection) if item[1] in ALL_SUITES]
+	print("Changes since %s select %d test(s) of %d suite(s) in %.0fms" % (args.changed,
+		sum(len(tests) if tests else len(graph.suites[suite]["tests"]) for name, suite, tests in items), len(items), (time.time() - start) * 1000))
+	for name, suite, tests in items:
+		if suite in reasons:
+			print("  %s: %s" % (suite, " <- ".join(reasons[suite])))
+		for test in tests or []:
+			if (suite, test) in reasons:
+				print("  %s.%s: %s" % (suite, test, " <- ".join(reasons[(suite, test)])))
+	if not items:
+		return 0
+	return run_parallel(args, items)
 
-args = argparser.parse_args()
 
-if (args.comportA and args.comportB) or (args.comportA != args.comportB):
-	pass
-else:
-	args.comportA = None
-	args.comportB = None
+def run_rerun(args):
+	"""Reruns the failed and errored tests of --rerun one per lua process across instances, merging the outcome into --result."""
+	discovered = discovery.discover(test_root())
+	report, failed = rerun.load_report(args.rerun, discovered)
+	if not failed:
+		print("Nothing failed in %s" % args.rerun)
+		return
+	test_estimates = {}
+	if args.history and os.path.exists(args.history):
+		timing_history = history.TimingHistory(args.history)
+		test_estimates = timing_history.test_estimates()
+		timing_history.close()
+	items = dict(("rerun%d" % (index + 1), (suite, test)) for index, (suite, test) in enumerate(failed))
+	estimates = dict((name, test_estimates[key]) for name, key in items.items() if key in test_estimates)
+	instances = [str(int(args.instance) + i) for i in range(min(args.parallel, len(items)))]
+	names, makespan, total = lpt_order(sorted(items, key=lambda name: int(name[len("rerun"):])), estimates, len(instances))
+	print("Rerunning %d failed test(s) on %d instance(s)%s" % (len(items), len(instances),
+		", predicted %.0fs" % makespan if total else ""))
+	runner = ParallelRunner(args, instances)
+	for name in names:
+		suite, test = items[name]
+		runner.add_work(name, suite, [test])
+	start = time.time()
+	runner.run()
+	names = rerun.readable_names(discovered)
+	results = rerun.rerun_results([instance_output(args.result, name) for name in items], names)
+	outcomes = rerun.merge(report, failed, results, names)
+	rerun.write(report, args.result)
+	print("Reran %d test(s) in %.1fs, merged report in %s" % (len(items), time.time() - start, args.result))
+	rerun.print_summary(outcomes)
 
-modemsim = ModemSimulator(args.modemsim, com_port=args.comportB)
-modemsim.update_options(
-	{
-		"DefaultDirectory" : args.firmwaredir,
-	}
-)
 
-modemsim.set_instance(args.instance)
-modemsim.run()
-time.sleep(5)
-test_runner = TestRunner(test_output=args.testoutput, com_port=args.comportA)
-test_runner.set_instance(args.instance)
+if __name__ == "__main__":
+	argparser = argparse.ArgumentParser()
+	argparser.add_argument("--modemsim", help="Specifies path to IDP Modem Simulator, required unless --pool is given")
+	argparser.add_argument("--firmwaredir", help="Specifies path firmware directory, required unless --pool is given")
+	argparser.add_argument("--instance", help="Specifies instance number of simulator", default="0")
+	argparser.add_argument("--suite", help="Specifies a test suite to run. In parallel mode a comma separated list of suites")
+	argparser.add_argument("--test", help="Specifies a test name to run")
+	argparser.add_argument("--testoutput", help="Specifies a test output file. In parallel mode suite name is appended to it")
+	argparser.add_argument("--result", help="Parses test output while the tests run and keeps a JUnit XML file up to date. In parallel mode suite name is appended to it and the suite files are merged into this one at the end")
+	argparser.add_argument("--tracelimit", help="Maximum number of trace characters kept per test case in the JUnit result", type=int, default=65536)
+	argparser.add_argument("--comportA", help="Specifies com port. E.g 200 ", default=None)
+	argparser.add_argument("--comportB", help="Specifies com port. E.g 201 ", default=None)
+	argparser.add_argument("--readytimeout", help="Seconds to wait for simulator web services to answer", type=float, default=60)
+	argparser.add_argument("--parallel", help="Runs N simulator instances starting from --instance and spreads suites across them", type=int, default=1)
+	argparser.add_argument("--gateway", help="Puts the Tools/Gateway stand-in on the instance port, in front of the simulator moved to port +%d (also enables GPS track upload)" % SIMULATOR_PORT_OFFSET, action="store_true")
+	argparser.add_argument("--longpoll", help="Seconds the Lua tests long-poll the gateway stand-in for return messages instead of polling every 3s", type=int, default=None)
+	argparser.add_argument("--pool", help="Leases warm instances from a simpool.py daemon, e.g. http://localhost:7999, instead of starting simulators")
+	argparser.add_argument("--shard", help="In parallel mode splits suites longer than half an instance's share into per-test shards (Test*Module.lua discovery)", action="store_true")
+	argparser.add_argument("--history", help="SQLite database the test durations are recorded in; parallel mode runs the longest suites first by it")
+	argparser.add_argument("--firmware", help="Firmware revision recorded in the history, defaults to the name of the firmware directory")
+	argparser.add_argument("--leasetimeout", help="Seconds to wait for a free instance of the pool", type=float, default=600)
+	argparser.add_argument("--resources", help="Samples CPU, memory, threads and handles of the simulator and lua processes into this time series file and adds a per test summary to the JUnit result. In parallel mode suite name is appended to it")
+	argparser.add_argument("--resourceinterval", help="Seconds between resource samples", type=float, default=1.0)
+	argparser.add_argument("--serialbridge", choices=("tcp", "pty"), help="Gives every instance a virtual serial port (serialbridge.py) on RS232MainPort instead of --comportA/--comportB; the tests reach it over TCP (tcp:localhost:%d+N) or a second pty" % serialbridge.SERIAL_PORT_BASE)
+	argparser.add_argument("--serialcapture", help="Records the serial bridge traffic to this file. In parallel mode instance number is appended to it")
+	argparser.add_argument("--serialcom", help="Under Wine the simulator end of the serial bridge of instance N is COM<this + N>", type=int, default=serialbridge.DEFAULT_COM_BASE)
+	argparser.add_argument("--changed", help="Runs only the tests the changes since this git revision (or in a range like origin/master..HEAD) can affect, by the Lua dependency graph of impact.py")
+	argparser.add_argument("--record", help="Records the web service traffic of the tests (gateway stand-in, implies --gateway) with a mark per test to this file for --replay. In parallel mode instance number is appended to it")
+	argparser.add_argument("--replay", help="Runs the tests against a --record file replayed by the gateway stand-in, without a simulator")
+	argparser.add_argument("--replayspeed", help="With --replay the recorded answer times and the Lua clock run this many times faster, 0 answers and skips waits at once", type=float, default=0)
+	argparser.add_argument("--rerun", help="Reruns the FAIL/ERROR tests of a JUnit result (comma separated for several) or history database across --parallel instances; --result gets the merged report with tests passing on rerun marked flaky")
 
-test_runner.args["s"] = args.suite
-test_runner.args["t"] = args.test
+	args = argparser.parse_args()
 
-test_runner.run()
+	if (args.comportA and args.comportB) or (args.comportA != args.comportB):
+		pass
+	else:
+		args.comportA = None
+		args.comportB = None
 
-modemsim.close()
+	if args.serialbridge:
+		if args.comportA or args.comportB:
+			argparser.error("--serialbridge replaces --comportA/--comportB")
+		if args.pool:
+			argparser.error("the serial bridge is set up by the pool (simpool.py --serialbridge)")
 
+	if args.replay:
+		if args.pool or args.parallel > 1 or args.changed or args.rerun:
+			argparser.error("--replay runs one recording, --pool, --parallel, --changed and --rerun can not be given")
+		if args.gateway or args.record or args.longpoll or args.serialbridge or args.comportA or args.comportB:
+			argparser.error("--replay answers from the recording, --gateway, --record, --longpoll, --serialbridge and com ports can not be given")
+	elif args.pool:
+		if args.record:
+			argparser.error("--record needs the gateway stand-in started here, it can not be given with --pool")
+		if args.gateway:
+			argparser.error("the gateway stand-in is set up by the pool (simpool.py --gateway)")
+		if args.comportA or args.comportB:
+			argparser.error("com ports can not be used with pooled instances")
+	elif not (args.modemsim and args.firmwaredir):
+		argparser.error("--modemsim and --firmwaredir are required unless --pool is given")
+	elif args.record:
+		args.gateway = True
+	elif args.longpoll and not args.gateway:
+		argparser.error("--longpoll needs the gateway stand-in (--gateway)")
 
+	if args.rerun:
+		if not args.result:
+			argparser.error("--rerun needs --result for the merged report, the reruns are written next to it")
+		if args.suite or args.test or args.shard:
+			argparser.error("--rerun picks the tests itself, --suite, --test and --shard can not be given")
+		if args.comportA or args.comportB:
+			argparser.error("com ports can not be used with --rerun")
+		run_rerun(args)
+	elif args.changed:
+		if args.suite or args.test or args.shard:
+			argparser.error("--changed picks the tests itself, --suite, --test and --shard can not be given")
+		if args.comportA or args.comportB:
+			argparser.error("com ports can not be used with --changed, use --serialbridge")
+		sys.exit(run_changed(args))
+	elif args.parallel > 1:
+		if args.comportA or args.comportB:
+			argparser.error("com ports can not be shared between parallel instances, use --serialbridge")
+		sys.exit(run_parallel(args))
+	else:
+		run_single(args)
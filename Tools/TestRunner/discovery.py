@@ -0,0 +1,194 @@
+"""Finds the test cases of the Test*Module.lua suites without running Lua.
+
+For every module file the suite name (module("...")), the lunatest hooks it
+defines (suite_setup, suite_teardown, setup, teardown), its test functions
+(global functions lunatest picks up: names starting or ending with "test")
+and their Annotations:register blocks (@randIn, @dependOn, ...) are
+collected. Comments are skipped, so commented out tests are not found.
+
+Results are cached in a JSON file next to the modules, keyed on the SHA-1 of
+every file, so only changed files are scanned again.
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+
+CACHE_NAME = ".testdiscovery.json"
+CACHE_VERSION = 1
+MODULE_GLOB_RE = re.compile(r"^Test.*Module\.lua$")
+HOOKS = ("suite_setup", "suite_teardown", "setup", "teardown")
+
+MODULE_RE = re.compile(r"""\bmodule\s*\(\s*["']([\w.]+)["']""")
+FUNCTION_RE = re.compile(r"^[ \t]*(local[ \t]+)?function[ \t]+([A-Za-z_]\w*)[ \t]*\(", re.M)
+ASSIGNED_FUNCTION_RE = re.compile(r"^[ \t]*(local[ \t]+)?([A-Za-z_]\w*)[ \t]*=[ \t]*function\b", re.M)
+REGISTER_RE = re.compile(r"Annotations\s*:\s*register\s*\(\s*\[(=*)\[(.*?)\]\1\]", re.S)
+ANNOTATION_RE = re.compile(r"@(\w+)\(([\w,_]+)\)")
+LONG_BRACKET_RE = re.compile(r"\[(=*)\[")
+# characters that may start a comment or a string
+TOKEN_START_RE = re.compile(r"[-\"'\[]")
+
+
+def strip_comments(source):
+	"""Lua source with comments blanked out (newlines kept, so line numbers stay), strings are left alone."""
+	out = []
+	i, length = 0, len(source)
+	while i < length:
+		c = source[i]
+		if c == "-" and source.startswith("--", i):
+			bracket = LONG_BRACKET_RE.match(source, i + 2)
+			if bracket:
+				end = source.find("]" + bracket.group(1) + "]", bracket.end())
+				end = length if end < 0 else end + len(bracket.group(1)) + 2
+			else:
+				end = source.find("\n", i)
+				end = length if end < 0 else end
+			out.append(re.sub(r"[^\n]", " ", source[i:end]))
+			i = end
+		elif c in "\"'":
+			end = i + 1
+			while end < length and source[end] != c and source[end] != "\n":
+				end += 2 if source[end] == "\\" else 1
+			out.append(source[i:end + 1])
+			i = end + 1
+		elif c == "[" and LONG_BRACKET_RE.match(source, i):
+			bracket = LONG_BRACKET_RE.match(source, i)
+			end = source.find("]" + bracket.group(1) + "]", bracket.end())
+			end = length if end < 0 else end + len(bracket.group(1)) + 2
+			out.append(source[i:end])
+			i = end
+		else:
+			match = TOKEN_START_RE.search(source, i + 1)
+			end = match.start() if match else length
+			out.append(source[i:end])
+			i = end
+	return "".join(out)
+
+
+def is_test_key(name):
+	# same rule as lunatest.is_test_key
+	return name.startswith("test") or name.endswith("test")
+
+
+def scan_module(path):
+	"""{"suite", "hooks", "tests": [{"name", "line", "annotations"}]} of one module file."""
+	with open(path, encoding="utf-8", errors="replace") as f:
+		code = strip_comments(f.read())
+	module = MODULE_RE.search(code)
+	suite = module.group(1) if module else os.path.splitext(os.path.basename(path))[0]
+
+	annotations = {}
+	for register in REGISTER_RE.finditer(code):
+		found = dict(ANNOTATION_RE.findall(register.group(2)))
+		if "method" in found:
+			annotations[found["method"]] = dict((key, value) for key, value in found.items() if key not in ("method", "module"))
+
+	functions = []
+	for regex in (FUNCTION_RE, ASSIGNED_FUNCTION_RE):
+		for match in regex.finditer(code):
+			if not match.group(1):
+				functions.append((match.start(), match.group(2)))
+	functions.sort()
+
+	tests, hooks, seen = [], [], set()
+	for position, name in functions:
+		if name in HOOKS:
+			if name not in hooks:
+				hooks.append(name)
+		elif is_test_key(name) and name not in seen:
+			# a redefinition replaces the function, lunatest still runs it once
+			seen.add(name)
+			tests.append({
+				"name" : name,
+				"line" : code.count("\n", 0, position) + 1,
+				"annotations" : annotations.get(name, {}),
+			})
+	return {"suite" : suite, "hooks" : hooks, "tests" : tests}
+
+
+def _sha1(path):
+	with open(path, "rb") as f:
+		return hashlib.sha1(f.read()).hexdigest()
+
+
+def discover(root, cache_path=None):
+	"""{suite: module info plus "file"} for every Test*Module.lua in root, scanning only files changed since the cache was written."""
+	cache_path = cache_path or os.path.join(root, CACHE_NAME)
+	try:
+		with open(cache_path, encoding="utf-8") as f:
+			cache = json.load(f)
+		if cache.get("version") != CACHE_VERSION:
+			cache = None
+	except (IOError, OSError, ValueError):
+		cache = None
+	cached = cache["files"] if cache else {}
+
+	files, changed = {}, False
+	for name in sorted(os.listdir(root)):
+		if not MODULE_GLOB_RE.match(name):
+			continue
+		sha1 = _sha1(os.path.join(root, name))
+		entry = cached.get(name)
+		if not entry or entry["sha1"] != sha1:
+			entry = scan_module(os.path.join(root, name))
+			entry["sha1"] = sha1
+			changed = True
+		files[name] = entry
+	if changed or set(files) != set(cached):
+		try:
+			with open(cache_path + ".tmp", "w", encoding="utf-8") as f:
+				json.dump({"version" : CACHE_VERSION, "files" : files}, f, indent=1)
+			os.replace(cache_path + ".tmp", cache_path)
+		except (IOError, OSError) as e:
+			print("Test discovery cache not written: %s" % e)
+
+	suites = {}
+	for name, entry in files.items():
+		suite = dict(entry)
+		suite["file"] = name
+		suites[entry["suite"]] = suite
+	return suites
+
+
+def test_groups(suite):
+	"""Tests of a suite in groups that have to run in the same lua process.
+
+	Tests sharing a @randIn batch are picked from at random (Randomizer:batch), a
+	shard holding only part of a batch would run more or fewer of them than intended.
+	"""
+	groups, batches = [], {}
+	for test in suite["tests"]:
+		rand_in = test["annotations"].get("randIn", "").split(",")
+		if len(rand_in) > 2 and rand_in[1] == "batch":
+			key = rand_in[2]
+			if key not in batches:
+				batches[key] = []
+				groups.append(batches[key])
+			batches[key].append(test["name"])
+		else:
+			groups.append([test["name"]])
+	return groups
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Lists the test cases of the Test*Module.lua suites.")
+	parser.add_argument("root", nargs="?", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."),
+		help="Directory holding the Test*Module.lua files")
+	parser.add_argument("--json", action="store_true", help="Print the whole discovery result as JSON")
+	parser.add_argument("--suite", help="Only this suite")
+	args = parser.parse_args()
+
+	suites = discover(args.root)
+	if args.suite:
+		suites = dict((name, suite) for name, suite in suites.items() if name == args.suite)
+	if args.json:
+		print(json.dumps(suites, indent=1, sort_keys=True))
+	else:
+		for name in sorted(suites):
+			suite = suites[name]
+			print("%s (%s): %d test(s), %d group(s), hooks: %s" % (name, suite["file"], len(suite["tests"]),
+				len(test_groups(suite)), ", ".join(suite["hooks"]) or "none"))
+			for test in suite["tests"]:
+				annotations = " ".join("@%s(%s)" % item for item in sorted(test["annotations"].items()))
+				print("  %5d  %s %s" % (test["line"], test["name"], annotations))
@@ -0,0 +1,556 @@
+"""Selects the Lua tests a change can affect, from a static dependency graph of the test tree.
+
+	python impact.py --base origin/master
+	python TestRunner.py ... --changed origin/master
+
+Every .lua file is cut into its top-level statements (function definitions,
+assignments, if blocks assigning globals, other code) and for each one the requires and the identifiers it
+uses are collected. From that the graph links
+
+	files to the files they require and the globals they use,
+	globals to where they are made: a class (Email/SmtpWrapper.lua defines
+	SmtpWrapper) or an assignment (vmsSW = VmsServiceWrapper() in RunAllModules.lua,
+	serialMain in both branches of the "if string.match(ComPort, ...)" there),
+	the test functions of the Test*Module.lua suites to the globals, module level
+	code and helper functions they use, their hooks and the objects named by
+	their annotations (@dependOn(helmPanel,isReady)).
+
+Changed lines of a git diff are mapped to the statements holding them, so a
+change inside a test function selects that test, one in an assignment of
+RunAllModules.lua (or an if block of assignments) the tests using that global, and one in a wrapper class
+the tests reaching it through any chain of globals and requires. Changes to
+the runner itself (RunAllModules.lua outside its assignments, lunatest.lua)
+select everything. A Lua file nothing requires by name counts as part of the
+file requiring a variable that names it (ConfigFile = ConfigFile or
+"TestConfiguration" ... require(ConfigFile) in TestFramework.lua), scripts
+not loaded at all (Service/servicetest.lua) select nothing.
+
+The analysis is lexical: locals shadowing a global and table keys spelled like
+one count as uses, so the selection errs on the side of running more. Scans
+are cached in a JSON file next to the modules keyed on the SHA-1 of every file
+like discovery.py, a selection after a small change rescans only that file.
+"""
+import argparse
+import collections
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+import discovery
+
+CACHE_NAME = ".testimpact.json"
+CACHE_VERSION = 2
+ENTRY = "RunAllModules.lua"
+# files run by the entry whatever the tests use
+RUNNER_FILES = ("lunatest.lua",)
+# Python tooling, not loaded by the tests
+IGNORED_DIRS = ("Tools",)
+ALL = "*"
+
+# standard library tables, files extending them (string.split in UtilLibs/Text.lua) reach the tests through their requires
+STANDARD_LIBRARY = set("_G coroutine debug io math os package string table".split())
+KEYWORDS = set("""and break do else elseif end false for function goto if in local nil not or
+	repeat return then true until while self""".split())
+REQUIRE_RE = re.compile(r"""\b(require|dofile|loadfile)\s*\(?\s*(?:"([^"\n]+)"|'([^'\n]+)'|\[\[([^\]\n]+)\]\]|([A-Za-z_]))""")
+STRING_RE = re.compile(r""""(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*'|\[(=*)\[.*?\]\1\]""", re.S)
+# block openers and closers of Lua, "while"/"for" are counted through their "do"
+BLOCK_RE = re.compile(r"\b(function|if|do|repeat|end|until)\b|([(\[{])|([)\]}])")
+IDENTIFIER_RE = re.compile(r"([.:]\s*)?\b([A-Za-z_]\w*)")
+FUNCTION_DEF_RE = re.compile(r"^(local\s+)?function\s+([A-Za-z_]\w*)")
+ASSIGNED_FUNCTION_RE = re.compile(r"^(local\s+)?([A-Za-z_]\w*)\s*=\s*function\b")
+VALUE_RE = re.compile(r"^(local\s+)?([A-Za-z_]\w*(?:\s*,\s*[A-Za-z_]\w*)*)\s*=(?!=)\s*(.?)")
+MODULE_NAME_RE = re.compile(r"^[A-Za-z_][\w./\\-]*$")
+FIELD_RE = re.compile(r"^([A-Za-z_]\w*)(?:\s*\.\s*\w+|\s*\[[^\]]*\])+\s*=(?!=)")
+IF_RE = re.compile(r"^if\b")
+
+
+def _blank(match):
+	return re.sub(r"[^\n]", " ", match.group(0))
+
+
+def blank_strings(code):
+	"""Code (with comments already stripped) with the contents of strings blanked out, newlines kept."""
+	return STRING_RE.sub(_blank, code)
+
+
+def module_path(name):
+	"""Relative path a require name is looked up at, e.g. "UtilLibs.Text" -> "UtilLibs/Text.lua"."""
+	name = name.replace("\\", "/")
+	if name.endswith(".lua"):
+		return name
+	return name.replace(".", "/") + ".lua"
+
+
+def _statements(lines):
+	"""Yields (first line, last line) of the top-level statements, 1-based."""
+	depth, start = 0, None
+	for number, line in enumerate(lines, 1):
+		if start is None:
+			if not line.strip():
+				continue
+			start = number
+		for match in BLOCK_RE.finditer(line):
+			word, opening, closing = match.groups()
+			if opening or word in ("function", "if", "do", "repeat"):
+				depth += 1
+			else:
+				depth -= 1
+		if depth <= 0:
+			depth = 0
+			yield start, number
+			start = None
+	if start is not None:
+		yield start, len(lines)
+
+
+def _uses(text):
+	return sorted(set(name for prefix, name in IDENTIFIER_RE.findall(text) if not prefix and name not in KEYWORDS))
+
+
+def scan_file(path):
+	"""{"units": [...], "dynamic": bool} of a Lua file.
+
+	Every unit is one top-level statement: {"kind": function, value, field, branch (an if block
+	assigning globals, named by them), annotation or code,
+	"names": names it defines, "local", "table" (value is a table constructor),
+	"lines": [first, last], "uses": identifiers, "requires": paths}. "strings" are the
+	string literals that could be module names.
+	"""
+	with open(path, encoding="utf-8", errors="replace") as f:
+		code = discovery.strip_comments(f.read())
+	requires = collections.defaultdict(list)
+	dynamic = False
+	# a file loaded by a require of a variable is named somewhere, e.g. ConfigFile = ConfigFile or "TestConfiguration"
+	strings = sorted(set(match.group(0)[1:-1] for match in STRING_RE.finditer(code)
+		if match.group(0)[0] in "\"'" and MODULE_NAME_RE.match(match.group(0)[1:-1])))
+	for match in REQUIRE_RE.finditer(code):
+		name = match.group(2) or match.group(3) or match.group(4)
+		if name:
+			line = code.count("\n", 0, match.start()) + 1
+			requires[line].append(module_path(name) if match.group(1) == "require" else name.replace("\\", "/"))
+		else:
+			dynamic = True
+	lines = blank_strings(code).split("\n")
+	code_lines = code.split("\n")
+	units = []
+	for first, last in _statements(lines):
+		head = lines[first - 1].strip()
+		text = "\n".join(lines[first - 1:last])
+		unit = {"kind" : "code", "names" : [], "local" : False, "table" : False, "lines" : [first, last]}
+		for regex in (FUNCTION_DEF_RE, ASSIGNED_FUNCTION_RE):
+			match = regex.match(head)
+			if match:
+				unit.update(kind="function", names=[match.group(2)], local=bool(match.group(1)))
+				break
+		else:
+			match = VALUE_RE.match(head)
+			if match:
+				unit.update(kind="value", names=[name.strip() for name in match.group(2).split(",")],
+					local=bool(match.group(1)), table=match.group(3) == "{")
+			else:
+				match = FIELD_RE.match(head)
+				if match:
+					unit.update(kind="field", names=[match.group(1)])
+				elif IF_RE.match(head):
+					names = set()
+					for line in lines[first:last - 1]:
+						match = VALUE_RE.match(line.strip())
+						if match and not match.group(1):
+							names.update(name.strip() for name in match.group(2).split(","))
+					if names:
+						unit.update(kind="branch", names=sorted(names))
+		if unit["kind"] == "code":
+			# Annotations:register([[ ... @method(test_X) ... ]]) belongs to the test it annotates
+			register = discovery.REGISTER_RE.search("\n".join(code_lines[first - 1:last]))
+			method = dict(discovery.ANNOTATION_RE.findall(register.group(2))).get("method") if register else None
+			if method:
+				unit.update(kind="annotation", names=[method])
+		unit["uses"] = [name for name in _uses(text) if name not in unit["names"] or unit["kind"] != "value"]
+		unit["requires"] = [path for line in range(first, last + 1) for path in requires.get(line, [])]
+		units.append(unit)
+	return {"units" : units, "dynamic" : dynamic, "strings" : strings}
+
+
+def lua_files(root):
+	"""Relative paths (with /) of the Lua files of the test tree."""
+	found = []
+	for directory, dirs, files in os.walk(root):
+		relative = os.path.relpath(directory, root).replace(os.sep, "/")
+		dirs[:] = sorted(name for name in dirs if not name.startswith(".")
+			and not (relative == "." and name in IGNORED_DIRS))
+		for name in sorted(files):
+			if name.endswith(".lua"):
+				found.append(name if relative == "." else relative + "/" + name)
+	return found
+
+
+def _sha1(path):
+	with open(path, "rb") as f:
+		return hashlib.sha1(f.read()).hexdigest()
+
+
+def scan_tree(root, cache_path=None):
+	"""{relative path: scan} of every Lua file, scanning only files changed since the cache was written."""
+	cache_path = cache_path or os.path.join(root, CACHE_NAME)
+	try:
+		with open(cache_path, encoding="utf-8") as f:
+			cache = json.load(f)
+		if cache.get("version") != CACHE_VERSION:
+			cache = None
+	except (IOError, OSError, ValueError):
+		cache = None
+	cached = cache["files"] if cache else {}
+
+	files, changed = {}, False
+	for name in lua_files(root):
+		sha1 = _sha1(os.path.join(root, name))
+		entry = cached.get(name)
+		if not entry or entry["sha1"] != sha1:
+			entry = scan_file(os.path.join(root, name))
+			entry["sha1"] = sha1
+			changed = True
+		files[name] = entry
+	if changed or set(files) != set(cached):
+		try:
+			with open(cache_path + ".tmp", "w", encoding="utf-8") as f:
+				json.dump({"version" : CACHE_VERSION, "files" : files}, f)
+			os.replace(cache_path + ".tmp", cache_path)
+		except (IOError, OSError) as e:
+			print("Test impact cache not written: %s" % e)
+	return files
+
+
+class ImpactGraph():
+	"""Dependency graph of the test tree. Nodes are ("file", path), ("global", name),
+	("module", suite) for the module level code of a suite and ("function", suite, name)
+	for the functions of a suite (tests, hooks and helpers)."""
+	def __init__(self, files, suites):
+		self.files = files
+		self.suites = suites
+		self.module_files = dict((suite["file"], name) for name, suite in suites.items())
+		# node -> nodes using it
+		self.users = collections.defaultdict(set)
+		self._build()
+
+	def _use(self, user, node):
+		if user != node:
+			self.users[node].add(user)
+
+	def _is_assignment(self, path, unit):
+		"""Values assigned to globals outside the suites are nodes of their own, not part of their file,
+		so are the if blocks of the entry choosing them (serialMain in RunAllModules.lua)."""
+		if unit["kind"] == "branch":
+			return path == ENTRY
+		return unit["kind"] == "value" and not unit["local"] and not unit["table"] and path not in self.module_files
+
+	def _loaded(self):
+		"""Files required by name from the entry or a suite, directly or not."""
+		loaded = set()
+		queue = collections.deque([ENTRY] + sorted(self.module_files))
+		while queue:
+			path = queue.popleft()
+			if path in loaded or path not in self.files:
+				continue
+			loaded.add(path)
+			queue.extend(required for unit in self.files[path]["units"] for required in unit["requires"])
+		return loaded
+
+	def _build(self):
+		# scripts nothing loads (e.g. Service/servicetest.lua) define no globals the tests see
+		self.loaded = self._loaded()
+		all_defined = set()
+		for path in self.loaded:
+			for unit in self.files[path]["units"]:
+				if unit["kind"] not in ("code", "annotation") and not unit["local"] and path not in self.module_files:
+					all_defined.update(unit["names"])
+		all_defined -= STANDARD_LIBRARY
+		for path in self.loaded:
+			scan = self.files[path]
+			# top-level locals of a file hide the globals of the same name in it
+			defined = all_defined - set(name for unit in scan["units"] if unit["local"] for name in unit["names"])
+			if path in self.module_files:
+				self._build_module(self.module_files[path], scan, defined)
+				continue
+			file_node = ("file", path)
+			for unit in scan["units"]:
+				if self._is_assignment(path, unit):
+					for name in unit["names"]:
+						for used in unit["uses"]:
+							if used in defined:
+								self._use(("global", name), ("global", used))
+						for required in unit["requires"]:
+							self._use(("global", name), ("file", required))
+					continue
+				for used in unit["uses"]:
+					if used in defined:
+						self._use(file_node, ("global", used))
+				for required in unit["requires"]:
+					# the entry requires every wrapper, the tests reach them through the globals it assigns
+					if path != ENTRY:
+						self._use(file_node, ("file", required))
+				if unit["kind"] not in ("code", "annotation") and not unit["local"]:
+					for name in unit["names"]:
+						self._use(("global", name), file_node)
+
+	def _build_module(self, suite, scan, defined):
+		info = self.suites[suite]
+		functions = set(name for unit in scan["units"] if unit["kind"] == "function" for name in unit["names"])
+		module_node = ("module", suite)
+		for unit in scan["units"]:
+			users = [("function", suite, name) for name in unit["names"]] if unit["kind"] in ("function", "annotation") else [module_node]
+			for user in users:
+				for used in unit["uses"]:
+					if used in functions:
+						self._use(user, ("function", suite, used))
+					elif used in defined:
+						self._use(user, ("global", used))
+				for required in unit["requires"]:
+					self._use(user, ("file", required))
+		for test in info["tests"]:
+			test_node = ("function", suite, test["name"])
+			self._use(test_node, module_node)
+			for hook in info["hooks"]:
+				self._use(test_node, ("function", suite, hook))
+			for value in test["annotations"].values():
+				self._use(test_node, ("global", value.split(",")[0]))
+
+	def unit_at(self, path, line):
+		scan = self.files.get(path)
+		if scan:
+			for unit in scan["units"]:
+				if unit["lines"][0] <= line <= unit["lines"][1]:
+					return unit
+		return None
+
+	def changed_nodes(self, path, lines):
+		"""(nodes, reason) changed by the given lines (None for the whole file) of a file, nodes may be ALL."""
+		if path in self.module_files:
+			suite = self.module_files[path]
+			if lines is None:
+				return [("module", suite)], None
+			nodes = set()
+			for line in lines:
+				unit = self.unit_at(path, line)
+				# blank and comment lines belong to no statement and change nothing
+				if unit is None:
+					continue
+				if unit["kind"] in ("function", "annotation"):
+					nodes.update(("function", suite, name) for name in unit["names"])
+				else:
+					nodes.add(("module", suite))
+			return sorted(nodes), None
+		if path in RUNNER_FILES:
+			return ALL, "%s runs every test" % path
+		if path in self.files and path not in self.loaded:
+			name = path[:-len(".lua")]
+			loaders = [("file", loader) for loader in sorted(self.loaded) if self.files[loader]["dynamic"]
+				and (name in self.files[loader]["strings"] or name.replace("/", ".") in self.files[loader]["strings"])]
+			if not loaders:
+				return [], "%s is not loaded by the tests" % path
+			return loaders, "%s is loaded through a require of a variable in %s" % (path, ", ".join(node[1] for node in loaders))
+		if lines is None or path not in self.files:
+			return (ALL, "%s changed as a whole" % path) if path == ENTRY else ([("file", path)], None)
+		nodes = set()
+		for line in lines:
+			unit = self.unit_at(path, line)
+			if unit is None:
+				continue
+			if self._is_assignment(path, unit):
+				nodes.update(("global", name) for name in unit["names"])
+			elif path == ENTRY:
+				return ALL, "%s line %d is not a global assignment" % (path, line)
+			else:
+				nodes.add(("file", path))
+		return sorted(nodes), None
+
+	def affected(self, changed):
+		"""{node: node it was reached from} of everything using the changed nodes, directly or not."""
+		reached = dict((node, None) for node in changed)
+		queue = collections.deque(changed)
+		while queue:
+			node = queue.popleft()
+			for user in self.users.get(node, ()):
+				if user not in reached:
+					reached[user] = node
+					queue.append(user)
+		return reached
+
+
+def describe(node):
+	if node[0] == "function":
+		return "%s.%s" % (node[1], node[2])
+	if node[0] == "module":
+		return "%s (module level)" % node[1]
+	return node[1]
+
+
+def select(graph, changes):
+	"""Tests to run for {path: changed lines or None}.
+
+	Returns ({suite: None for all its tests or [test names]}, {suite or (suite, test): chain of node descriptions}, [notes]).
+	"""
+	changed, notes = [], []
+	for path, lines in sorted(changes.items()):
+		if not path.endswith(".lua") or path.split("/")[0] in IGNORED_DIRS:
+			notes.append("%s does not affect the Lua tests" % path)
+			continue
+		nodes, reason = graph.changed_nodes(path, lines)
+		if nodes == ALL:
+			notes.append(reason)
+			return dict((suite, None) for suite in graph.suites), {}, notes
+		if reason:
+			notes.append(reason)
+		changed.extend(nodes)
+	reached = graph.affected(changed)
+
+	def chain(node):
+		names = []
+		while node is not None:
+			names.append(describe(node))
+			node = reached[node]
+		return names
+
+	for runner in RUNNER_FILES:
+		if ("file", runner) in reached:
+			notes.append("the change reaches the runner: %s" % " <- ".join(chain(("file", runner))))
+			return dict((suite, None) for suite in graph.suites), {}, notes
+
+	selection, reasons = {}, {}
+	for suite, info in graph.suites.items():
+		module_node = ("module", suite)
+		if module_node in reached:
+			selection[suite] = None
+			reasons[suite] = chain(module_node)
+			continue
+		hooks = [("function", suite, hook) for hook in info["hooks"] if ("function", suite, hook) in reached]
+		if hooks:
+			selection[suite] = None
+			reasons[suite] = chain(hooks[0])
+			continue
+		tests = [test["name"] for test in info["tests"] if ("function", suite, test["name"]) in reached]
+		if not tests:
+			continue
+		for name in tests:
+			reasons[(suite, name)] = chain(("function", suite, name))
+		# a test of a @randIn batch is picked at random, the whole batch has to run
+		for group in discovery.test_groups(info):
+			if set(group) & set(tests):
+				tests.extend(name for name in group if name not in tests)
+		all_tests = [test["name"] for test in info["tests"]]
+		selection[suite] = None if set(all_tests) <= set(tests) else [name for name in all_tests if name in tests]
+	return selection, reasons, notes
+
+
+def _git(root, *args):
+	return subprocess.check_output(["git"] + list(args), cwd=root, universal_newlines=True, errors="replace")
+
+
+HUNK_RE = re.compile(r"^@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@")
+
+
+def parse_diff(text):
+	"""{path: set of changed line numbers of the new file, or None when it is gone} of a unified diff."""
+	changes = {}
+	old_path = path = None
+	for line in text.splitlines():
+		if line.startswith("--- "):
+			old_path = line[4:].strip()
+		elif line.startswith("+++ "):
+			path = line[4:].strip()
+			if path == "/dev/null":
+				# deleted, what used it has to run
+				path = old_path[2:] if old_path.startswith("a/") else old_path
+				changes[path] = None
+				path = None
+			else:
+				path = path[2:] if path.startswith("b/") else path
+				changes.setdefault(path, set())
+		elif path is not None and line.startswith("@@"):
+			match = HUNK_RE.match(line)
+			if match:
+				start, count = int(match.group(1)), int(match.group(2) or 1)
+				# a pure deletion is after line start, the statement holding it is the one around it
+				changes[path].update(range(start, start + count) if count else (max(start, 1), start + 1))
+	return changes
+
+
+def git_changes(root, base="HEAD"):
+	"""{path relative to root: changed lines} between base (or a range like a..b) and the working tree or the range end."""
+	top = _git(root, "rev-parse", "--show-toplevel").strip()
+	diff = _git(root, "diff", "-U0", "--no-color", "--no-ext-diff", "--no-renames", base, "--", ".")
+	changes = parse_diff(diff)
+	if ".." not in base:
+		for path in _git(root, "ls-files", "--others", "--exclude-standard", "--full-name", ".").splitlines():
+			changes[path] = None if not path.endswith(".lua") else set()
+	relative = {}
+	for path, lines in changes.items():
+		path = os.path.relpath(os.path.join(top, path), root).replace(os.sep, "/")
+		# new files have every line changed
+		if lines is not None and not lines and os.path.exists(os.path.join(root, path)):
+			lines = None
+		relative[path] = lines
+	return relative
+
+
+def load_graph(root):
+	return ImpactGraph(scan_tree(root), discovery.discover(root))
+
+
+def work_items(selection):
+	"""[(name, suite, tests or None)] of a selection, the form TestRunner.py queues work in."""
+	items = []
+	for suite in sorted(selection):
+		tests = selection[suite]
+		items.append((suite if tests is None else suite + "-changed", suite, tests))
+	return items
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Lists the tests a change can affect, from the require and global dependencies of the Lua test tree.")
+	parser.add_argument("--root", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."),
+		help="Directory holding RunAllModules.lua and the Test*Module.lua files")
+	parser.add_argument("--base", default="HEAD", help="Git revision the working tree is compared to, or a range like origin/master..HEAD")
+	parser.add_argument("--diff", help="Unified diff file to take the changes from instead of git, - for stdin")
+	parser.add_argument("--format", choices=("text", "args", "json"), default="text",
+		help="text: selection with reasons, args: RunAllModules.lua -s/-tl arguments per suite, json")
+	args = parser.parse_args()
+
+	root = os.path.abspath(args.root)
+	start = time.time()
+	if args.diff:
+		changes = parse_diff(sys.stdin.read() if args.diff == "-" else open(args.diff, errors="replace").read())
+	else:
+		changes = git_changes(root, args.base)
+	graph = load_graph(root)
+	selection, reasons, notes = select(graph, changes)
+	elapsed = time.time() - start
+
+	if args.format == "json":
+		print(json.dumps({"changed" : sorted(changes), "selection" : selection, "notes" : notes}, indent=1, sort_keys=True))
+	elif args.format == "args":
+		for name, suite, tests in work_items(selection):
+			print("-s %s%s" % (suite, " -tl " + ",".join(tests) if tests else ""))
+	else:
+		for path in sorted(changes):
+			lines = changes[path]
+			print("Changed %s%s" % (path, "" if lines is None else " (%d line(s))" % len(lines)))
+		for note in notes:
+			print("  " + note)
+		total = sum(len(info["tests"]) for info in graph.suites.values())
+		selected = 0
+		for suite in sorted(selection):
+			tests = selection[suite]
+			count = len(graph.suites[suite]["tests"]) if tests is None else len(tests)
+			selected += count
+			print("%-28s %s" % (suite, "all %d test(s)" % count if tests is None else "%d of %d test(s)" % (count, len(graph.suites[suite]["tests"]))))
+			if suite in reasons:
+				print("    %s" % " <- ".join(reasons[suite]))
+			for name in tests or []:
+				print("  %s" % name)
+				if (suite, name) in reasons:
+					print("    %s" % " <- ".join(reasons[(suite, name)]))
+		print("%d of %d test(s) selected in %.1fms" % (selected, total, elapsed * 1000))
@@ -0,0 +1,209 @@
+"""Failed test reruns: picks the FAIL and ERROR cases of an earlier run and merges the rerun outcome into its report.
+
+The earlier run is a JUnit XML written by testoutparse.py or TestRunner.py --result
+(a comma separated list for the per suite files of a parallel run), or a timing
+history database, whose latest record of every test is taken.
+
+In the merged report a test that passes on rerun keeps its original failure as
+<flakyFailure>/<flakyError> (the Maven Surefire way of reporting flaky tests,
+understood by the Jenkins JUnit plugin) and a test failing again gets the new
+message as <rerunFailure>/<rerunError>. Every rerun test case also gets a "rerun"
+property: flaky, failed or notrun (no result came back, e.g. the simulator died).
+"""
+import argparse
+import os
+import sys
+import xml.etree.ElementTree as ET
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "OutputParser"))
+import testoutparse
+import history
+import discovery
+
+from junitmerge import FAILED, RERUN_PROPERTY, FLAKY, STILL_FAILING, RESULT_TAGS, FLAKY_TAGS, RERUN_TAGS, lunatest_name, case_result, case_time
+from junitmerge import case_property as _property, set_case_property as _set_property
+
+NOT_RERUN = "notrun"
+
+
+def is_history(path):
+	with open(path, "rb") as f:
+		return f.read(16) == b"SQLite format 3\x00"
+
+
+def case_test(case, suite, readable_names):
+	"""Lunatest name of a testcase element, results written before the name was kept are mapped back by discovery."""
+	name = _property(case, testoutparse.TEST_NAME_PROPERTY)
+	if name is None:
+		name = readable_names.get((suite, case.get("name")), case.get("name"))
+	return lunatest_name(name)
+
+
+def readable_names(discovered):
+	"""{(suite, JUnit testcase name): test name} of every discovered test."""
+	return dict(((suite, testoutparse.junit_case_name(test["name"])), test["name"])
+		for suite, info in discovered.items() for test in info["tests"])
+
+
+def cases(root, names):
+	"""(suite, test, testcase element) of every test case of a parsed JUnit document."""
+	for testsuite in root.iter("testsuite"):
+		suite = testsuite.get("name")
+		for case in testsuite.findall("testcase"):
+			yield suite, case_test(case, suite, names), case
+
+
+def load_junit(paths):
+	"""All documents merged into one <testsuites> element."""
+	root = None
+	for path in paths:
+		document = ET.parse(path).getroot()
+		if root is None:
+			root = document
+		else:
+			root.extend(document.findall("testsuite"))
+	return root
+
+
+def load_history(path):
+	"""A JUnit document of the tests whose latest history record is a failure, there are no messages or traces."""
+	root = ET.Element("testsuites", name="Rerun of %s" % os.path.basename(path))
+	suites = {}
+	timing_history = history.TimingHistory(path)
+	try:
+		failed = timing_history.failed_tests(FAILED)
+	finally:
+		timing_history.close()
+	for suite, test, result in failed:
+		if suite not in suites:
+			suites[suite] = ET.SubElement(root, "testsuite", name=suite)
+		name = lunatest_name(test)
+		case = ET.SubElement(suites[suite], "testcase", name=testoutparse.junit_case_name(name), classname=suite)
+		_set_property(case, testoutparse.TEST_NAME_PROPERTY, name)
+		ET.SubElement(case, dict(RESULT_TAGS)[result], message="%s in the history" % result)
+	return root
+
+
+def load_report(source, discovered):
+	"""(JUnit document, [(suite, test)] failed in it) of a JUnit file list or history database."""
+	names = readable_names(discovered)
+	paths = [path.strip() for path in source.split(",") if path.strip()]
+	if len(paths) == 1 and is_history(paths[0]):
+		root = load_history(paths[0])
+	else:
+		root = load_junit(paths)
+	failed = []
+	for suite, test, case in cases(root, names):
+		if case_result(case) in FAILED and (suite, test) not in failed:
+			if discovered and test not in [known["name"] for known in discovered.get(suite, {"tests" : []})["tests"]]:
+				print("Not rerunning %s in %s, no such test in the Test*Module.lua files" % (test, suite))
+				continue
+			failed.append((suite, test))
+	return root, failed
+
+
+def rerun_results(paths, names):
+	"""{(suite, test): testcase element} of the JUnit results of the reruns, missing files are skipped."""
+	results = {}
+	for path in paths:
+		if not path or not os.path.exists(path):
+			continue
+		try:
+			root = ET.parse(path).getroot()
+		except ET.ParseError as e:
+			print("Rerun result %s not read: %s" % (path, e))
+			continue
+		for suite, test, case in cases(root, names):
+			results[(suite, test)] = case
+	return results
+
+
+def merge(root, failed, results, names):
+	"""Marks the failed test cases of root with their rerun outcome, returns {outcome: [(suite, test)]}."""
+	outcomes = {FLAKY : [], STILL_FAILING : [], NOT_RERUN : []}
+	for suite, test, case in cases(root, names):
+		if (suite, test) not in failed or _property(case, RERUN_PROPERTY) is not None:
+			continue
+		result = case_result(case)
+		rerun = results.get((suite, test))
+		rerun_result = case_result(rerun) if rerun is not None else None
+		if rerun_result == "PASS":
+			outcome = FLAKY
+			# the original failure stays as the flaky one, the test case itself passed
+			original = case.find(dict(RESULT_TAGS)[result])
+			original.tag = FLAKY_TAGS[result]
+			if rerun.get("time") is not None:
+				case.set("time", rerun.get("time"))
+		elif rerun_result in FAILED:
+			outcome = STILL_FAILING
+			again = ET.SubElement(case, RERUN_TAGS[rerun_result], message=rerun.find(dict(RESULT_TAGS)[rerun_result]).get("message", ""))
+			trace = rerun.find("system-out")
+			if trace is not None:
+				ET.SubElement(again, "system-out").text = trace.text
+		else:
+			# skipped on rerun (e.g. @dependOn on a test not rerun) tells as little as no result
+			outcome = NOT_RERUN
+		_set_property(case, RERUN_PROPERTY, outcome)
+		outcomes[outcome].append((suite, test))
+	return outcomes
+
+
+def recount(root):
+	"""Sets tests, failures, errors, skipped and time of every testsuite from its test cases, and their sums on root."""
+	totals = dict((name, 0) for name in testoutparse.SUITE_COUNTS)
+	for testsuite in root.iter("testsuite"):
+		counts = dict((name, 0) for name in testoutparse.SUITE_COUNTS)
+		seconds = 0.0
+		for case in testsuite.findall("testcase"):
+			counts["tests"] += 1
+			result = case_result(case)
+			if result in ("FAIL", "ERROR", "SKIP"):
+				counts[testoutparse.SUITE_COUNTS[("FAIL", "ERROR", "SKIP").index(result) + 1]] += 1
+			seconds += case_time(case)
+		for name, count in counts.items():
+			testsuite.set(name, str(count))
+			totals[name] += count
+		# a flaky test case takes the time of its passing rerun
+		if testsuite.get("time") is not None:
+			testsuite.set("time", "%.3f" % seconds)
+	if root.tag == "testsuites":
+		for name, count in totals.items():
+			root.set(name, str(count))
+
+
+def write(root, path):
+	# a test passing on rerun no longer counts as failed
+	recount(root)
+	if hasattr(ET, "indent"):
+		ET.indent(root, "\t")
+	ET.ElementTree(root).write(path, encoding="utf-8", xml_declaration=True)
+
+
+def print_summary(outcomes):
+	for outcome, title in ((FLAKY, "Flaky (passed on rerun)"), (STILL_FAILING, "Still failing"), (NOT_RERUN, "Not rerun")):
+		if outcomes[outcome]:
+			print("%s: %d" % (title, len(outcomes[outcome])))
+			for suite, test in outcomes[outcome]:
+				print("  %-32s %s" % (suite, test))
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Lists the failed tests of a JUnit result or history database, or merges rerun results into it.")
+	parser.add_argument("source", help="JUnit XML file(s), comma separated, or a history database")
+	parser.add_argument("--merge", help="Comma separated JUnit results of the reruns")
+	parser.add_argument("--output", help="Merged JUnit report")
+	parser.add_argument("--root", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."),
+		help="Directory holding the Test*Module.lua files, for results without lunatest test names")
+	args = parser.parse_args()
+
+	discovered = discovery.discover(args.root)
+	root, failed = load_report(args.source, discovered)
+	if not args.merge:
+		for suite, test in failed:
+			print("%-32s %s" % (suite, test))
+	else:
+		names = readable_names(discovered)
+		outcomes = merge(root, failed, rerun_results(args.merge.split(","), names), names)
+		print_summary(outcomes)
+		if args.output:
+			write(root, args.output)
@@ -0,0 +1,195 @@
+"""Samples CPU, memory, thread and handle use of the simulator and lua processes while tests run.
+
+Processes are read from /proc on Linux, elsewhere through psutil when it is
+installed. Every interval one line per watched process is appended to a tab
+separated time series, test case results are written in between as comments:
+
+	# resources started 1431500000.250
+	# time	process	pid	cpu%	rss_kb	threads	handles
+	12.500	modemsim	4242	37.5	81234	14	56
+	12.500	lua	4250	2.0	10240	1	5
+	# 13.105	PASS	TestSmtpModule	test_SMTP_WhenHELOCommandCalled_ServerReturns250
+
+Time is in seconds from the start line, cpu% of one core (it can pass 100),
+taken over at least MIN_CPU_WINDOW seconds ("-" for samples closer together).
+The samples taken while a test ran are summed up as JUnit testcase properties,
+e.g. resources.modemsim.cpu_max, so spikes can be lined up with the test that
+caused them.
+"""
+import argparse
+import os
+import threading
+import time
+
+try:
+	import psutil
+except ImportError:
+	psutil = None
+
+PROC = "/proc"
+FIELDS = ("cpu", "rss_kb", "threads", "handles")
+# cpu times come in clock ticks (10ms), shorter windows give no usable percentage
+MIN_CPU_WINDOW = 0.5
+
+
+def _read_proc(pid):
+	"""(cpu seconds, rss kB, threads, open handles or None) of a process from /proc."""
+	with open(os.path.join(PROC, str(pid), "stat")) as f:
+		# the command name may hold spaces and parentheses, the fields after it do not
+		fields = f.read().rsplit(")", 1)[1].split()
+	ticks = os.sysconf("SC_CLK_TCK")
+	cpu = (int(fields[11]) + int(fields[12])) / float(ticks)
+	rss = int(fields[21]) * os.sysconf("SC_PAGE_SIZE") // 1024
+	try:
+		handles = len(os.listdir(os.path.join(PROC, str(pid), "fd")))
+	except OSError:
+		handles = None
+	return cpu, rss, int(fields[17]), handles
+
+
+def _read_psutil(pid):
+	process = psutil.Process(pid)
+	with process.oneshot():
+		times = process.cpu_times()
+		handles = process.num_handles() if hasattr(process, "num_handles") else process.num_fds()
+		return times.user + times.system, process.memory_info().rss // 1024, process.num_threads(), handles
+
+
+def read_process(pid):
+	"""(cpu seconds, rss kB, threads, handles) or None when the process is gone."""
+	try:
+		if os.path.isdir(PROC):
+			return _read_proc(pid)
+		return _read_psutil(pid)
+	except (OSError, IndexError, ValueError):
+		return None
+	except Exception as e:
+		if psutil and isinstance(e, psutil.Error):
+			return None
+		raise
+
+
+def available():
+	return os.path.isdir(PROC) or psutil is not None
+
+
+def summarize(samples):
+	"""JUnit properties [(name, value)] of {process: [(cpu, rss_kb, threads, handles)]}."""
+	properties = []
+	for label in sorted(samples):
+		rows = samples[label]
+		if not rows:
+			continue
+		prefix = "resources.%s." % label
+		cpu = [row[0] for row in rows if row[0] is not None]
+		if cpu:
+			properties.append((prefix + "cpu_max", "%.1f" % max(cpu)))
+			properties.append((prefix + "cpu_mean", "%.1f" % (sum(cpu) / len(cpu))))
+		for index, name in ((1, "rss_max_kb"), (2, "threads_max"), (3, "handles_max")):
+			values = [row[index] for row in rows if row[index] is not None]
+			if values:
+				properties.append((prefix + name, str(max(values))))
+		properties.append((prefix + "samples", str(len(rows))))
+	return properties
+
+
+class ResourceSampler():
+	def __init__(self, path, interval=1.0):
+		self.interval = interval
+		self.output = open(path, "a", encoding="utf-8")
+		self.lock = threading.Lock()
+		self.processes = {}
+		# pid -> (cpu seconds, wall time) of the previous sample, cpu% is taken over the time in between
+		self.previous = {}
+		# samples since the last test case ended
+		self.pending = {}
+		self.stopped = threading.Event()
+		self.thread = None
+		self.start_time = time.time()
+		self.output.write("# resources started %.3f\n# time\tprocess\tpid\tcpu%%\trss_kb\tthreads\thandles\n" % self.start_time)
+
+	def watch(self, label, pid):
+		with self.lock:
+			self.processes[label] = pid
+
+	def start(self):
+		self.thread = threading.Thread(target=self._run, daemon=True)
+		self.thread.start()
+
+	def _run(self):
+		while not self.stopped.wait(self.interval):
+			self.sample()
+
+	def sample(self):
+		with self.lock:
+			now = time.time()
+			for label, pid in sorted(self.processes.items()):
+				values = read_process(pid)
+				if values is None:
+					continue
+				cpu_seconds, rss, threads, handles = values
+				previous = self.previous.get(pid)
+				cpu = None
+				if previous is None:
+					self.previous[pid] = (cpu_seconds, now)
+				elif now - previous[1] >= MIN_CPU_WINDOW:
+					cpu = 100.0 * (cpu_seconds - previous[0]) / (now - previous[1])
+					self.previous[pid] = (cpu_seconds, now)
+				self.pending.setdefault(label, []).append((cpu, rss, threads, handles))
+				self.output.write("%.3f\t%s\t%d\t%s\t%d\t%d\t%s\n" % (now - self.start_time, label, pid,
+					"-" if cpu is None else "%.1f" % cpu, rss, threads, "-" if handles is None else handles))
+			self.output.flush()
+
+	def test_case(self, suite, test_case):
+		"""Properties summing up the samples since the previous test case, which also covers its setup and teardown."""
+		# a test shorter than the interval still gets a sample of its own
+		self.sample()
+		with self.lock:
+			samples, self.pending = self.pending, {}
+			self.output.write("# %.3f\t%s\t%s\t%s\n" % (time.time() - self.start_time, test_case["result"], suite, test_case["name"]))
+		return summarize(samples)
+
+	def close(self):
+		self.stopped.set()
+		if self.thread:
+			self.thread.join()
+		self.sample()
+		self.output.close()
+
+
+def read_series(path):
+	"""Yields ("sample", time, process, (cpu, rss_kb, threads, handles)) and ("test", time, result, suite, name) of a time series file."""
+	def number(text, kind):
+		return None if text == "-" else kind(text)
+	with open(path, encoding="utf-8") as f:
+		for line in f:
+			fields = line.rstrip("\n").split("\t")
+			if line.startswith("# ") and len(fields) == 4:
+				yield ("test", float(fields[0][2:]), fields[1], fields[2], fields[3])
+			elif not line.startswith("#") and len(fields) == 7:
+				yield ("sample", float(fields[0]), fields[1],
+					(number(fields[3], float), int(fields[4]), int(fields[5]), number(fields[6], int)))
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Sums up a resource time series written by TestRunner.py --resources per test case.")
+	parser.add_argument("series", help="Time series file")
+	parser.add_argument("--sort", choices=FIELDS, help="Lists the test cases by the peak of this value over all processes, highest first")
+	args = parser.parse_args()
+
+	rows, samples = [], {}
+	for record in read_series(args.series):
+		if record[0] == "sample":
+			samples.setdefault(record[2], []).append(record[3])
+		else:
+			rows.append((record, samples))
+			samples = {}
+	if args.sort:
+		index = FIELDS.index(args.sort)
+		def peak(row):
+			return max([sample[index] or 0 for values in row[1].values() for sample in values] or [0])
+		rows.sort(key=lambda row: -peak(row))
+	for (kind, at, result, suite, name), samples in rows:
+		print("%9.1fs %-5s %s %s" % (at, result, suite, name))
+		for prop, value in summarize(samples):
+			print("            %-36s %s" % (prop, value))
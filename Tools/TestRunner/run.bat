@@ -1,2 +1,13 @@
 python TestRunner.py --modemsim C:/BR/Appsy/IDPToolkit/Applications_v220/ModemSimulator.exe --firmwaredir C:/BR/Projektowe/Firmware --test test_SMTP_WhenHELOCommandCalled_ServerReturns250 --testoutput log.txt --instance 10
+REM with warm simulators from: python simpool.py --modemsim ... --firmwaredir ... --instance 10
+REM python TestRunner.py --pool http://localhost:7999 --test test_SMTP_WhenHELOCommandCalled_ServerReturns250 --testoutput log.txt
+REM failed tests of a regression again, 4 at a time, flaky ones marked in merged.xml:
+REM python TestRunner.py --modemsim ... --firmwaredir ... --instance 10 --parallel 4 --rerun result.xml --result merged.xml
+REM several results (shards, instances, reruns) in one report, tests passing on a rerun marked flaky:
+REM python ../OutputParser/junitmerge.py result_*.xml merged.xml --output report.xml --duplicates flaky
+REM only the tests the changes since origin/master can affect (python impact.py --base origin/master lists them):
+REM python TestRunner.py --modemsim ... --firmwaredir ... --instance 10 --parallel 4 --changed origin/master --result result.xml
+REM traffic of a failing test recorded once, then its checks rerun offline against the recording:
+REM python TestRunner.py --modemsim ... --firmwaredir ... --instance 10 --test test_Name --record traffic.bin
+REM python TestRunner.py --instance 10 --test test_Name --replay traffic.bin --replayspeed 0
 pause
\ No newline at end of file
@@ -0,0 +1,314 @@
+"""Virtual serial port between a simulator's RS232MainPort and the Lua tests, in place of a COM port pair.
+
+The simulator end is a pseudo-terminal. ModemSimulator.exe run through Wine
+gets it as COM<n> (a dosdevices/com<n> link to the pty); other simulators get
+the pty path. The test end is either a TCP socket, which RunAllModules.lua uses
+when started with -com tcp:localhost:<port> (Serial/SocketSerialWrapper.lua),
+or a second pseudo-terminal for io.Serial.
+
+Bytes are copied both ways by a selector loop in a background thread. Reads
+take up to 64 kB at a time and writes are buffered, so a slow reader only
+holds back its own direction. With a capture file every chunk is recorded
+with its time and direction:
+
+	python serialbridge.py --dump capture_10.bin
+
+Needs pseudo-terminals, so it runs on Linux; on Windows a com0com pair with
+--comportA/--comportB does the same.
+"""
+import argparse
+import errno
+import os
+import selectors
+import socket
+import struct
+import sys
+import threading
+import time
+import tty
+
+# the TCP test end of instance N listens on this + N
+SERIAL_PORT_BASE = 10000
+# Wine COM port of instance N is COM<com base + N>
+DEFAULT_COM_BASE = 100
+CHUNK = 65536
+# a direction stops reading its source while this much is waiting for a slow reader
+MAX_PENDING = 4 * 1024 * 1024
+
+TO_SIMULATOR = 0
+TO_TESTS = 1
+# capture record: time, direction, length, then the bytes
+CAPTURE_RECORD = struct.Struct("<dBI")
+CAPTURE_MAGIC = b"SERCAP1\n"
+
+
+def available():
+	return hasattr(os, "openpty")
+
+
+def wine_com_port(device, number):
+	"""Links dosdevices/com<number> of the Wine prefix to device and returns "COM<number>"."""
+	prefix = os.environ.get("WINEPREFIX") or os.path.join(os.path.expanduser("~"), ".wine")
+	link = os.path.join(prefix, "dosdevices", "com%d" % number)
+	if os.path.islink(link) or os.path.exists(link):
+		os.remove(link)
+	os.symlink(device, link)
+	return "COM%d" % number
+
+
+def _open_pty():
+	"""(master fd, slave fd, slave path) of a raw pseudo-terminal."""
+	master, slave = os.openpty()
+	# no echo, no line editing, no CR/LF translation: bytes pass as they are
+	tty.setraw(slave)
+	os.set_blocking(master, False)
+	return master, slave, os.ttyname(slave)
+
+
+class _Endpoint():
+	"""One end of the bridge: a pty master fd or a connected socket."""
+	def __init__(self, name, fd=None, sock=None):
+		self.name = name
+		self.fd = fd
+		self.sock = sock
+		self.pending = bytearray()
+		# selector events it is registered for, 0 when it is not
+		self.events = 0
+
+	def fileno(self):
+		return self.sock.fileno() if self.sock else self.fd
+
+	def read(self):
+		if self.sock:
+			return self.sock.recv(CHUNK)
+		return os.read(self.fd, CHUNK)
+
+	def write(self, data):
+		if self.sock:
+			return self.sock.send(data)
+		return os.write(self.fd, data)
+
+
+class SerialBridge():
+	def __init__(self, instance, tests_end="tcp", capture=None, com_base=DEFAULT_COM_BASE, wine=False):
+		self.instance = instance
+		self.tests_end = tests_end
+		self.capture_path = capture
+		self.com_base = com_base
+		self.wine = wine
+		self.selector = selectors.DefaultSelector()
+		self.stopped = False
+		self.thread = None
+		self.capture = None
+		self.listener = None
+		self.slaves = []
+		self.bytes = {TO_SIMULATOR : 0, TO_TESTS : 0}
+		self.simulator = None
+		self.tests = None
+		self.simulator_port = None
+		self.tests_port = None
+		# the waker wakes the loop up on close
+		self.waker, self.wake = socket.socketpair()
+
+	def start(self):
+		if not available():
+			raise Exception("The serial bridge needs pseudo-terminals (Linux); on Windows use a com0com pair with --comportA/--comportB")
+		master, slave, path = _open_pty()
+		# the slave stays open here too, so the master does not fail with EIO while the simulator has it closed
+		self.slaves.append(slave)
+		self.simulator = _Endpoint("simulator", fd=master)
+		self.simulator_port = wine_com_port(path, self.com_base + int(self.instance)) if self.wine else path
+		if self.tests_end == "pty":
+			master, slave, path = _open_pty()
+			self.slaves.append(slave)
+			self.tests = _Endpoint("tests", fd=master)
+			self.tests_port = path
+		else:
+			self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+			self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+			self.listener.bind(("localhost", SERIAL_PORT_BASE + int(self.instance)))
+			self.listener.listen(1)
+			self.listener.setblocking(False)
+			self.selector.register(self.listener, selectors.EVENT_READ, "accept")
+			self.tests_port = "tcp:localhost:%d" % (SERIAL_PORT_BASE + int(self.instance))
+		if self.capture_path:
+			self.capture = open(self.capture_path, "wb")
+			self.capture.write(CAPTURE_MAGIC)
+		self.selector.register(self.waker, selectors.EVENT_READ, "wake")
+		self._register(self.simulator)
+		if self.tests:
+			self._register(self.tests)
+		self.start_time = time.time()
+		self.thread = threading.Thread(target=self._run, daemon=True)
+		self.thread.start()
+		print("Serial bridge of instance %s: simulator %s, tests %s" % (self.instance, self.simulator_port, self.tests_port))
+		return self
+
+	def _peer(self, endpoint):
+		return self.tests if endpoint is self.simulator else self.simulator
+
+	def _register(self, endpoint):
+		endpoint.events = selectors.EVENT_READ
+		self.selector.register(endpoint, endpoint.events, "data")
+
+	def _update(self, endpoint):
+		"""Reads while its peer's backlog is small, waits for writability while it has a backlog of its own."""
+		peer = self._peer(endpoint)
+		events = 0
+		if peer is None or len(peer.pending) < MAX_PENDING:
+			events |= selectors.EVENT_READ
+		if endpoint.pending:
+			events |= selectors.EVENT_WRITE
+		if events == endpoint.events:
+			return
+		if not events:
+			# the peer draining its backlog registers it again
+			self.selector.unregister(endpoint)
+		elif not endpoint.events:
+			self.selector.register(endpoint, events, "data")
+		else:
+			self.selector.modify(endpoint, events, "data")
+		endpoint.events = events
+
+	def _record(self, direction, data):
+		self.bytes[direction] += len(data)
+		if self.capture:
+			self.capture.write(CAPTURE_RECORD.pack(time.time() - self.start_time, direction, len(data)))
+			self.capture.write(data)
+
+	def _accept(self):
+		client, address = self.listener.accept()
+		client.setblocking(False)
+		client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		if self.tests:
+			# a new test run replaces the connection of the previous one
+			self._drop_tests()
+		self.tests = _Endpoint("tests", sock=client)
+		self._register(self.tests)
+		self._update(self.simulator)
+
+	def _drop_tests(self):
+		if self.tests.events:
+			self.selector.unregister(self.tests)
+		self.tests.sock.close()
+		self.tests = None
+		self._update(self.simulator)
+
+	def _flush(self, endpoint):
+		while endpoint.pending:
+			try:
+				sent = endpoint.write(endpoint.pending)
+			except BlockingIOError:
+				break
+			del endpoint.pending[:sent]
+
+	def _transfer(self, endpoint, mask):
+		if mask & selectors.EVENT_WRITE:
+			self._flush(endpoint)
+			peer = self._peer(endpoint)
+			if peer is not None:
+				self._update(peer)
+		if mask & selectors.EVENT_READ:
+			try:
+				data = endpoint.read()
+			except BlockingIOError:
+				data = None
+			except OSError as e:
+				if e.errno != errno.EIO:
+					raise
+				data = None
+			if data == b"" and endpoint.sock:
+				# the test run closed its serial port
+				self._drop_tests()
+				return
+			if data:
+				direction = TO_TESTS if endpoint is self.simulator else TO_SIMULATOR
+				self._record(direction, data)
+				peer = self._peer(endpoint)
+				# without a connected test run the simulator output is lost, like on an unplugged COM port
+				if peer is not None:
+					peer.pending += data
+					self._flush(peer)
+					self._update(peer)
+		self._update(endpoint)
+
+	def _run(self):
+		try:
+			while not self.stopped:
+				for key, mask in self.selector.select():
+					if key.data == "wake":
+						return
+					if key.data == "accept":
+						self._accept()
+					elif key.fileobj is self.simulator or key.fileobj is self.tests:
+						try:
+							self._transfer(key.fileobj, mask)
+						except ConnectionError:
+							# only the test end is a socket
+							if self.tests is not None and self.tests.sock:
+								self._drop_tests()
+		finally:
+			if self.capture:
+				self.capture.close()
+
+	def close(self):
+		if self.stopped:
+			return
+		self.stopped = True
+		self.wake.send(b"x")
+		if self.thread:
+			self.thread.join()
+		for endpoint in (self.simulator, self.tests):
+			if endpoint is None:
+				continue
+			if endpoint.sock:
+				endpoint.sock.close()
+			else:
+				os.close(endpoint.fd)
+		for fd in self.slaves:
+			os.close(fd)
+		if self.listener:
+			self.listener.close()
+		self.waker.close()
+		self.wake.close()
+		self.selector.close()
+		print("Serial bridge of instance %s closed: %d bytes to the simulator, %d to the tests" % (
+			self.instance, self.bytes[TO_SIMULATOR], self.bytes[TO_TESTS]))
+
+
+def read_capture(path):
+	"""Yields (seconds from the bridge start, direction, bytes) of a capture file."""
+	with open(path, "rb") as f:
+		if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+			raise Exception("Not a serial bridge capture: " + path)
+		while True:
+			header = f.read(CAPTURE_RECORD.size)
+			if len(header) < CAPTURE_RECORD.size:
+				return
+			at, direction, length = CAPTURE_RECORD.unpack(header)
+			yield at, direction, f.read(length)
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Virtual serial port for a simulator instance, or dump of a capture file.")
+	parser.add_argument("--instance", default="0", help="Instance number, the TCP end listens on %d+N" % SERIAL_PORT_BASE)
+	parser.add_argument("--tests", choices=("tcp", "pty"), default="tcp", help="Test end of the bridge")
+	parser.add_argument("--capture", help="Records every byte with its time and direction to this file")
+	parser.add_argument("--wine", action="store_true", help="Give the simulator end as a Wine COM port")
+	parser.add_argument("--com", type=int, default=DEFAULT_COM_BASE, help="With --wine the simulator end is COM<this + instance>")
+	parser.add_argument("--dump", help="Prints a capture file instead of running a bridge")
+	args = parser.parse_args()
+
+	if args.dump:
+		for at, direction, data in read_capture(args.dump):
+			print("%10.3f %s %r" % (at, ">" if direction == TO_SIMULATOR else "<", data))
+		sys.exit(0)
+
+	bridge = SerialBridge(args.instance, args.tests, args.capture, args.com, args.wine).start()
+	try:
+		while True:
+			time.sleep(3600)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		bridge.close()
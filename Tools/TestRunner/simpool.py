@@ -0,0 +1,394 @@
+"""Pool of warm modem simulator instances shared by TestRunner.py runs.
+
+Booting ModemSimulator.exe and loading the PackageFiles is the slowest part of
+a short run, e.g. a single test rerun from run.bat. The pool keeps simulators
+running on their fixed instance ports (8000+N, with --gateway behind the
+gateway stand-in like TestRunner.py does) and leases them out:
+
+	GET /lease?client=<name>&timeout=<s>   blocks until an instance is free, {"lease", "instance", "port", "gateway", ...}
+	GET /release?lease=<id>                hands it back
+	GET /status                            instances, their state and lease/boot timings
+
+Between leases an instance is health checked (process alive, web services
+answering) and reset: the properties of --resetsins go back to their defaults
+(system service resetProperties, idle only once the terminal answers a
+getProperties sent after it) and the GPS simulator to gps.set defaults.
+After a failed check, a crash, an expired lease or --maxleases leases the
+simulator is restarted instead.
+
+	python simpool.py --modemsim ModemSimulator.exe --firmwaredir C:/Firmware --instance 10 --count 4
+	python TestRunner.py --pool http://localhost:7999 --test test_SMTP_WhenHELOCommandCalled_ServerReturns250
+"""
+import argparse
+import http.server
+import json
+import os
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+from TestRunner import GATEWAY_SUFFIX, instance_port, serial_port, start_instance, web_service_ready
+import serialbridge
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Gateway"))
+import gpsservice
+
+# system service resetProperties and getProperties, see lsf.resetProperties and lsf.getProperties in TestFramework.lua
+SYSTEM_SIN = 16
+GET_PROPERTIES_MIN = 8
+RESET_PROPERTIES_MIN = 10
+# propertyValues, the answer to getProperties
+PROPERTY_VALUES_MIN = 5
+
+IDLE = "idle"
+LEASED = "leased"
+PREPARING = "preparing"
+BOOTING = "booting"
+FAILED = "failed"
+
+
+class PooledInstance():
+	def __init__(self, instance):
+		self.instance = instance
+		self.port = instance_port(instance)
+		self.state = BOOTING
+		self.modemsim = None
+		self.gateway = None
+		self.leases = 0             # leases since the last boot
+		self.total_leases = 0
+		self.boots = 0
+		self.boot_time = None
+		self.prepare_time = None
+		self.lease_id = None
+		self.client = None
+		self.leased_at = None
+		self.error = None
+		self.failed_at = None
+
+	def processes(self):
+		processes = {}
+		if self.modemsim and self.modemsim.process:
+			processes["modemsim"] = self.modemsim.process.pid
+		if self.gateway and self.gateway.process:
+			processes["gateway"] = self.gateway.process.pid
+		return processes
+
+	def describe(self):
+		return {
+			"instance" : self.instance,
+			"port" : self.port,
+			"state" : self.state,
+			"leases" : self.leases,
+			"total_leases" : self.total_leases,
+			"boots" : self.boots,
+			"boot_time" : self.boot_time,
+			"prepare_time" : self.prepare_time,
+			"client" : self.client,
+			"leased_for" : time.time() - self.leased_at if self.state == LEASED else None,
+			"error" : self.error,
+		}
+
+
+class SimulatorPool():
+	def __init__(self, args, instances, max_leases=50, reset_sins=(), lease_timeout=3600, retry_interval=30):
+		self.args = args
+		self.instances = [PooledInstance(instance) for instance in instances]
+		self.max_leases = max_leases
+		self.reset_sins = list(reset_sins)
+		self.lease_timeout = lease_timeout
+		self.retry_interval = retry_interval
+		self.condition = threading.Condition()
+		self.next_lease = 1
+		self.next_message_id = 1
+		self.stopping = False
+
+	def start(self):
+		for slot in self.instances:
+			self._in_background(self._boot, slot)
+		self._in_background(self._monitor)
+
+	def _in_background(self, target, *args):
+		thread = threading.Thread(target=target, args=args)
+		thread.daemon = True
+		thread.start()
+
+	def _set_state(self, slot, state, error=None):
+		with self.condition:
+			slot.state = state
+			slot.error = error
+			if state == FAILED:
+				slot.failed_at = time.time()
+			self.condition.notify_all()
+
+	# ---- simulator lifecycle ----
+
+	def _stop(self, slot):
+		for process in (slot.modemsim, slot.gateway):
+			if process is None:
+				continue
+			try:
+				process.close()
+			except Exception:
+				pass
+		if slot.modemsim and slot.modemsim.process:
+			slot.modemsim.process.wait()
+		slot.modemsim = slot.gateway = None
+
+	def _boot(self, slot):
+		self._set_state(slot, BOOTING)
+		self._stop(slot)
+		start = time.time()
+		try:
+			slot.modemsim, slot.gateway = start_instance(self.args, slot.instance)
+		except Exception as e:
+			print("Instance %s failed to start: %s" % (slot.instance, e))
+			self._set_state(slot, FAILED, str(e))
+			return
+		slot.boot_time = time.time() - start
+		slot.boots += 1
+		slot.leases = 0
+		# a fresh simulator still gets the reset, its terminal may keep properties from an earlier run
+		self._prepare(slot, booted=True)
+
+	def _healthy(self, slot):
+		if not slot.modemsim or slot.modemsim.process.poll() is not None:
+			return False
+		if slot.gateway:
+			slot.gateway.ensure_running(self.args.readytimeout)
+		return all(web_service_ready(url) for url in slot.modemsim.probe_urls())
+
+	def _gateway(self, base, resource, params=None, body=None):
+		url = "%s%s/%s/" % (base, GATEWAY_SUFFIX, resource)
+		if params:
+			url += "?" + urllib.parse.urlencode(params)
+		request = urllib.request.Request(url, data=body, headers={"Content-Type" : "application/json"},
+			method="POST" if body is not None else "GET")
+		with urllib.request.urlopen(request, timeout=30) as response:
+			return json.loads(response.read().decode("utf-8"))
+
+	def _wait_for_return(self, base, start_utc, sin, min_):
+		"""Polls get_return_messages from start_utc until a message sin/min_ arrives, for at most --readytimeout."""
+		deadline = time.time() + self.args.readytimeout
+		params = {"access_id" : self.args.accessid, "password" : self.args.password}
+		while True:
+			params["start_utc"] = start_utc
+			result = self._gateway(base, "get_return_messages.json", params)
+			if result.get("ErrorID") == 0:
+				for message in result.get("Messages") or []:
+					if message.get("SIN") == sin and (message.get("Payload") or {}).get("MIN") == min_:
+						return
+				start_utc = result.get("NextStartUTC") or start_utc
+			if time.time() > deadline:
+				raise Exception("No answer of the terminal to SIN %d MIN %d within %ds" % (sin, min_, self.args.readytimeout))
+			time.sleep(1)
+
+	def _reset(self, slot):
+		base = "http://localhost:%d" % slot.port
+		if self.reset_sins:
+			with self.condition:
+				message_id = self.next_message_id
+				self.next_message_id += 2
+			reset = {"SIN" : SYSTEM_SIN, "MIN" : RESET_PROPERTIES_MIN, "Fields" : [{"Name" : "list", "Elements" : [
+				{"Index" : index, "Fields" : [{"Name" : "sin", "Value" : sin}]} for index, sin in enumerate(self.reset_sins)]}]}
+			# an empty pinList asks for every property of the service
+			read_back = {"SIN" : SYSTEM_SIN, "MIN" : GET_PROPERTIES_MIN, "Fields" : [{"Name" : "list", "Elements" : [
+				{"Index" : index, "Fields" : [{"Name" : "sin", "Value" : sin}, {"Name" : "pinList", "Value" : ""}]}
+				for index, sin in enumerate(self.reset_sins)]}]}
+			body = json.dumps({"accessID" : self.args.accessid, "password" : self.args.password, "messages" : [
+				{"DestinationID" : self.args.mobileid, "UserMessageID" : message_id + index, "Payload" : payload}
+				for index, payload in enumerate((reset, read_back))]}).encode("utf-8")
+			start_utc = self._gateway(base, "info_utc_time.json")
+			result = self._gateway(base, "submit_messages.json", body=body)["SubmitForwardMessages_JResult"]
+			if result["ErrorID"] != 0:
+				raise Exception("Property reset not submitted, gateway ErrorID %s" % result["ErrorID"])
+			# the terminal handles forward messages in order, the properties it sends back are the reset ones
+			self._wait_for_return(base, start_utc, SYSTEM_SIN, PROPERTY_VALUES_MIN)
+		if slot.gateway:
+			# a track left running by the previous lease would keep moving the GPS
+			urllib.request.urlopen(base + gpsservice.GPS_PREFIX + "/stop_track.json/", timeout=30).close()
+		for resource, params in gpsservice.resource_params(gpsservice.DEFAULTS):
+			urllib.request.urlopen("%s%s/%s.json/?%s" % (base, gpsservice.GPS_PREFIX, resource, urllib.parse.urlencode(params)),
+				timeout=30).close()
+
+	def _prepare(self, slot, booted=False):
+		"""Health check and reset, the instance is restarted when either fails (left failed when it was just started)."""
+		self._set_state(slot, PREPARING)
+		start = time.time()
+		try:
+			if not self._healthy(slot):
+				raise Exception("health check failed")
+			self._reset(slot)
+		except Exception as e:
+			if booted:
+				print("Instance %s failed its first check: %s" % (slot.instance, e))
+				self._set_state(slot, FAILED, str(e))
+			else:
+				print("Instance %s needs a restart: %s" % (slot.instance, e))
+				self._boot(slot)
+			return
+		slot.prepare_time = time.time() - start
+		self._set_state(slot, IDLE)
+
+	def _recycle(self, slot):
+		if slot.leases >= self.max_leases:
+			print("Instance %s recycled after %d leases" % (slot.instance, slot.leases))
+			self._boot(slot)
+		else:
+			self._prepare(slot)
+
+	def _monitor(self):
+		"""Restarts idle simulators that died, retries failed boots and takes back expired leases."""
+		while not self.stopping:
+			time.sleep(min(self.retry_interval, 5))
+			now = time.time()
+			for slot in self.instances:
+				with self.condition:
+					if slot.state == IDLE and (not slot.modemsim or slot.modemsim.process.poll() is not None):
+						print("Instance %s exited while idle, restarting" % slot.instance)
+						slot.state, action = BOOTING, self._boot
+					elif slot.state == FAILED and now - slot.failed_at > self.retry_interval:
+						slot.state, action = BOOTING, self._boot
+					elif slot.state == LEASED and now - slot.leased_at > self.lease_timeout:
+						print("Lease %s of instance %s by %s expired" % (slot.lease_id, slot.instance, slot.client))
+						slot.lease_id = slot.client = None
+						slot.state, action = PREPARING, self._recycle
+					else:
+						continue
+				self._in_background(action, slot)
+
+	# ---- leases ----
+
+	def lease(self, client, timeout):
+		deadline = time.time() + timeout
+		with self.condition:
+			while True:
+				idle = [slot for slot in self.instances if slot.state == IDLE]
+				if idle:
+					break
+				remaining = deadline - time.time()
+				if remaining <= 0 or self.stopping:
+					return None
+				self.condition.wait(remaining)
+			# the least used instance, so recycling is spread out
+			slot = min(idle, key=lambda slot: slot.leases)
+			slot.state = LEASED
+			slot.lease_id = self.next_lease
+			self.next_lease += 1
+			slot.leases += 1
+			slot.total_leases += 1
+			slot.client = client
+			slot.leased_at = time.time()
+			return {
+				"lease" : slot.lease_id,
+				"instance" : slot.instance,
+				"port" : slot.port,
+				"gateway" : slot.gateway is not None,
+				"leases" : slot.leases,
+				"max_leases" : self.max_leases,
+				"boot_time" : slot.boot_time,
+				"processes" : slot.processes(),
+				"serial" : serial_port(slot.modemsim),
+			}
+
+	def release(self, lease_id):
+		with self.condition:
+			for slot in self.instances:
+				if slot.state == LEASED and slot.lease_id == lease_id:
+					slot.lease_id = None
+					slot.client = None
+					slot.state = PREPARING
+					break
+			else:
+				return False
+		self._in_background(self._recycle, slot)
+		return True
+
+	def status(self):
+		with self.condition:
+			return {"instances" : [slot.describe() for slot in self.instances], "max_leases" : self.max_leases}
+
+	def close(self):
+		with self.condition:
+			self.stopping = True
+			self.condition.notify_all()
+		for slot in self.instances:
+			self._stop(slot)
+
+
+class PoolRequestHandler(http.server.BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+
+	def _answer(self, status, value):
+		content = json.dumps(value).encode("utf-8")
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json; charset=utf-8")
+		self.send_header("Content-Length", str(len(content)))
+		self.end_headers()
+		self.wfile.write(content)
+
+	def do_GET(self):
+		pool = self.server.pool
+		url = urllib.parse.urlsplit(self.path)
+		path = url.path.rstrip("/")
+		params = dict(urllib.parse.parse_qsl(url.query))
+		try:
+			if path == "/lease":
+				leased = pool.lease(params.get("client", self.client_address[0]), float(params.get("timeout", 600)))
+				if leased is None:
+					self._answer(503, {"error" : "no instance became free"})
+				else:
+					print("Lease %d: instance %s to %s" % (leased["lease"], leased["instance"], params.get("client")))
+					self._answer(200, leased)
+			elif path == "/release":
+				if pool.release(int(params["lease"])):
+					self._answer(200, {})
+				else:
+					self._answer(404, {"error" : "unknown lease " + params["lease"]})
+			elif path == "/status":
+				self._answer(200, pool.status())
+			else:
+				self._answer(404, {"error" : "unknown resource " + path})
+		except (KeyError, ValueError) as e:
+			self._answer(400, {"error" : "bad request: %s" % e})
+
+	def log_message(self, format, *args):
+		pass
+
+
+if __name__ == "__main__":
+	argparser = argparse.ArgumentParser(description="Keeps modem simulators running and leases them to TestRunner.py --pool runs.")
+	argparser.add_argument("--modemsim", help="Specifies path to IDP Modem Simulator", required=True)
+	argparser.add_argument("--firmwaredir", help="Specifies path firmware directory", required=True)
+	argparser.add_argument("--instance", help="First instance number, instances use ports 8000+N", default="0")
+	argparser.add_argument("--count", help="Number of simulator instances", type=int, default=1)
+	argparser.add_argument("--port", help="Port of the pool's own web service", type=int, default=7999)
+	argparser.add_argument("--maxleases", help="Restart a simulator after this many leases", type=int, default=50)
+	argparser.add_argument("--resetsins", help="Comma separated SINs whose properties are reset between leases", default="115")
+	argparser.add_argument("--leasetimeout", help="Seconds after which a lease that was not released is taken back", type=float, default=3600)
+	argparser.add_argument("--readytimeout", help="Seconds to wait for simulator web services to answer", type=float, default=60)
+	argparser.add_argument("--gateway", help="Puts the Tools/Gateway stand-in in front of every simulator, like TestRunner.py --gateway", action="store_true")
+	argparser.add_argument("--serialbridge", choices=("tcp", "pty"), help="Gives every simulator a virtual serial port, like TestRunner.py --serialbridge")
+	argparser.add_argument("--serialcapture", help="Records the serial bridge traffic, instance number is appended to the file name")
+	argparser.add_argument("--serialcom", type=int, default=serialbridge.DEFAULT_COM_BASE, help="Under Wine the simulator end of instance N is COM<this + N>")
+	argparser.add_argument("--accessid", default="00000000")
+	argparser.add_argument("--password", default="password")
+	argparser.add_argument("--mobileid", default="00000000SKYEE3D")
+	args = argparser.parse_args()
+
+	instances = [str(int(args.instance) + i) for i in range(args.count)]
+	reset_sins = [int(sin) for sin in args.resetsins.split(",") if sin.strip()]
+	pool = SimulatorPool(args, instances, args.maxleases, reset_sins, args.leasetimeout)
+	server = http.server.ThreadingHTTPServer(("localhost", args.port), PoolRequestHandler)
+	server.daemon_threads = True
+	server.pool = pool
+	pool.start()
+	print("Simulator pool of instance(s) %s listening on port %d" % (", ".join(instances), args.port), flush=True)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		pool.close()
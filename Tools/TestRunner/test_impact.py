@@ -0,0 +1,209 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import impact
+
+# a test tree laid out like the real one: the entry assigns the framework and wrapper globals, the suites use them
+TREE = {
+	"RunAllModules.lua" : """require("Wrapper/MyWrapper")
+cfg, framework = require "TestFramework"()
+lunatest = require "lunatest"
+
+myWrapper = MyWrapper()
+
+lunatest.suite("TestAModule")
+lunatest.suite("TestBModule")
+lunatest.suite("TestCModule")
+lunatest.run()
+""",
+	"lunatest.lua" : """local lunatest = {}
+return lunatest
+""",
+	"TestFramework.lua" : """-- framework of the tests
+local function now()
+  return os.time()
+end
+
+return function()
+  local framework = {}
+  function framework.delay(seconds)
+    return now() + seconds
+  end
+  return {}, framework
+end
+""",
+	"Wrapper/MyWrapper.lua" : """MyWrapper = {}
+
+function MyWrapper:send(value)
+  return value
+end
+""",
+	# the wrapper is used by suite_setup, every test depends on it
+	"TestAModule.lua" : """module("TestAModule", package.seeall)
+
+local delay = framework.delay
+
+function suite_setup()
+  myWrapper:send(1)
+end
+
+function test_A1()
+  delay(1)
+end
+
+function test_A2()
+  delay(2)
+end
+""",
+	# the wrapper is used by one test
+	"TestBModule.lua" : """module("TestBModule", package.seeall)
+
+local delay = framework.delay
+
+function test_B1()
+  myWrapper:send(2)
+end
+
+function test_B2()
+  delay(1)
+end
+""",
+	"TestCModule.lua" : """module("TestCModule", package.seeall)
+
+local delay = framework.delay
+
+function test_C1()
+  delay(3)
+end
+""",
+}
+
+
+class TestImpact(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.root = self.directory.name
+		for path, content in TREE.items():
+			self.write(path, content)
+
+	def tearDown(self):
+		self.directory.cleanup()
+
+	def write(self, path, content):
+		path = os.path.join(self.root, path)
+		if not os.path.isdir(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		with open(path, "w", encoding="utf-8") as f:
+			f.write(content)
+
+	def select(self, changes):
+		selection, reasons, notes = impact.select(impact.load_graph(self.root), changes)
+		return selection, reasons, notes
+
+	def test_changed_test_function_selects_that_test(self):
+		selection, reasons, notes = self.select({"TestBModule.lua" : {10}})
+		self.assertEqual(selection, {"TestBModule" : ["test_B2"]})
+		self.assertEqual(reasons[("TestBModule", "test_B2")], ["TestBModule.test_B2"])
+
+	def test_changed_wrapper_selects_dependent_suites(self):
+		selection, reasons, notes = self.select({"Wrapper/MyWrapper.lua" : {4}})
+		# whole TestAModule through suite_setup, only the test of TestBModule using it, nothing of TestCModule
+		self.assertEqual(selection, {"TestAModule" : None, "TestBModule" : ["test_B1"]})
+		self.assertEqual(reasons["TestAModule"], ["TestAModule.suite_setup", "myWrapper", "MyWrapper", "Wrapper/MyWrapper.lua"])
+
+	def test_changed_wrapper_chosen_in_if_block(self):
+		self.write("RunAllModules.lua", TREE["RunAllModules.lua"].replace("lunatest.suite(\"TestAModule\")", """if string.match(ComPort, "^tcp:") then
+  require("Serial/SocketSerialWrapper")
+  serialMain = SocketSerialWrapper()
+else
+  require("Serial/RealSerialWrapper")
+  serialMain = RealSerialWrapper()
+end
+
+lunatest.suite("TestAModule")"""))
+		self.write("Serial/SerialWrapper.lua", "SerialWrapper = {}\n\nfunction SerialWrapper:write(text)\n  return text\nend\n")
+		for name in ("SocketSerialWrapper", "RealSerialWrapper"):
+			self.write("Serial/%s.lua" % name, 'require "Serial/SerialWrapper"\n%s = setmetatable({}, {__index = SerialWrapper})\n' % name)
+		self.write("TestCModule.lua", TREE["TestCModule.lua"] + "\nfunction test_C2()\n  serialMain:write(\"at\")\nend\n")
+		selection, reasons, notes = self.select({"Serial/SerialWrapper.lua" : {4}})
+		self.assertEqual(selection, {"TestCModule" : ["test_C2"]})
+		self.assertEqual(reasons[("TestCModule", "test_C2")],
+			["TestCModule.test_C2", "serialMain", "Serial/SocketSerialWrapper.lua", "Serial/SerialWrapper.lua"])
+		# the condition picks the wrapper, a change of it is a change of serialMain, not of the whole runner
+		selection, reasons, notes = self.select({"RunAllModules.lua" : {7}})
+		self.assertEqual(selection, {"TestCModule" : ["test_C2"]})
+
+	def test_changed_framework_selects_everything(self):
+		selection, reasons, notes = self.select({"TestFramework.lua" : {9}})
+		self.assertEqual(selection, {"TestAModule" : None, "TestBModule" : None, "TestCModule" : None})
+
+	def test_runner_and_comments(self):
+		selection, reasons, notes = self.select({"lunatest.lua" : {1}})
+		self.assertEqual(set(selection), {"TestAModule", "TestBModule", "TestCModule"})
+		self.assertEqual(notes, ["lunatest.lua runs every test"])
+		# a comment is in no statement
+		self.assertEqual(self.select({"TestFramework.lua" : {1}})[0], {})
+		# Python tooling does not reach the tests
+		selection, reasons, notes = self.select({"Tools/TestRunner/impact.py" : {1}})
+		self.assertEqual(selection, {})
+
+	def test_work_items(self):
+		selection, reasons, notes = self.select({"Wrapper/MyWrapper.lua" : {4}})
+		self.assertEqual(impact.work_items(selection),
+			[("TestAModule", "TestAModule", None), ("TestBModule-changed", "TestBModule", ["test_B1"])])
+
+	def test_parse_diff(self):
+		changes = impact.parse_diff("""diff --git a/TestBModule.lua b/TestBModule.lua
+--- a/TestBModule.lua
++++ b/TestBModule.lua
+@@ -9,0 +10,2 @@ function test_B2()
++  delay(1)
++  delay(2)
+@@ -20 +22,0 @@
+-  removed()
+--- a/Old.lua
++++ /dev/null
+@@ -1 +0,0 @@
+-gone
+""")
+		self.assertEqual(changes, {"TestBModule.lua" : {10, 11, 22, 23}, "Old.lua" : None})
+
+	def test_cache_follows_file_sha(self):
+		cache_path = os.path.join(self.root, impact.CACHE_NAME)
+		files = impact.scan_tree(self.root)
+		self.assertTrue(os.path.exists(cache_path))
+		old_sha1 = files["Wrapper/MyWrapper.lua"]["sha1"]
+
+		scanned = []
+		scan_file = impact.scan_file
+		def counting_scan(path):
+			scanned.append(os.path.relpath(path, self.root).replace(os.sep, "/"))
+			return scan_file(path)
+		impact.scan_file = counting_scan
+		try:
+			# nothing changed, nothing scanned again
+			impact.scan_tree(self.root)
+			self.assertEqual(scanned, [])
+			self.write("Wrapper/MyWrapper.lua", TREE["Wrapper/MyWrapper.lua"] + "\nfunction MyWrapper:receive()\n  return nil\nend\n")
+			files = impact.scan_tree(self.root)
+		finally:
+			impact.scan_file = scan_file
+		self.assertEqual(scanned, ["Wrapper/MyWrapper.lua"])
+		self.assertNotEqual(files["Wrapper/MyWrapper.lua"]["sha1"], old_sha1)
+		self.assertEqual(len(files["Wrapper/MyWrapper.lua"]["units"]), 3)
+		# the new function is a change of the wrapper as well
+		selection, reasons, notes = self.select({"Wrapper/MyWrapper.lua" : {8}})
+		self.assertEqual(selection, {"TestAModule" : None, "TestBModule" : ["test_B1"]})
+
+	def test_cache_of_other_version_is_ignored(self):
+		with open(os.path.join(self.root, impact.CACHE_NAME), "w", encoding="utf-8") as f:
+			f.write('{"version": 0, "files": {"TestAModule.lua": {"sha1": "x", "units": []}}}')
+		files = impact.scan_tree(self.root)
+		self.assertTrue(files["TestAModule.lua"]["units"])
+
+
+if __name__ == "__main__":
+	unittest.main()
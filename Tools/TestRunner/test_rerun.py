@@ -0,0 +1,166 @@
+import os
+import sys
+import tempfile
+import unittest
+import xml.etree.ElementTree as ET
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import rerun
+import history
+import testoutparse
+from test_history import record_run
+
+# a report of testoutparse.py, counts padded the way JUnitWriter keeps them up to date
+REPORT = """<?xml version="1.0" encoding="utf-8"?>
+<testsuites name="VMS Feature Tests">
+	<testsuite name="TestSuiteA" tests="4" failures="3" errors="0" skipped="0"      >
+		<testcase name="Group: When Ok - Passes" classname="TestSuiteA" time="1.0">
+			<properties>
+				<property name="test" value="test_Group_WhenOk_Passes" />
+			</properties>
+		</testcase>
+		<testcase name="Group: When Flaky - Passes" classname="TestSuiteA" time="2.0">
+			<properties>
+				<property name="test" value="test_Group_WhenFlaky_Passes" />
+			</properties>
+			<failure message="timeout waiting for message" />
+		</testcase>
+		<testcase name="Group: When Broken - Fails" classname="TestSuiteA" time="0.5">
+			<properties>
+				<property name="test" value="test_Group_WhenBroken_Fails" />
+			</properties>
+			<failure message="wrong value" />
+		</testcase>
+		<testcase name="Group: When Lost - Fails" classname="TestSuiteA" time="0.5">
+			<properties>
+				<property name="test" value="test_Group_WhenLost_Fails" />
+			</properties>
+			<failure message="simulator gone" />
+		</testcase>
+	</testsuite>
+	<testsuite name="TestSuiteB" tests="1" failures="0" errors="1" skipped="0"      >
+		<testcase name="Other: When Run - Errors" classname="TestSuiteB" time="0.25">
+			<error message="attempt to index a nil value" />
+		</testcase>
+	</testsuite>
+</testsuites>
+"""
+
+RERUN_FLAKY = """<?xml version="1.0" encoding="utf-8"?>
+<testsuites name="VMS Feature Tests">
+	<testsuite name="TestSuiteA">
+		<testcase name="Group: When Flaky - Passes" classname="TestSuiteA" time="2.5">
+			<properties>
+				<property name="test" value="test_Group_WhenFlaky_Passes" />
+			</properties>
+		</testcase>
+	</testsuite>
+</testsuites>
+"""
+
+RERUN_BROKEN = """<?xml version="1.0" encoding="utf-8"?>
+<testsuites name="VMS Feature Tests">
+	<testsuite name="TestSuiteA">
+		<testcase name="Group: When Broken - Fails" classname="TestSuiteA" time="0.5">
+			<properties>
+				<property name="test" value="test_Group_WhenBroken_Fails" />
+			</properties>
+			<failure message="wrong value again" />
+			<system-out>rerun output</system-out>
+		</testcase>
+	</testsuite>
+</testsuites>
+"""
+
+# TestSuiteB written without test name properties, discovery maps the JUnit name back
+RERUN_ERROR = """<?xml version="1.0" encoding="utf-8"?>
+<testsuites name="VMS Feature Tests">
+	<testsuite name="TestSuiteB">
+		<testcase name="Other: When Run - Errors" classname="TestSuiteB" time="0.25" />
+	</testsuite>
+</testsuites>
+"""
+
+DISCOVERED = {
+	"TestSuiteA" : {"tests" : [{"name" : name, "annotations" : {}} for name in ("test_Group_WhenOk_Passes",
+		"test_Group_WhenFlaky_Passes", "test_Group_WhenBroken_Fails", "test_Group_WhenLost_Fails")]},
+	"TestSuiteB" : {"tests" : [{"name" : "test_Other_WhenRun_Errors", "annotations" : {}}]},
+}
+
+
+class TestRerun(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.report = self.write("result.xml", REPORT)
+		self.names = rerun.readable_names(DISCOVERED)
+
+	def tearDown(self):
+		self.directory.cleanup()
+
+	def write(self, name, content):
+		path = os.path.join(self.directory.name, name)
+		with open(path, "w", encoding="utf-8") as f:
+			f.write(content)
+		return path
+
+	def merge(self):
+		root, failed = rerun.load_report(self.report, DISCOVERED)
+		results = rerun.rerun_results([self.write("rerun1.xml", RERUN_FLAKY), self.write("rerun2.xml", RERUN_BROKEN),
+			self.write("rerun3.xml", RERUN_ERROR), None], self.names)
+		outcomes = rerun.merge(root, failed, results, self.names)
+		output = os.path.join(self.directory.name, "merged.xml")
+		rerun.write(root, output)
+		merged = ET.parse(output).getroot()
+		return outcomes, merged, dict((test, case) for suite, test, case in rerun.cases(merged, self.names))
+
+	def test_failed_tests_of_report(self):
+		root, failed = rerun.load_report(self.report, DISCOVERED)
+		self.assertEqual(failed, [("TestSuiteA", "test_Group_WhenFlaky_Passes"), ("TestSuiteA", "test_Group_WhenBroken_Fails"),
+			("TestSuiteA", "test_Group_WhenLost_Fails"), ("TestSuiteB", "test_Other_WhenRun_Errors")])
+
+	def test_unknown_tests_are_not_rerun(self):
+		discovered = {"TestSuiteA" : DISCOVERED["TestSuiteA"]}
+		root, failed = rerun.load_report(self.report, discovered)
+		self.assertNotIn(("TestSuiteB", "test_Other_WhenRun_Errors"), failed)
+
+	def test_outcomes(self):
+		outcomes, merged, cases = self.merge()
+		self.assertEqual(outcomes[rerun.FLAKY], [("TestSuiteA", "test_Group_WhenFlaky_Passes"), ("TestSuiteB", "test_Other_WhenRun_Errors")])
+		self.assertEqual(outcomes[rerun.STILL_FAILING], [("TestSuiteA", "test_Group_WhenBroken_Fails")])
+		self.assertEqual(outcomes[rerun.NOT_RERUN], [("TestSuiteA", "test_Group_WhenLost_Fails")])
+
+		flaky = cases["test_Group_WhenFlaky_Passes"]
+		self.assertEqual(rerun.case_result(flaky), "PASS")
+		self.assertEqual(flaky.find("flakyFailure").get("message"), "timeout waiting for message")
+		self.assertEqual(flaky.get("time"), "2.5")
+		broken = cases["test_Group_WhenBroken_Fails"]
+		self.assertEqual(broken.find("failure").get("message"), "wrong value")
+		self.assertEqual(broken.find("rerunFailure/system-out").text, "rerun output")
+		self.assertEqual(rerun._property(cases["test_Group_WhenLost_Fails"], rerun.RERUN_PROPERTY), rerun.NOT_RERUN)
+		self.assertIsNotNone(cases["test_Other_WhenRun_Errors"].find("flakyError"))
+
+	def test_counts_follow_rerun(self):
+		outcomes, merged, cases = self.merge()
+		suites = dict((suite.get("name"), suite) for suite in merged.iter("testsuite"))
+		# the flaky tests passed, the broken one and the one without rerun result still fail
+		self.assertEqual([suites["TestSuiteA"].get(name) for name in testoutparse.SUITE_COUNTS], ["4", "2", "0", "0"])
+		self.assertEqual([suites["TestSuiteB"].get(name) for name in testoutparse.SUITE_COUNTS], ["1", "0", "0", "0"])
+		self.assertEqual([merged.get(name) for name in testoutparse.SUITE_COUNTS], ["5", "2", "0", "0"])
+
+	def test_history_report(self):
+		path = os.path.join(self.directory.name, "history.db")
+		timing_history = history.TimingHistory(path)
+		try:
+			record_run(timing_history, "TestSuiteA", {"test_Group_WhenOk_Passes" : 1.0})
+			record_run(timing_history, "TestSuiteA", {"test_Group_WhenBroken_Fails" : 1.0}, result="FAIL")
+		finally:
+			timing_history.close()
+		root, failed = rerun.load_report(path, DISCOVERED)
+		self.assertEqual(failed, [("TestSuiteA", "test_Group_WhenBroken_Fails")])
+		case = root.find("testsuite/testcase")
+		self.assertEqual(case.get("name"), "Group: When Broken - Fails")
+		self.assertEqual(rerun.case_result(case), "FAIL")
+
+
+if __name__ == "__main__":
+	unittest.main()
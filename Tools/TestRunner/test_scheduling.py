@@ -0,0 +1,81 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import TestRunner
+import history
+from test_history import record_run
+
+
+def suite(*tests):
+	"""Discovery result of a suite with the given tests, no @randIn batches."""
+	return {"tests" : [{"name" : name, "annotations" : {}} for name in tests]}
+
+
+class TestLptOrder(unittest.TestCase):
+	def test_longest_first_and_makespan(self):
+		ordered, makespan, total = TestRunner.lpt_order(["A", "B", "C", "D"], {"A" : 1.0, "B" : 4.0, "C" : 3.0, "D" : 2.0}, 2)
+		self.assertEqual(ordered, ["B", "C", "D", "A"])
+		self.assertEqual((makespan, total), (5.0, 10.0))
+
+	def test_unknown_items_first(self):
+		# a suite without history may be the longest one, it is taken as long as the longest known
+		ordered, makespan, total = TestRunner.lpt_order(["A", "New", "B"], {"A" : 1.0, "B" : 4.0}, 2)
+		self.assertEqual(ordered, ["New", "B", "A"])
+		self.assertEqual((makespan, total), (5.0, 9.0))
+
+	def test_no_history(self):
+		ordered, makespan, total = TestRunner.lpt_order(["A", "B"], {}, 4)
+		self.assertEqual(sorted(ordered), ["A", "B"])
+		self.assertEqual((makespan, total), (0, 0))
+
+
+class TestShardBalance(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.history = history.TimingHistory(os.path.join(self.directory.name, "history.db"))
+
+	def tearDown(self):
+		self.history.close()
+		self.directory.cleanup()
+
+	def test_long_suite_is_split_evenly(self):
+		big = dict(("test_%d" % number, float(seconds)) for number, seconds in enumerate([8, 7, 6, 5, 4, 3, 2, 1, 1, 1]))
+		record_run(self.history, "TestBig", big, 40.0)
+		record_run(self.history, "TestSmall", {"test_A" : 2.0}, 2.0)
+		discovered = {"TestBig" : suite(*big), "TestSmall" : suite("test_A")}
+		items, estimates = TestRunner.plan_shards(["TestBig", "TestSmall"], 3, self.history.suite_estimates(),
+			self.history.test_estimates(), discovered)
+		shards = [(name, tests) for name, suite_name, tests in items if suite_name == "TestBig"]
+		self.assertEqual(len(shards), 3)
+		# every test in exactly one shard
+		self.assertEqual(sorted(test for name, tests in shards for test in tests), sorted(big))
+		# 38s of tests plus 2s of suite overhead in every shard: 12.7 + 2 each at best
+		loads = [estimates[name] for name, tests in shards]
+		self.assertLessEqual(max(loads) - min(loads), 1.0)
+		self.assertTrue(all(load >= 2.0 + 12.0 for load in loads))
+		# the small suite stays whole
+		self.assertIn(("TestSmall", "TestSmall", None), items)
+		ordered, makespan, total = TestRunner.lpt_order([name for name, suite_name, tests in items], estimates, 3)
+		self.assertLess(makespan, 40.0 / 2)
+
+	def test_new_tests_get_median_estimate(self):
+		record_run(self.history, "TestBig", {"test_A" : 10.0, "test_B" : 10.0, "test_C" : 2.0})
+		discovered = {"TestBig" : suite("test_A", "test_B", "test_C", "test_New")}
+		items, estimates = TestRunner.plan_shards(["TestBig"], 2, {}, self.history.test_estimates(), discovered)
+		self.assertEqual(len(items), 2)
+		# 10 + 10 + 2 + median 10 over two instances
+		self.assertEqual(sorted(estimates.values()), [12.0, 20.0])
+
+	def test_no_history_splits_by_test_count(self):
+		discovered = {"TestBig" : suite(*["test_%d" % number for number in range(6)]), "TestSmall" : suite("test_A")}
+		items, estimates = TestRunner.plan_shards(["TestBig", "TestSmall"], 2, {}, {}, discovered)
+		sizes = sorted(len(tests) for name, suite_name, tests in items if tests)
+		self.assertEqual(sizes, [3, 3])
+		self.assertEqual(estimates["TestSmall"], TestRunner.DEFAULT_TEST_SECONDS)
+
+
+if __name__ == "__main__":
+	unittest.main()
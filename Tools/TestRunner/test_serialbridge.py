@@ -0,0 +1,46 @@
+import argparse
+import io
+import os
+import socket
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import TestRunner
+import serialbridge
+
+
+def free_instance():
+	"""An instance number whose serial bridge port (10000+N) is free here."""
+	for instance in range(900, 1000):
+		with socket.socket() as s:
+			try:
+				s.bind(("localhost", serialbridge.SERIAL_PORT_BASE + instance))
+			except OSError:
+				continue
+			return str(instance)
+	raise unittest.SkipTest("no free serial bridge port")
+
+
+@unittest.skipIf(sys.platform == "win32", "the simulator end of the bridge is a pty")
+class TestStartInstance(unittest.TestCase):
+	def test_failed_start_closes_serial_bridge(self):
+		with tempfile.TemporaryDirectory() as directory:
+			args = argparse.Namespace(modemsim=os.path.join(directory, "missing"), firmwaredir=directory, gateway=False,
+				serialbridge="tcp", serialcapture=None, serialcom=serialbridge.DEFAULT_COM_BASE, readytimeout=5)
+			instance = free_instance()
+			sys.stdout, stdout = io.StringIO(), sys.stdout
+			try:
+				# the second attempt would find the TCP port of the first bridge still taken
+				for attempt in range(2):
+					with self.assertRaises(FileNotFoundError):
+						TestRunner.start_instance(args, instance)
+			finally:
+				sys.stdout = stdout
+			with socket.socket() as s:
+				s.bind(("localhost", serialbridge.SERIAL_PORT_BASE + int(instance)))
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,142 @@
+import json
+import os
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+import urllib.request
+
+SIMPOOL = os.path.join(os.path.dirname(os.path.abspath(__file__)), "simpool.py")
+
+# stands in for ModemSimulator.exe: answers the web service requests of GatewayURL, and getProperties with
+# propertyValues unless FAKE_SILENT is set; the forward messages and answered polls go to FAKE_LOG
+FAKE_SIMULATOR = """#!%s
+import http.server, json, os, sys
+port = 8000
+for option in sys.argv[1:]:
+	if option.startswith("--GatewayURL="):
+		port = int(option.rsplit(":", 1)[1])
+returned = []
+def log(line):
+	if os.environ.get("FAKE_LOG"):
+		with open(os.environ["FAKE_LOG"], "a") as f:
+			f.write(line + "\\n")
+class Handler(http.server.BaseHTTPRequestHandler):
+	def answer(self):
+		body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+		resource = self.path.split("?")[0].rstrip("/").rsplit("/", 1)[-1]
+		result = {"ErrorID": 0}
+		if resource == "info_utc_time.json":
+			result = "2026-10-18 10:00:00"
+		elif resource == "submit_messages.json":
+			for message in json.loads(body.decode("utf-8"))["messages"]:
+				payload = message["Payload"]
+				log("submit " + str(payload["SIN"]) + "/" + str(payload["MIN"]))
+				if payload["MIN"] == 8 and not os.environ.get("FAKE_SILENT"):
+					returned.append({"SIN": 16, "MobileID": message["DestinationID"], "Payload": {"SIN": 16, "MIN": 5, "Fields": []}})
+			result = {"SubmitForwardMessages_JResult": {"ErrorID": 0, "Submissions": []}}
+		elif resource == "get_return_messages.json":
+			if returned:
+				log("poll " + str(len(returned)))
+			result = {"ErrorID": 0, "Messages": returned[:], "More": False, "NextStartUTC": "2026-10-18 10:00:01"}
+			del returned[:]
+		content = json.dumps(result).encode("utf-8")
+		self.send_response(200)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(content)))
+		self.end_headers()
+		self.wfile.write(content)
+	do_GET = do_POST = answer
+	def log_message(self, *args):
+		pass
+http.server.HTTPServer(("localhost", port), Handler).serve_forever()
+"""
+
+
+def free_port():
+	with socket.socket() as s:
+		s.bind(("localhost", 0))
+		return s.getsockname()[1]
+
+
+def get(url):
+	with urllib.request.urlopen(url, timeout=30) as response:
+		return json.loads(response.read().decode("utf-8"))
+
+
+@unittest.skipIf(sys.platform == "win32", "the fake simulator is started as a script")
+class TestSimulatorPool(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.simulator = os.path.join(self.directory.name, "modemsim")
+		with open(self.simulator, "w") as f:
+			f.write(FAKE_SIMULATOR % sys.executable)
+		os.chmod(self.simulator, os.stat(self.simulator).st_mode | stat.S_IEXEC)
+		self.pool = None
+
+	def tearDown(self):
+		if self.pool:
+			self.pool.terminate()
+			try:
+				self.pool.wait(10)
+			except subprocess.TimeoutExpired:
+				self.pool.kill()
+		self.directory.cleanup()
+
+	def start_pool(self, *options, **env):
+		port = free_port()
+		# instance ports 8000+N and 9000+N, N picked so that they are free here
+		instance = free_port() % 900 + 50
+		self.pool = subprocess.Popen([sys.executable, SIMPOOL, "--modemsim", self.simulator, "--firmwaredir", self.directory.name,
+			"--instance", str(instance), "--port", str(port), "--resetsins", "", "--readytimeout", "20"] + list(options),
+			cwd=self.directory.name, env=dict(os.environ, WORKSPACE=self.directory.name, **env),
+			stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+		return "http://localhost:%d" % port
+
+	def wait_for_state(self, url, states, timeout=30):
+		deadline = time.time() + timeout
+		while time.time() < deadline:
+			try:
+				instances = get(url + "/status")["instances"]
+				if instances[0]["state"] in states:
+					return instances[0]
+			except OSError:
+				pass
+			if self.pool.poll() is not None:
+				self.fail("simpool.py exited: %s" % self.pool.stdout.read())
+			time.sleep(0.2)
+		self.fail("instance not %s after %ds" % (" or ".join(states), timeout))
+
+	def test_boot_with_gateway(self):
+		url = self.start_pool("--gateway")
+		instance = self.wait_for_state(url, ("idle", "failed"))
+		self.assertEqual(instance["state"], "idle", instance["error"])
+		leased = get(url + "/lease?client=test&timeout=10")
+		self.assertTrue(leased["gateway"])
+		self.assertIn("gateway", leased["processes"])
+		# the stand-in answers on the instance port, the simulator behind it
+		self.assertEqual(get("http://localhost:%d/GpsWebService/track_status.json/" % leased["port"])["ErrorID"], 0)
+		get(url + "/release?lease=%d" % leased["lease"])
+		self.assertEqual(self.wait_for_state(url, ("idle", "failed"))["state"], "idle")
+
+	def test_reset_waits_for_terminal(self):
+		log = os.path.join(self.directory.name, "fake.log")
+		url = self.start_pool("--resetsins", "115,20", FAKE_LOG=log)
+		instance = self.wait_for_state(url, ("idle", "failed"))
+		self.assertEqual(instance["state"], "idle", instance["error"])
+		# idle only after the properties read back behind the reset came in
+		with open(log) as f:
+			self.assertEqual(f.read().split("\n")[:3], ["submit 16/10", "submit 16/8", "poll 1"])
+
+	def test_unconfirmed_reset_fails(self):
+		url = self.start_pool("--resetsins", "115", "--readytimeout", "2", FAKE_SILENT="1")
+		instance = self.wait_for_state(url, ("idle", "failed"))
+		self.assertEqual(instance["state"], "failed")
+		self.assertIn("SIN 16 MIN 5", instance["error"])
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,238 @@
+"""Block compressed trace log archives with a timestamp index.
+
+	python archive.py _run/test_10.log --format zst
+	-> _run/test_10.log.zst and _run/test_10.log.zst.bidx
+
+The log is cut into blocks of about --blocksize kB at entry boundaries
+(continuation lines stay with their entry) and every block is compressed on its
+own, as a gzip member or a zstd frame. The archive is still a regular .gz/.zst
+file that zcat or zstdcat read whole. The side index (<archive>.bidx) holds the
+offset, size and timestamp range of every block, so reading a time window only
+decompresses the blocks it overlaps.
+
+open_text(), open_window() and read_bytes() read plain logs and archives alike.
+An archive without an index (e.g. a log gzipped by hand) is streamed from its
+start. .zst needs the zstandard module.
+"""
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import os
+import time
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+from tracelog import line_ms, DAY_MS, ROLLOVER_MS
+
+INDEX_SUFFIX = ".bidx"
+INDEX_VERSION = 1
+FORMATS = {".gz" : "gz", ".zst" : "zst"}
+DEFAULT_BLOCK_KB = 1024
+DEFAULT_LEVELS = {"gz" : 6, "zst" : 10}
+# a block is cut at the next entry after reaching its size, but never grows beyond this many times it
+MAX_BLOCK_FACTOR = 4
+
+
+def archive_format(path):
+	"""'gz' or 'zst' for archive paths, None for plain logs."""
+	return FORMATS.get(os.path.splitext(path)[1].lower())
+
+
+def is_archive(path):
+	return archive_format(path) is not None
+
+
+def _zstandard():
+	if zstandard is None:
+		raise Exception("Reading or writing .zst archives needs the zstandard module (pip install zstandard)")
+	return zstandard
+
+
+def _compress(data, fmt, level):
+	if fmt == "gz":
+		# no time stamp, the same log always gives the same archive
+		return gzip.compress(data, compresslevel=level, mtime=0)
+	return _zstandard().ZstdCompressor(level=level).compress(data)
+
+
+def _decompress(data, fmt):
+	if fmt == "gz":
+		return gzip.decompress(data)
+	return _zstandard().ZstdDecompressor().decompress(data)
+
+
+def _blocks(lines, block_size):
+	"""Yields (raw lines, last timestamp before them, lowest and highest timestamp in them) per block."""
+	block, size = [], 0
+	previous_ms = last_ms = None
+	low = high = None
+	day = 0
+	for line in lines:
+		stamp = line_ms(line)
+		if block and (stamp is not None and size >= block_size or size >= block_size * MAX_BLOCK_FACTOR):
+			yield block, previous_ms, low, high
+			block, size = [], 0
+			previous_ms, low, high = last_ms, None, None
+		if stamp is not None:
+			# same midnight rollover rule as tracelog
+			stamp += day * DAY_MS
+			if last_ms is not None and last_ms - stamp > ROLLOVER_MS:
+				day += 1
+				stamp += DAY_MS
+			last_ms = stamp
+			# interleaved threads may step back a little, so the range is not just the first and last line
+			low = stamp if low is None else min(low, stamp)
+			high = stamp if high is None else max(high, stamp)
+		raw = line.encode("utf-8", "surrogateescape")
+		block.append(raw)
+		size += len(raw)
+	if block:
+		yield block, previous_ms, low, high
+
+
+def write_archive(path, output=None, fmt="gz", block_kb=DEFAULT_BLOCK_KB, level=None):
+	"""Compresses the plain log at path block by block, returns (archive path, index)."""
+	output = output or path + "." + fmt
+	level = DEFAULT_LEVELS[fmt] if level is None else level
+	if fmt == "zst":
+		_zstandard()
+	blocks = []
+	digest = hashlib.sha1()
+	raw_offset = 0
+	with open(path, encoding="utf-8", errors="surrogateescape", newline="") as source, open(output + ".tmp", "wb") as archive:
+		for lines, previous_ms, low, high in _blocks(source, block_kb * 1024):
+			data = b"".join(lines)
+			digest.update(data)
+			compressed = _compress(data, fmt, level)
+			# offset, size, raw offset, raw size, last timestamp before the block, lowest and highest timestamp in it
+			# (a block of continuation lines only is at the time of the entry they belong to)
+			blocks.append([archive.tell(), len(compressed), raw_offset, len(data), previous_ms,
+				previous_ms if low is None else low, previous_ms if high is None else high])
+			archive.write(compressed)
+			raw_offset += len(data)
+	index = {
+		"version" : INDEX_VERSION,
+		"format" : fmt,
+		"source" : os.path.basename(path),
+		"source_size" : raw_offset,
+		"sha1" : digest.hexdigest(),
+		"created" : time.time(),
+		"blocks" : blocks,
+	}
+	with open(output + INDEX_SUFFIX + ".tmp", "w") as f:
+		json.dump(index, f)
+	os.replace(output + ".tmp", output)
+	os.replace(output + INDEX_SUFFIX + ".tmp", output + INDEX_SUFFIX)
+	return output, index
+
+
+def load_index(path):
+	"""The block index of an archive, None when it has none or it belongs to another version of the archive."""
+	try:
+		with open(path + INDEX_SUFFIX) as f:
+			index = json.load(f)
+	except (IOError, OSError, ValueError):
+		return None
+	if index.get("version") != INDEX_VERSION or index.get("format") != archive_format(path):
+		return None
+	blocks = index["blocks"]
+	if blocks and blocks[-1][0] + blocks[-1][1] != os.path.getsize(path):
+		return None
+	return index
+
+
+def _text_lines(data):
+	return io.StringIO(data.decode("utf-8", "replace"), newline="")
+
+
+def _read_blocks(path, fmt, blocks):
+	with open(path, "rb") as f:
+		for offset, size, raw_offset, raw_size, previous_ms, low, high in blocks:
+			f.seek(offset)
+			yield _decompress(f.read(size), fmt)
+
+
+def _stream(path, fmt):
+	"""Binary file object of the whole decompressed archive."""
+	if fmt == "gz":
+		return gzip.open(path, "rb")
+	f = open(path, "rb")
+	return _zstandard().ZstdDecompressor().stream_reader(f, read_across_frames=True, closefd=True)
+
+
+def open_text(path):
+	"""Text lines of a plain log or a whole archive."""
+	fmt = archive_format(path)
+	if not fmt:
+		return open(path, encoding="utf-8", errors="replace")
+	return io.TextIOWrapper(_stream(path, fmt), encoding="utf-8", errors="replace")
+
+
+def open_window(path, start=None, end=None):
+	"""(lines, timestamp before the first line) covering at least the time window [start, end] in ms (tracelog timestamps).
+
+	For an indexed archive only the blocks overlapping the window are decompressed, the
+	lines are a superset of the window and still have to be filtered by time
+	(tracelog.stream_select). Other files are read from their start.
+	"""
+	fmt = archive_format(path)
+	index = load_index(path) if fmt else None
+	if index is None:
+		return open_text(path), None
+	overlapping = [i for i, block in enumerate(index["blocks"])
+		if (start is None or (block[6] or 0) >= start) and (end is None or (block[5] or 0) <= end)]
+	# the lines have to stay in order and keep their continuation lines, so the whole run of blocks is read
+	selected = index["blocks"][overlapping[0]:overlapping[-1] + 1] if overlapping else []
+	def lines():
+		for data in _read_blocks(path, fmt, selected):
+			for line in _text_lines(data):
+				yield line
+	return lines(), selected[0][4] if selected else None
+
+
+def read_bytes(path):
+	"""Whole content of a plain log or an archive."""
+	fmt = archive_format(path)
+	if not fmt:
+		with open(path, "rb") as f:
+			return f.read()
+	with _stream(path, fmt) as f:
+		return f.read()
+
+
+def verify(path, index):
+	"""True when the archive decompresses to exactly what was archived."""
+	digest = hashlib.sha1()
+	size = 0
+	for data in _read_blocks(path, index["format"], index["blocks"]):
+		digest.update(data)
+		size += len(data)
+	return size == index["source_size"] and digest.hexdigest() == index["sha1"]
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Compresses finished trace logs into block archives with a timestamp index.")
+	parser.add_argument("logs", nargs="+", help="Trace log files, e.g. _run/test_10.log")
+	parser.add_argument("--format", choices=sorted(DEFAULT_LEVELS), default="gz", help="gz (always available) or zst (zstandard module)")
+	parser.add_argument("--blocksize", type=int, default=DEFAULT_BLOCK_KB, help="Uncompressed kB per block, smaller blocks give faster time window reads")
+	parser.add_argument("--level", type=int, help="Compression level, default %s" % ", ".join("%s %d" % item for item in sorted(DEFAULT_LEVELS.items())))
+	parser.add_argument("--remove", action="store_true", help="Delete the log (and its .tidx) once the archive is verified")
+	args = parser.parse_args()
+
+	for log in args.logs:
+		start = time.time()
+		output, index = write_archive(log, fmt=args.format, block_kb=args.blocksize, level=args.level)
+		size = os.path.getsize(output)
+		print("%s -> %s: %d block(s), %d -> %d bytes (%.1f%%) in %.1fs" % (log, output, len(index["blocks"]),
+			index["source_size"], size, 100.0 * size / max(index["source_size"], 1), time.time() - start))
+		if args.remove:
+			if not verify(output, index) or os.path.getsize(log) != index["source_size"]:
+				raise Exception("%s does not match %s, the log is kept" % (output, log))
+			os.remove(log)
+			if os.path.exists(log + ".tidx"):
+				os.remove(log + ".tidx")
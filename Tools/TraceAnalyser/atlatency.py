@@ -0,0 +1,191 @@
+"""AT command round-trip latency profile of a terminal trace log.
+
+Every "cmd: AT..." line is paired with the next "res: ..." line of the same
+thread in one pass. Latencies and polling intervals are reported per
+command, together with a histogram, outliers and a per time bucket view.
+With --compare a second trace (e.g. from another firmware build) is
+profiled and printed next to the first one.
+"""
+import argparse
+import array
+import bisect
+import heapq
+
+from tracelog import iter_entries, format_time
+import archive
+
+HISTOGRAM_BINS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+def command_key(command, full=False):
+	"""AT%GPS=30,2,"RMC","GGA"*D90A -> AT%GPS, ATS89?*47C6 -> ATS89?"""
+	command = command.strip()
+	star = command.rfind("*")
+	if star > 0:
+		command = command[:star]
+	if full:
+		return command
+	return command.split("=", 1)[0]
+
+
+def percentile(values, fraction):
+	"""Nearest rank percentile of sorted values."""
+	if not values:
+		return None
+	rank = max(int(round(fraction * len(values) + 0.5)) - 1, 0)
+	return values[min(rank, len(values) - 1)]
+
+
+class CommandStats():
+	def __init__(self):
+		self.latencies = array.array("i")
+		self.sent = array.array("q")
+		self.unanswered = 0
+		# the slowest round trips with their send time, candidates for outliers
+		self.slowest = []
+
+	def summary(self):
+		latencies = sorted(self.latencies)
+		intervals = sorted(b - a for a, b in zip(self.sent, self.sent[1:]))
+		span = (self.sent[-1] - self.sent[0]) if len(self.sent) > 1 else 0
+		return {
+			"count" : len(self.sent),
+			"answered" : len(latencies),
+			"unanswered" : self.unanswered,
+			"per_minute" : len(self.sent) * 60000.0 / span if span else None,
+			"interval_p50" : percentile(intervals, 0.5),
+			"p50" : percentile(latencies, 0.5),
+			"p90" : percentile(latencies, 0.9),
+			"p99" : percentile(latencies, 0.99),
+			"max" : latencies[-1] if latencies else None,
+			"mean" : sum(latencies) / float(len(latencies)) if latencies else None,
+		}
+
+	def histogram(self):
+		counts = [0] * (len(HISTOGRAM_BINS_MS) + 1)
+		for latency in self.latencies:
+			counts[bisect.bisect_left(HISTOGRAM_BINS_MS, latency)] += 1
+		return counts
+
+
+class LatencyProfile():
+	def __init__(self, full=False, bucket_ms=600000, outlier_factor=5.0, outlier_limit=20):
+		self.full = full
+		self.outlier_limit = outlier_limit
+		self.bucket_ms = bucket_ms
+		self.outlier_factor = outlier_factor
+		self.commands = {}
+		self.pending = {}
+		# (bucket, command) -> latencies of commands answered in that bucket
+		self.buckets = {}
+
+	def feed(self, stamp, thread, message):
+		if message.startswith("cmd: "):
+			key = command_key(message[5:], self.full)
+			stats = self.commands.get(key)
+			if stats is None:
+				stats = self.commands[key] = CommandStats()
+			stats.sent.append(stamp)
+			previous = self.pending.get(thread)
+			if previous:
+				self.commands[previous[0]].unanswered += 1
+			self.pending[thread] = (key, stamp)
+		elif message.startswith("res: "):
+			sent = self.pending.pop(thread, None)
+			if sent is None:
+				return
+			key, sent_stamp = sent
+			latency = stamp - sent_stamp
+			stats = self.commands[key]
+			stats.latencies.append(latency)
+			if len(stats.slowest) < self.outlier_limit:
+				heapq.heappush(stats.slowest, (latency, sent_stamp))
+			elif latency > stats.slowest[0][0]:
+				heapq.heapreplace(stats.slowest, (latency, sent_stamp))
+			self.buckets.setdefault((sent_stamp - sent_stamp % self.bucket_ms, key), array.array("i")).append(latency)
+
+	def read(self, lines):
+		for stamp, thread, level, message in iter_entries(lines):
+			self.feed(stamp, thread, message)
+		for key, stamp in self.pending.values():
+			self.commands[key].unanswered += 1
+		self.pending = {}
+		return self
+
+	def outliers(self):
+		"""(send time, command, latency) of round trips slower than both p99 and outlier_factor * p50 of their command."""
+		found = []
+		for key, stats in self.commands.items():
+			summary = stats.summary()
+			if summary["p50"] is None:
+				continue
+			threshold = max(summary["p99"], summary["p50"] * self.outlier_factor)
+			found.extend((stamp, key, latency) for latency, stamp in stats.slowest if latency > threshold)
+		found.sort(key=lambda sample: -sample[2])
+		return found[:self.outlier_limit]
+
+
+def _ms(value):
+	return "-" if value is None else ("%.1f" % value if isinstance(value, float) else str(value))
+
+
+def print_profile(profile, name):
+	print("== %s" % name)
+	print("%-24s %8s %6s %8s %8s %6s %6s %6s %6s %8s" % ("command", "count", "unans", "per min", "interval", "p50", "p90", "p99", "max", "mean"))
+	for key in sorted(profile.commands):
+		s = profile.commands[key].summary()
+		print("%-24s %8d %6d %8s %8s %6s %6s %6s %6s %8s" % (key, s["count"], s["unanswered"], _ms(s["per_minute"]),
+			_ms(s["interval_p50"]), _ms(s["p50"]), _ms(s["p90"]), _ms(s["p99"]), _ms(s["max"]), _ms(s["mean"])))
+
+	print("")
+	print("latency histogram (ms, upper bounds)")
+	print("%-24s %s" % ("command", " ".join("%6s" % ("<=%d" % b) for b in HISTOGRAM_BINS_MS) + "  >%d" % HISTOGRAM_BINS_MS[-1]))
+	for key in sorted(profile.commands):
+		print("%-24s %s" % (key, " ".join("%6d" % count for count in profile.commands[key].histogram())))
+
+	print("")
+	print("per %d min: count / p50 / max latency" % (profile.bucket_ms // 60000))
+	for bucket, key in sorted(profile.buckets):
+		latencies = sorted(profile.buckets[(bucket, key)])
+		print("%-16s %-24s %6d %6s %6s" % (format_time(bucket), key, len(latencies), percentile(latencies, 0.5), latencies[-1]))
+
+	outliers = profile.outliers()
+	if outliers:
+		print("")
+		print("outliers")
+		for stamp, key, latency in outliers:
+			print("%-16s %-24s %6d ms" % (format_time(stamp), key, latency))
+
+
+def print_comparison(base, other, base_name, other_name):
+	print("== %s -> %s" % (base_name, other_name))
+	print("%-24s %17s %17s %17s %17s" % ("command", "per min", "interval p50", "latency p50", "latency p99"))
+	for key in sorted(set(base.commands) | set(other.commands)):
+		a = base.commands[key].summary() if key in base.commands else {}
+		b = other.commands[key].summary() if key in other.commands else {}
+		columns = []
+		for field in ("per_minute", "interval_p50", "p50", "p99"):
+			columns.append("%17s" % ("%s -> %s" % (_ms(a.get(field)), _ms(b.get(field)))))
+		print("%-24s %s" % (key, " ".join(columns)))
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Profiles AT command round-trip latency from terminal trace logs.")
+	parser.add_argument("log", help="Trace log file, or a .gz/.zst archive of one")
+	parser.add_argument("--compare", help="Second trace log to compare against the first one")
+	parser.add_argument("--full", action="store_true", help="Group by full command text instead of command name")
+	parser.add_argument("--bucket", type=int, default=10, help="Minutes per bucket of the over time view")
+	parser.add_argument("--outlierfactor", type=float, default=5.0, help="Outlier when latency exceeds p99 and this many times p50")
+	args = parser.parse_args()
+
+	profiles = []
+	for path in [args.log] + ([args.compare] if args.compare else []):
+		with archive.open_text(path) as f:
+			profiles.append(LatencyProfile(args.full, args.bucket * 60000, args.outlierfactor).read(f))
+
+	print_profile(profiles[0], args.log)
+	if args.compare:
+		print("")
+		print_profile(profiles[1], args.compare)
+		print("")
+		print_comparison(profiles[0], profiles[1], args.log, args.compare)
@@ -0,0 +1,302 @@
+"""NMEA fixes and fix interval/drift analysis of a terminal trace log.
+
+The $GPGGA/$GPRMC sentences embedded in "%GPS:" responses are decoded
+straight from the mapped file with NumPy, without a Python object per
+sentence, into columns (time, latitude, longitude, speed, heading, validity,
+fix quality, satellites, checksum), one row per RMC sentence. The GGA
+sentence of the same response supplies quality and satellites.
+
+Intervals between consecutive fixes are checked with a vectorized version
+of Infrastructure/DataAnalyse/DriftAnalyse.lua.
+"""
+import argparse
+import mmap
+import os
+
+import numpy as np
+
+import archive
+
+# bytes looked at after '$', NMEA 0183 limits a sentence to 82 characters including "$" and "\r\n"
+SENTENCE_WIDTH = 82
+# sentences are located in blocks of this many bytes to bound temporary memory
+BLOCK_SIZE = 64 * 1024 * 1024
+# sentences decoded at once, each one takes SENTENCE_WIDTH bytes plus a few int columns
+CHUNK_SENTENCES = 200000
+# (field number, characters parsed), the talker/sentence id being field 0; width 1 fields are kept as characters
+RMC_FIELDS = {
+	"time" : (1, 10),
+	"status" : (2, 1),
+	"lat" : (3, 10),
+	"ns" : (4, 1),
+	"lon" : (5, 11),
+	"ew" : (6, 1),
+	"speed" : (7, 8),
+	"course" : (8, 7),
+	"date" : (9, 6),
+}
+GGA_FIELDS = {"time" : (1, 10), "quality" : (6, 2), "satellites" : (7, 2)}
+NO_QUALITY = -1
+# characters that end a sentence before its "*hh", the trace escapes line ends as "\r\n"
+SENTENCE_BREAKS = np.zeros(256, dtype=bool)
+SENTENCE_BREAKS[[ord("\\"), ord("\r"), ord("\n"), ord("$")]] = True
+HEX_DIGITS = np.zeros(256, dtype=bool)
+HEX_DIGITS[list(b"0123456789ABCDEFabcdef")] = True
+RMC = 1
+GGA = 2
+
+
+def _find_sentences(data):
+	"""Offsets of every '$' starting a $G?RMC or $G?GGA sentence and their kind."""
+	offsets = []
+	kinds = []
+	for block in range(0, len(data), BLOCK_SIZE):
+		found = np.flatnonzero(data[block:block + BLOCK_SIZE] == ord("$")) + block
+		found = found[found + 6 < len(data)]
+		talker = data[found + 1] == ord("G")
+		rmc = talker & (data[found + 3] == ord("R")) & (data[found + 4] == ord("M")) & (data[found + 5] == ord("C"))
+		gga = talker & (data[found + 3] == ord("G")) & (data[found + 4] == ord("G")) & (data[found + 5] == ord("A"))
+		offsets.append(found[rmc | gga])
+		kinds.append(np.where(rmc, RMC, GGA).astype(np.int8)[rmc | gga])
+	if not offsets:
+		return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int8)
+	return np.concatenate(offsets), np.concatenate(kinds)
+
+
+def _hex_value(chars):
+	chars = chars.astype(np.int16)
+	return np.where(chars >= ord("A"), (chars | 0x20) - ord("a") + 10, chars - ord("0"))
+
+
+def _number(window, rows, start, end, width):
+	"""Decimal field to float without creating Python strings, NaN when empty.
+
+	Digits are accumulated column by column for all sentences at once.
+	"""
+	length = end - start
+	mantissa = np.zeros(len(rows))
+	scale = np.ones(len(rows))
+	after_dot = np.zeros(len(rows), dtype=bool)
+	any_digit = np.zeros(len(rows), dtype=bool)
+	for column in range(width):
+		chars = window[rows, np.minimum(start + column, SENTENCE_WIDTH - 1)]
+		inside = column < length
+		digits = chars - np.uint8(ord("0"))
+		is_digit = inside & (digits < 10)
+		mantissa = np.where(is_digit, mantissa * 10 + digits, mantissa)
+		scale = np.where(is_digit & after_dot, scale * 10, scale)
+		after_dot |= inside & (chars == ord("."))
+		any_digit |= is_digit
+	return np.where(any_digit, mantissa / scale, np.nan)
+
+
+def _windows(data, offsets):
+	"""Copies the SENTENCE_WIDTH bytes after every '$' into one 2D array, zero padded at the end of the file."""
+	limit = len(data) - SENTENCE_WIDTH - 1
+	inner = offsets[offsets <= limit]
+	windows = np.lib.stride_tricks.sliding_window_view(data, SENTENCE_WIDTH)[inner + 1]
+	if len(inner) == len(offsets):
+		return windows
+	tail_start = max(limit, 0)
+	tail = np.concatenate((data[tail_start:], np.zeros(SENTENCE_WIDTH + 1, dtype=np.uint8)))
+	tail_windows = np.lib.stride_tricks.sliding_window_view(tail, SENTENCE_WIDTH)[offsets[offsets > limit] + 1 - tail_start]
+	return np.concatenate((windows, tail_windows))
+
+
+def _decode(data, offsets, kinds):
+	"""Decodes one chunk of sentences into {field: column} with fields of both sentence kinds."""
+	count = len(offsets)
+	window = _windows(data, offsets)
+	is_star = window == ord("*")
+	body_end = np.argmax(is_star, axis=1)
+	breaks = SENTENCE_BREAKS[window]
+	# a sentence needs its "*hh" within the window, before the line (or the escaped "\r\n") ends
+	complete = is_star.any(axis=1) & (body_end + 2 < SENTENCE_WIDTH) & \
+		(~breaks.any(axis=1) | (np.argmax(breaks, axis=1) > body_end))
+	body_end = np.where(complete, body_end, 0)
+	body = np.arange(SENTENCE_WIDTH) < body_end[:, None]
+	computed = np.bitwise_xor.reduce(window * body, axis=1)
+	all_rows = np.arange(count)
+	high = window[all_rows, np.minimum(body_end + 1, SENTENCE_WIDTH - 1)]
+	low = window[all_rows, np.minimum(body_end + 2, SENTENCE_WIDTH - 1)]
+	complete &= HEX_DIGITS[high] & HEX_DIGITS[low]
+	expected = _hex_value(high) * 16 + _hex_value(low)
+
+	# comma columns of all sentences in row order, commas of row i start at first[i]
+	comma_rows, comma_columns = np.nonzero(body & (window == ord(",")))
+	comma_columns = np.append(comma_columns, 0)
+	counts = np.bincount(comma_rows, minlength=count)
+	first = np.cumsum(counts) - counts
+
+	columns = {"complete" : complete, "checksum_ok" : complete & (computed == expected)}
+	for kind, fields in ((RMC, RMC_FIELDS), (GGA, GGA_FIELDS)):
+		rows = np.flatnonzero(kinds == kind)
+		for name, (field, width) in fields.items():
+			key = name if kind == RMC or name != "time" else "gga_time"
+			present = counts[rows] >= field
+			start = np.where(present, comma_columns[np.where(present, first[rows] + field - 1, -1)] + 1, 0)
+			end = np.where(counts[rows] > field, comma_columns[np.where(present, first[rows] + field, -1)], body_end[rows])
+			end = np.where(present, end, start)
+			if width == 1:
+				column = np.zeros(count, dtype=np.uint8)
+				column[rows] = np.where(end > start, window[rows, start], 0)
+			else:
+				column = np.full(count, np.nan)
+				column[rows] = _number(window, rows, start, end, width)
+			columns[key] = column
+	return columns
+
+
+def _degrees(value, hemisphere, negative):
+	"""NMEA ddmm.mmmm / dddmm.mmmm to signed decimal degrees."""
+	degrees = np.floor(value / 100.0)
+	degrees += (value - degrees * 100.0) / 60.0
+	return np.where(hemisphere == negative, -degrees, degrees)
+
+
+def _epoch_seconds(date, clock):
+	"""RMC ddmmyy and hhmmss.sss to seconds since 1970, NaN when either is missing."""
+	known = ~(np.isnan(date) | np.isnan(clock))
+	ddmmyy = np.where(known, date, 10170).astype(np.int64)
+	years = (ddmmyy % 100 + 30) % 100
+	months = ddmmyy // 100 % 100 - 1
+	days = (years.astype("datetime64[Y]") + months.astype("timedelta64[M]")).astype("datetime64[D]") + (ddmmyy // 10000 - 1)
+	hhmmss = np.where(known, clock, 0.0)
+	seconds = np.floor(hhmmss / 10000.0) * 3600 + np.floor(hhmmss / 100.0) % 100 * 60 + hhmmss % 100
+	return np.where(known, days.astype(np.int64) * 86400.0 + seconds, np.nan)
+
+
+def _scan(data):
+	offsets, kinds = _find_sentences(data)
+	chunks = [_decode(data, offsets[i:i + CHUNK_SENTENCES], kinds[i:i + CHUNK_SENTENCES])
+		for i in range(0, len(offsets), CHUNK_SENTENCES)]
+	return offsets, kinds, chunks
+
+
+def extract(path):
+	"""Returns a dict of equally long NumPy columns, one row per RMC sentence found in the trace log.
+
+	Plain logs are mapped, .gz/.zst archives (archive.py) decompressed into memory; offsets are the ones in the plain log.
+	"""
+	if archive.is_archive(path):
+		offsets, kinds, chunks = _scan(np.frombuffer(archive.read_bytes(path), dtype=np.uint8))
+	elif not os.path.getsize(path):
+		# an empty file can not be mapped
+		offsets, kinds, chunks = _scan(np.zeros(0, dtype=np.uint8))
+	else:
+		with open(path, "rb") as f:
+			mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+			data = np.frombuffer(mm, dtype=np.uint8)
+			try:
+				offsets, kinds, chunks = _scan(data)
+			finally:
+				# the mapping can not be closed while an array still points into it
+				del data
+				mm.close()
+	if chunks:
+		columns = dict((key, np.concatenate([chunk[key] for chunk in chunks])) for key in chunks[0])
+	else:
+		columns = _decode(np.zeros(SENTENCE_WIDTH, dtype=np.uint8), np.zeros(0, dtype=np.int64), kinds)
+	del chunks
+
+	complete = columns["complete"]
+	rmc = np.flatnonzero(complete & (kinds == RMC))
+	clock = columns["time"][rmc]
+	fixes = {
+		"offset" : offsets[rmc],
+		"time" : _epoch_seconds(columns["date"][rmc], clock),
+		"lat" : _degrees(columns["lat"][rmc], columns["ns"][rmc], ord("S")),
+		"lon" : _degrees(columns["lon"][rmc], columns["ew"][rmc], ord("W")),
+		"speed" : columns["speed"][rmc],
+		"heading" : columns["course"][rmc],
+		"valid" : columns["status"][rmc] == ord("A"),
+		"checksum_ok" : columns["checksum_ok"][rmc],
+	}
+
+	# a GGA belongs to the RMC right after it (same response) when both carry the same time of day
+	previous = np.maximum(rmc - 1, 0)
+	paired = (rmc > 0) & complete[previous] & (kinds[previous] == GGA) & (columns["gga_time"][previous] == clock)
+	for name in ("quality", "satellites"):
+		values = np.nan_to_num(columns[name][previous], nan=NO_QUALITY)
+		fixes[name] = np.where(paired, values, NO_QUALITY).astype(np.int8)
+	fixes["checksum_ok"] &= np.where(paired, columns["checksum_ok"][previous], True)
+	return fixes
+
+
+def fix_intervals(fixes):
+	"""Seconds between consecutive distinct valid fixes; a fix polled again with the same time is counted once."""
+	usable = fixes["valid"] & fixes["checksum_ok"] & ~np.isnan(fixes["time"])
+	times = fixes["time"][usable]
+	intervals = np.diff(times)
+	distinct = intervals != 0
+	return intervals[distinct], times[1:][distinct]
+
+
+def drift(data, interval, tolerance_max, tolerance_min):
+	"""Vectorized DriftAnalyse:perform(). Returns (passed, cumulated difference after every item).
+
+	The Lua loop adds (item - interval) for longer items and subtracts (interval - item)
+	for shorter ones, which is a running sum of (item - interval).
+	"""
+	cumulated = np.cumsum(np.asarray(data, dtype=np.float64) - interval)
+	final = cumulated[-1] if len(cumulated) else 0.0
+	return bool(tolerance_min <= final <= tolerance_max), cumulated
+
+
+def interval_stats(intervals):
+	if not len(intervals):
+		return None
+	p50, p90, p99 = np.percentile(intervals, (50, 90, 99))
+	return {
+		"count" : len(intervals),
+		"min" : intervals.min(),
+		"p50" : p50,
+		"p90" : p90,
+		"p99" : p99,
+		"max" : intervals.max(),
+		"mean" : intervals.mean(),
+		"std" : intervals.std(),
+	}
+
+
+def _format_epoch(seconds):
+	return str(np.datetime64(int(seconds * 1000), "ms")).replace("T", " ")
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Extracts NMEA fixes from a trace log and checks fix intervals for drift.")
+	parser.add_argument("log", help="Trace log file, or a .gz/.zst archive of one")
+	parser.add_argument("--interval", type=float, help="Expected seconds between fixes (default: median interval)")
+	parser.add_argument("--tolmax", type=float, default=2.0, help="Largest allowed cumulated drift in seconds")
+	parser.add_argument("--tolmin", type=float, default=-2.0, help="Smallest allowed cumulated drift in seconds")
+	parser.add_argument("--gaps", type=int, default=10, help="Number of longest intervals to list")
+	parser.add_argument("--save", help="Write the fix columns to this .npz file")
+	args = parser.parse_args()
+
+	fixes = extract(args.log)
+	if args.save:
+		np.savez_compressed(args.save, **fixes)
+
+	count = len(fixes["time"])
+	print("fixes: %d, valid: %d, checksum errors: %d" % (count, fixes["valid"].sum(), count - fixes["checksum_ok"].sum()))
+	qualities, quality_counts = np.unique(fixes["quality"], return_counts=True)
+	print("fix quality: " + ", ".join("%d=%d" % pair for pair in zip(qualities, quality_counts)))
+	known = fixes["time"][~np.isnan(fixes["time"])]
+	if len(known):
+		print("span: %s - %s" % (_format_epoch(known.min()), _format_epoch(known.max())))
+
+	intervals, ends = fix_intervals(fixes)
+	stats = interval_stats(intervals)
+	if stats is None:
+		print("not enough valid fixes for interval analysis")
+	else:
+		print("intervals (s): " + " ".join("%s=%s" % (key, "%.3f" % stats[key] if key != "count" else stats[key])
+			for key in ("count", "min", "p50", "p90", "p99", "max", "mean", "std")))
+		interval = args.interval if args.interval is not None else stats["p50"]
+		passed, cumulated = drift(intervals, interval, args.tolmax, args.tolmin)
+		print("drift against %.3fs: final %.3fs, range %.3fs .. %.3fs, %s" % (
+			interval, cumulated[-1], cumulated.min(), cumulated.max(), "OK" if passed else "inconsistency found"))
+		if args.gaps:
+			print("longest intervals:")
+			for i in np.argsort(intervals)[::-1][:args.gaps]:
+				print("  %s  %.3fs" % (_format_epoch(ends[i]), intervals[i]))
@@ -0,0 +1,354 @@
+"""Indexed queries over terminal simulator trace logs (TraceLogFile).
+
+Lines look like
+	[ 08:47:58.302 ] [115:INFO] Debouncing GpsBlocked=true for 1s
+	[ 08:11:48.538 ] Starting svcmgr.init
+and may be followed by continuation lines without a timestamp.
+
+The log is scanned once into columnar arrays (timestamp in ms with midnight
+rollover, thread id, level, line offset, message offset) which are kept in
+<log>.tidx. When the log grows, only the new part is scanned.
+"""
+import argparse
+import array
+import bisect
+import hashlib
+import json
+import mmap
+import os
+import re
+import sys
+
+INDEX_MAGIC = b"TRACEIDX1\n"
+HEAD_SIZE = 4096
+DAY_MS = 24 * 3600 * 1000
+# a timestamp going back by more than this is taken as midnight rollover, smaller steps as thread interleaving
+ROLLOVER_MS = 12 * 3600 * 1000
+NO_THREAD = -1
+
+LINE_RE = re.compile(rb"\[ (\d\d):(\d\d):(\d\d)\.(\d\d\d) \] ")
+TAG_RE = re.compile(rb"(\d+):(\w+)$")
+TIME_RE = re.compile(r"(?:(\d+)\+)?(\d{1,2}):(\d\d)(?::(\d\d)(?:\.(\d{1,3}))?)?$")
+
+COLUMNS = (
+	("timestamps", "q"),
+	("threads", "i"),
+	("level_codes", "b"),
+	("offsets", "q"),
+	("message_offsets", "q"),
+)
+
+
+def parse_time(text):
+	"""[day+]hh:mm[:ss[.mmm]] -> ms since midnight of the first day of the log."""
+	match = TIME_RE.match(text.strip())
+	if not match:
+		raise ValueError("Time should look like hh:mm[:ss[.mmm]], optionally prefixed with day+: " + text)
+	day, hours, minutes, seconds, millis = match.groups()
+	return (((int(day or 0) * 24 + int(hours)) * 60 + int(minutes)) * 60 + int(seconds or 0)) * 1000 + int((millis or "0").ljust(3, "0"))
+
+
+def format_time(ms):
+	day, ms = divmod(ms, DAY_MS)
+	text = "%02d:%02d:%02d.%03d" % (ms // 3600000, ms // 60000 % 60, ms // 1000 % 60, ms % 1000)
+	return "%d+%s" % (day, text) if day else text
+
+
+def line_ms(line):
+	"""ms since midnight of a timestamped line, None for a continuation line."""
+	if line[:2] != "[ " or line[14:17] != " ] ":
+		return None
+	try:
+		return ((int(line[2:4]) * 60 + int(line[5:7])) * 60 + int(line[8:10])) * 1000 + int(line[11:14])
+	except ValueError:
+		return None
+
+
+def iter_lines(lines, last_ms=None):
+	"""Streams (timestamp ms, thread id, level, message, line) for every line.
+
+	Continuation lines come with the timestamp, thread and level of the entry above
+	them and None as message. Timestamps keep growing across midnight like the ones
+	in the index; last_ms is the timestamp before the first line when the lines do
+	not start at the top of the log.
+	"""
+	day = last_ms // DAY_MS if last_ms is not None else 0
+	thread, level = NO_THREAD, ""
+	for line in lines:
+		stamp = line_ms(line)
+		if stamp is None:
+			yield (last_ms if last_ms is not None else 0), thread, level, None, line
+			continue
+		stamp += day * DAY_MS
+		if last_ms is not None and last_ms - stamp > ROLLOVER_MS:
+			day += 1
+			stamp += DAY_MS
+		last_ms = stamp
+		thread, level, message = NO_THREAD, "", line[17:]
+		if message[:1] == "[":
+			close = message.find("] ")
+			thread_text, _, level_text = message[1:close].partition(":")
+			if close > 0 and thread_text.isdigit():
+				thread, level, message = int(thread_text), level_text, message[close + 2:]
+		yield stamp, thread, level, message.rstrip("\r\n"), line
+
+
+def iter_entries(lines):
+	"""Streams (timestamp ms, thread id, level, message) for every timestamped line, continuation lines are skipped."""
+	for stamp, thread, level, message, line in iter_lines(lines):
+		if message is not None:
+			yield stamp, thread, level, message
+
+
+def stream_select(lines, thread=None, level=None, start=None, end=None, last_ms=None):
+	"""TraceIndex.select() over lines read in order, for logs without an index such as compressed archives.
+
+	Yields (timestamp ms, level, message, line); continuation lines go with their entry and have None as message.
+	"""
+	for stamp, line_thread, line_level, message, line in iter_lines(lines, last_ms):
+		if start is not None and stamp < start or end is not None and stamp > end:
+			continue
+		if thread is not None and line_thread != thread or level is not None and line_level != level:
+			continue
+		yield stamp, line_level, message, line
+
+
+class TraceIndex():
+	def __init__(self, path):
+		self.path = path
+		self.index_path = path + ".tidx"
+		self.levels = [""]
+		self.indexed_size = 0
+		self.day = 0
+		self.last_ms = None
+		self.head = None
+		for name, typecode in COLUMNS:
+			setattr(self, name, array.array(typecode))
+
+	@classmethod
+	def open(cls, path, rebuild=False):
+		"""Loads the on-disk index and brings it up to date with the log."""
+		index = cls(path)
+		if not rebuild:
+			index._load()
+		if index.head != index._head_hash():
+			index = cls(path)
+		if os.path.getsize(path) > index.indexed_size:
+			index._scan()
+			index.save()
+		return index
+
+	def __len__(self):
+		return len(self.offsets)
+
+	def _head_hash(self):
+		with open(self.path, "rb") as f:
+			return hashlib.sha1(f.read(HEAD_SIZE)).hexdigest()
+
+	def _load(self):
+		try:
+			with open(self.index_path, "rb") as f:
+				if f.readline() != INDEX_MAGIC:
+					return
+				header = json.loads(f.readline().decode())
+				count = header["count"]
+				for name, typecode in COLUMNS:
+					column = array.array(typecode)
+					column.fromfile(f, count)
+					setattr(self, name, column)
+		except (IOError, OSError, ValueError, EOFError, KeyError):
+			self.__init__(self.path)
+			return
+		self.levels = header["levels"]
+		self.indexed_size = header["size"]
+		self.day = header["day"]
+		self.last_ms = header["last_ms"]
+		self.head = header["head"]
+		# the log got shorter (rotated or overwritten by a new run)
+		if os.path.getsize(self.path) < self.indexed_size:
+			self.__init__(self.path)
+
+	def save(self):
+		header = {
+			"count" : len(self),
+			"levels" : self.levels,
+			"size" : self.indexed_size,
+			"day" : self.day,
+			"last_ms" : self.last_ms,
+			"head" : self.head,
+		}
+		with open(self.index_path + ".tmp", "wb") as f:
+			f.write(INDEX_MAGIC)
+			f.write((json.dumps(header) + "\n").encode())
+			for name, typecode in COLUMNS:
+				getattr(self, name).tofile(f)
+		os.replace(self.index_path + ".tmp", self.index_path)
+
+	def _scan(self):
+		level_codes = dict((level, code) for code, level in enumerate(self.levels))
+		timestamps, threads, levels = self.timestamps, self.threads, self.levels
+		level_column, offsets, message_offsets = self.level_codes, self.offsets, self.message_offsets
+		day, last_ms = self.day, self.last_ms
+		thread, level = (threads[-1], level_column[-1]) if len(threads) else (NO_THREAD, 0)
+		# "hh:mm:ss" and "thread:LEVEL" repeat a lot, so they are converted once and looked up afterwards
+		seconds_cache = {}
+		tag_cache = {}
+		with open(self.path, "rb") as f:
+			# emptied since its size was taken, an empty file can not be mapped
+			if not os.fstat(f.fileno()).st_size:
+				return
+			mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+			try:
+				position = self.indexed_size
+				end = mm.rfind(b"\n") + 1
+				mm.seek(position)
+				while position < end:
+					line = mm.readline()
+					seconds = None
+					if line[:2] == b"[ " and line[14:17] == b" ] ":
+						seconds = seconds_cache.get(line[2:10])
+						if seconds is None and LINE_RE.match(line):
+							seconds = seconds_cache[line[2:10]] = ((int(line[2:4]) * 60 + int(line[5:7])) * 60 + int(line[8:10])) * 1000
+					if seconds is not None:
+						stamp = seconds + int(line[11:14]) + day * DAY_MS
+						if last_ms is not None and last_ms - stamp > ROLLOVER_MS:
+							day += 1
+							stamp += DAY_MS
+						last_ms = stamp
+						thread, level = NO_THREAD, 0
+						message_offset = 17
+						if line[17:18] == b"[":
+							close = line.find(b"] ", 18)
+							tag = line[18:close]
+							cached = tag_cache.get(tag)
+							if cached is None and close > 0:
+								match = TAG_RE.match(tag)
+								if match:
+									level_text = match.group(2).decode()
+									if level_text not in level_codes:
+										level_codes[level_text] = len(levels)
+										levels.append(level_text)
+									cached = tag_cache[tag] = (int(match.group(1)), level_codes[level_text])
+							if cached is not None:
+								thread, level = cached
+								message_offset = close + 2
+						message_offset += position
+					else:
+						# continuation line, belongs to the entry above it
+						message_offset = position
+					timestamps.append(last_ms if last_ms is not None else 0)
+					threads.append(thread)
+					level_column.append(level)
+					offsets.append(position)
+					message_offsets.append(message_offset)
+					position += len(line)
+				self.indexed_size = end
+			finally:
+				mm.close()
+		self.day, self.last_ms = day, last_ms
+		self.head = self._head_hash()
+
+	def _line_end(self, i):
+		return self.offsets[i + 1] if i + 1 < len(self.offsets) else self.indexed_size
+
+	def line(self, i, mm):
+		return mm[self.offsets[i]:self._line_end(i)].decode("utf-8", "replace").rstrip("\r\n")
+
+	def message(self, i, mm):
+		return mm[self.message_offsets[i]:self._line_end(i)].decode("utf-8", "replace").rstrip("\r\n")
+
+	def select(self, thread=None, level=None, start=None, end=None):
+		"""Yields indexes of lines matching all given criteria; time limits are ms as returned by parse_time."""
+		first = 0 if start is None else bisect.bisect_left(self.timestamps, start)
+		last = len(self) if end is None else bisect.bisect_right(self.timestamps, end)
+		level_code = None
+		if level is not None:
+			if level not in self.levels:
+				return
+			level_code = self.levels.index(level)
+		threads, level_column = self.threads, self.level_codes
+		for i in range(first, last):
+			if thread is not None and threads[i] != thread:
+				continue
+			if level_code is not None and level_column[i] != level_code:
+				continue
+			yield i
+
+	def count_by_level(self, bucket_ms=60000, **criteria):
+		"""Returns {bucket start ms: {level: count}} for entries matching select() criteria."""
+		counts = {}
+		timestamps, level_column, offsets, message_offsets = self.timestamps, self.level_codes, self.offsets, self.message_offsets
+		for i in self.select(**criteria):
+			# continuation lines are part of the entry above, not entries of their own
+			if offsets[i] == message_offsets[i]:
+				continue
+			bucket = counts.setdefault(timestamps[i] - timestamps[i] % bucket_ms, {})
+			level = self.levels[level_column[i]] or "-"
+			bucket[level] = bucket.get(level, 0) + 1
+		return counts
+
+
+def print_counts(counts):
+	levels = sorted(set(level for bucket in counts.values() for level in bucket))
+	print("%-16s %s" % ("time", " ".join("%8s" % level for level in levels)))
+	for bucket in sorted(counts):
+		print("%-16s %s" % (format_time(bucket), " ".join("%8d" % counts[bucket].get(level, 0) for level in levels)))
+
+
+if __name__ == "__main__":
+	# archive imports this module
+	import archive
+
+	parser = argparse.ArgumentParser(description="Queries terminal trace logs through a persistent index.")
+	parser.add_argument("log", help="Trace log file, or a .gz/.zst archive of one (see archive.py)")
+	parser.add_argument("--thread", type=int, help="Only lines of this thread id, e.g. 115")
+	parser.add_argument("--level", help="Only lines of this level, e.g. INFO")
+	parser.add_argument("--start", help="From time [day+]hh:mm[:ss[.mmm]], day counts midnight rollovers")
+	parser.add_argument("--end", help="Up to time [day+]hh:mm[:ss[.mmm]]")
+	parser.add_argument("--grep", help="Only lines whose message contains this text")
+	parser.add_argument("--countby", type=int, metavar="SECONDS", help="Print line counts by level per SECONDS bucket instead of lines")
+	parser.add_argument("--reindex", action="store_true", help="Rebuild the index from scratch (plain logs only)")
+	args = parser.parse_args()
+
+	criteria = {
+		"thread" : args.thread,
+		"level" : args.level,
+		"start" : parse_time(args.start) if args.start else None,
+		"end" : parse_time(args.end) if args.end else None,
+	}
+
+	if archive.is_archive(args.log):
+		# compressed archives have no line index, the block index narrows the read down to the time window
+		lines, last_ms = archive.open_window(args.log, criteria["start"], criteria["end"])
+		matches = stream_select(lines, last_ms=last_ms, **criteria)
+		if args.countby:
+			counts = {}
+			for stamp, level, message, line in matches:
+				if message is not None:
+					bucket = counts.setdefault(stamp - stamp % (args.countby * 1000), {})
+					bucket[level or "-"] = bucket.get(level or "-", 0) + 1
+			print_counts(counts)
+		else:
+			for stamp, level, message, line in matches:
+				if args.grep and args.grep not in (line if message is None else message):
+					continue
+				print(line.rstrip("\r\n"))
+		sys.exit(0)
+
+	index = TraceIndex.open(args.log, rebuild=args.reindex)
+	if args.countby:
+		print_counts(index.count_by_level(args.countby * 1000, **criteria))
+		sys.exit(0)
+	if not len(index):
+		# nothing logged yet, e.g. by a simulator that just started; an empty file can not be mapped
+		sys.exit(0)
+
+	with open(args.log, "rb") as f:
+		mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			for i in index.select(**criteria):
+				if args.grep and args.grep not in index.message(i, mm):
+					continue
+				print(index.line(i, mm))
+		finally:
+			mm.close()
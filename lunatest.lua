@@ -90,6 +90,7 @@ local _importing_env = getenv()
 -- -v / --verbose, default to verbose_hooks.
 -- -s or --suite, only run the named suite(s).
 -- -t or --test, only run tests matching the pattern.
+-- -tl or --testlist, only run the tests of a comma separated list of exact names.
 local lt_arg = arg
 
 -- #####################
@@ -720,6 +721,11 @@ local function cmd_line_switches(arg)
          opts.suite_pat = arg[i+1]
       elseif v == "-t" or v == "--test" then
          opts.test_pat = arg[i+1]
+      elseif v == "-tl" or v == "--testlist" then
+         opts.test_list = {}
+         for name in (arg[i+1] or ""):gmatch("[^,]+") do
+            opts.test_list[name] = true
+         end
       end
    end
    return opts
@@ -765,7 +771,8 @@ local function run_suite(hooks, opts, results, sname, tests)
          if hooks.begin_suite then hooks.begin_suite(res, tests) end
          res.tests = tests
          for name, test in pairs(tests) do
-            if not opts.test_pat or name:match(opts.test_pat) then
+            if (not opts.test_pat or name:match(opts.test_pat))
+               and (not opts.test_list or opts.test_list[name]) then
               if opts.verbose then
                 print("[STARTING]: " .. name)
                 D:log("Executing test: " .. name)